@@ -0,0 +1,109 @@
+"""
+-----------------------------------------------------------------------------------------
+benchmark_hrf.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Micro-benchmark of the per-call latency of return_prediction, with a fixed hrf
+and with fitted hrf parameters (fit_hrf), with and without the cached hrf basis
+and convolution operators
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: task (ex: GazeCenterFS)
+sys.argv[2]: number of calls per condition
+-----------------------------------------------------------------------------------------
+Output(s):
+Printed median and mean latency per condition
+-----------------------------------------------------------------------------------------
+To run:
+>> cd to function directory
+>> python fit/benchmark_hrf.py [task] [number of calls]
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/mszinte/projects/pRFgazeMod/mri_analysis/
+python fit/benchmark_hrf.py GazeCenterFS 1000
+-----------------------------------------------------------------------------------------
+Written by Martin Szinte (martin.szinte@gmail.com)
+-----------------------------------------------------------------------------------------
+"""
+
+# Stop warnings
+# -------------
+import warnings
+warnings.filterwarnings("ignore")
+
+# General imports
+# ---------------
+import sys
+import os
+import json
+import time
+import numpy as np
+import scipy.io
+opj = os.path.join
+
+# MRI analysis imports
+# --------------------
+from model.prfpy.stimulus import PRFStimulus2D
+from model.prfpy.model import Iso2DGaussianModel
+
+# Get inputs
+# ----------
+task = sys.argv[1]
+n_calls = int(sys.argv[2])
+
+# Define analysis parameters
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+base_dir = analysis_info['base_dir']
+
+# Create stimulus design
+if 'GazeCenterFS' in task:
+    end_task = 'GazeCenterFS'
+elif 'GazeCenter' in task:
+    end_task = 'GazeCenter'
+elif 'GazeRight' in task:
+    end_task = 'GazeRight'
+elif 'GazeLeft' in task:
+    end_task = 'GazeLeft'
+
+visual_dm_file = scipy.io.loadmat(opj(base_dir,'pp_data','visual_dm',"{end_task}_vd.mat".format(end_task = end_task)))
+visual_dm = visual_dm_file['stim'].transpose([1,0,2])
+
+stimulus = PRFStimulus2D(   screen_size_cm=analysis_info['screen_width'],
+                            screen_distance_cm=analysis_info['screen_distance'],
+                            design_matrix=visual_dm,
+                            TR=analysis_info['TR'])
+
+# random parameters, as visited by the iterative fit
+rng = np.random.default_rng(0)
+params = np.c_[ rng.uniform(-5, 5, n_calls), rng.uniform(-5, 5, n_calls), rng.uniform(0.5, 5, n_calls),
+                np.ones(n_calls), np.zeros(n_calls), rng.uniform(0, 10, n_calls), rng.uniform(0, 2, n_calls)]
+
+def clear_hrf_cache(model):
+    # forget the hrf basis and operators, as before they were cached
+    for attribute in ['hrf_basis_TR', 'hrf_basis_operators_source', 'hrf_operator_source']:
+        model.__dict__.pop(attribute, None)
+
+conditions = [  ('fixed hrf, cached operator', True, False, False),
+                ('fixed hrf, fft convolution', False, False, False),
+                ('fit_hrf, cached basis operators', True, True, False),
+                ('fit_hrf, cached basis, fft convolution', False, True, False),
+                ('fit_hrf, uncached basis, fft convolution', False, True, True)]
+
+for name, precompute_convolution, fit_hrf, uncached in conditions:
+    model = Iso2DGaussianModel(stimulus = stimulus, precompute_convolution = precompute_convolution)
+    n_params = 7 if fit_hrf else 5
+    # first call computes the caches
+    model.return_prediction(*list(params[:1, :n_params].T))
+
+    latencies = np.zeros(n_calls)
+    for call in range(n_calls):
+        if uncached:
+            clear_hrf_cache(model)
+        start_time = time.perf_counter()
+        model.return_prediction(*list(params[call:call+1, :n_params].T))
+        latencies[call] = time.perf_counter() - start_time
+
+    print("{name:<45}median {median:8.1f} us\tmean {mean:8.1f} us".format(
+            name = name, median = np.median(latencies)*1e6, mean = np.mean(latencies)*1e6))
@@ -0,0 +1,150 @@
+"""
+-----------------------------------------------------------------------------------------
+benchmark_optimizers.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Benchmark of the iterative fit optimizer backends on the same voxels and grid fit
+starting parameters: evaluations, iterations and time per voxel, and rsq parity
+with the first (reference) optimizer
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: subject name
+sys.argv[2]: task (ex: GazeCenterFS)
+sys.argv[3]: pre-processing steps (fmriprep_dct or fmriprep_dct_pca)
+sys.argv[4]: voxel index file of a shard (see submit_fit_jobs.py)
+sys.argv[5]: number of voxels of the shard to fit (randomly drawn)
+sys.argv[6]: optimizers, comma separated, reference first (optional, default: all)
+sys.argv[7]: maximum time per voxel in seconds (optional, default: no maximum)
+-----------------------------------------------------------------------------------------
+Output(s):
+Printed statistics per optimizer
+-----------------------------------------------------------------------------------------
+To run:
+>> cd to function directory
+>> python fit/benchmark_optimizers.py [subject] [task] [preproc] [voxel index file] [number of voxels] [optimizers] [max seconds]
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/mszinte/projects/pRFgazeMod/mri_analysis/
+python fit/benchmark_optimizers.py sub-001 GazeCenterFS fmriprep_dct /home/.../sub-001..._shard_10_voxels.npy 500
+python fit/benchmark_optimizers.py sub-001 GazeCenterFS fmriprep_dct /home/.../sub-001..._shard_10_voxels.npy 500 Powell,L-BFGS-B,dual_annealing 2
+-----------------------------------------------------------------------------------------
+Written by Martin Szinte (martin.szinte@gmail.com)
+-----------------------------------------------------------------------------------------
+"""
+
+# Stop warnings
+# -------------
+import warnings
+warnings.filterwarnings("ignore")
+
+# General imports
+# ---------------
+import sys
+import os
+import json
+import numpy as np
+import scipy.io
+import nibabel as nb
+opj = os.path.join
+
+# MRI analysis imports
+# --------------------
+from model.prfpy.stimulus import PRFStimulus2D
+from model.prfpy.model import Iso2DGaussianModel
+from model.prfpy.fit import Iso2DGaussianFitter, optimizers
+from model.prfpy.voxels import VoxelSource
+
+# Get inputs
+# ----------
+subject = sys.argv[1]
+task = sys.argv[2]
+preproc = sys.argv[3]
+voxel_file = sys.argv[4]
+n_voxels = int(sys.argv[5])
+if len(sys.argv) > 6:
+    optimizer_names = sys.argv[6].split(',')
+else:
+    optimizer_names = list(optimizers)
+if len(sys.argv) > 7:
+    max_seconds = float(sys.argv[7])
+else:
+    max_seconds = None
+
+# Define analysis parameters
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+base_dir = analysis_info['base_dir']
+nb_procs = 32
+rsq_threshold = 0.0001
+grid_cache_dir = opj(base_dir, 'pp_data', 'grid_cache')
+
+# Load data of randomly drawn voxels of the shard
+rng = np.random.default_rng(0)
+vox_indices = np.load(voxel_file)
+vox_indices = vox_indices[np.sort(rng.choice(vox_indices.shape[0], min(n_voxels, vox_indices.shape[0]), replace=False))]
+data_file = "{base_dir}/pp_data/{sub}/func/{sub}_task-{task}_{preproc}_avg.nii.gz".format(
+                        base_dir = base_dir, sub = subject, task = task, preproc = preproc)
+data_to_analyse = VoxelSource.from_nifti_voxels(nb.load(data_file), vox_indices).data
+
+# Create stimulus design
+if 'GazeCenterFS' in task:
+    end_task = 'GazeCenterFS'
+elif 'GazeCenter' in task:
+    end_task = 'GazeCenter'
+elif 'GazeRight' in task:
+    end_task = 'GazeRight'
+elif 'GazeLeft' in task:
+    end_task = 'GazeLeft'
+
+visual_dm_file = scipy.io.loadmat(opj(base_dir,'pp_data','visual_dm',"{end_task}_vd.mat".format(end_task = end_task)))
+visual_dm = visual_dm_file['stim'].transpose([1,0,2])
+
+stimulus = PRFStimulus2D(   screen_size_cm=analysis_info['screen_width'],
+                            screen_distance_cm=analysis_info['screen_distance'],
+                            design_matrix=visual_dm,
+                            TR=analysis_info['TR'])
+
+# define model, grid and bounds (for optimizers that support them)
+gauss_model = Iso2DGaussianModel(stimulus = stimulus)
+grid_nr = analysis_info['grid_nr']
+max_ecc_size = analysis_info['max_ecc_size']
+sizes = max_ecc_size * np.linspace(0.25,1,grid_nr)**2
+eccs = max_ecc_size * np.linspace(0.1,1,grid_nr)**2
+polars = np.linspace(0, 2*np.pi, grid_nr)
+max_amplitude = 10 * np.abs(data_to_analyse).max()
+bounds = [  (-1.5*max_ecc_size, 1.5*max_ecc_size),     # x
+            (-1.5*max_ecc_size, 1.5*max_ecc_size),     # y
+            (0.1, 1.5*max_ecc_size),                   # size
+            (0, max_amplitude),                        # beta
+            (-max_amplitude, max_amplitude)]           # baseline
+
+# grid fit, the starting parameters of all optimizers
+gauss_fitter = Iso2DGaussianFitter(data = data_to_analyse, model = gauss_model, n_jobs = nb_procs)
+gauss_fitter.grid_fit(ecc_grid = eccs, polar_grid = polars, size_grid = sizes, pos_prfs_only = True,
+                      grid_cache_dir = grid_cache_dir)
+starting_params = gauss_fitter.gridsearch_params
+
+print("{num_vox} voxels, {num_fit} above rsq threshold".format(
+        num_vox = vox_indices.shape[0], num_fit = np.sum(starting_params[:, -1] > rsq_threshold)))
+
+for optimizer in optimizer_names:
+    gauss_fitter.iterative_fit(rsq_threshold = rsq_threshold, starting_params = starting_params,
+                               bounds = bounds if optimizers[optimizer]['supports_bounds'] else None,
+                               optimizer = optimizer, max_seconds = max_seconds)
+    stats = gauss_fitter.optimizer_stats
+    rsq = gauss_fitter.iterative_search_params[gauss_fitter.rsq_mask, -1]
+    if optimizer == optimizer_names[0]:
+        reference_rsq = rsq
+
+    print("{optimizer:<16}wall {wall:8.1f} s\tmedian {seconds:8.1f} ms\tevaluations {evaluations:6.0f}\t"
+          "iterations {iterations:6.0f}\tbudget spent {budget_spent:5d}\tmedian rsq {rsq:.4f}\t"
+          "rsq loss > 0.001 {rsq_loss:5d}".format(
+            optimizer = optimizer,
+            wall = stats['wall_seconds'],
+            seconds = stats['median_seconds']*1e3,
+            evaluations = stats['median_evaluations'],
+            iterations = stats['median_iterations'],
+            budget_spent = stats['budget_spent'],
+            rsq = stats['median_rsq'],
+            rsq_loss = int(np.sum(rsq < reference_rsq - 0.001))))
@@ -0,0 +1,141 @@
+"""
+-----------------------------------------------------------------------------------------
+check_hrf_convolution.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Regression check of the cached hrf convolution operators: predictions of the Gaussian,
+CSS, DoG and normalization models with precompute_convolution must match the fft
+convolution fallback (precompute_convolution=False) within float32 tolerance, with
+and without filter_predictions, with a fixed hrf and with fitted hrf parameters.
+Check of the CSS analytic jacobian against central finite differences, including small
+exponents and pRFs outside the screen where the stimulus response underflows
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: task (ex: GazeCenterFS)
+sys.argv[2]: number of parameter sets per condition
+-----------------------------------------------------------------------------------------
+Output(s):
+Printed maximum relative difference per condition, exit with an error if any condition
+exceeds its tolerance
+-----------------------------------------------------------------------------------------
+To run:
+>> cd to function directory
+>> python fit/check_hrf_convolution.py [task] [number of parameter sets]
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/mszinte/projects/pRFgazeMod/mri_analysis/
+python fit/check_hrf_convolution.py GazeCenterFS 100
+-----------------------------------------------------------------------------------------
+Written by Martin Szinte (martin.szinte@gmail.com)
+-----------------------------------------------------------------------------------------
+"""
+
+# Stop warnings
+# -------------
+import warnings
+warnings.filterwarnings("ignore")
+
+# General imports
+# ---------------
+import sys
+import os
+import json
+import numpy as np
+import scipy.io
+opj = os.path.join
+
+# MRI analysis imports
+# --------------------
+from model.prfpy.stimulus import PRFStimulus2D
+from model.prfpy.model import Iso2DGaussianModel, CSS_Iso2DGaussianModel, DoG_Iso2DGaussianModel, Norm_Iso2DGaussianModel
+
+# Get inputs
+# ----------
+task = sys.argv[1]
+n_params = int(sys.argv[2])
+tolerance = 1e-5  # relative to the largest prediction, float32 precision
+jacobian_tolerance = 1e-3  # relative to the largest finite difference derivative
+
+# Define analysis parameters
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+base_dir = analysis_info['base_dir']
+
+# Create stimulus design
+if 'GazeCenterFS' in task:
+    end_task = 'GazeCenterFS'
+elif 'GazeCenter' in task:
+    end_task = 'GazeCenter'
+elif 'GazeRight' in task:
+    end_task = 'GazeRight'
+elif 'GazeLeft' in task:
+    end_task = 'GazeLeft'
+
+visual_dm_file = scipy.io.loadmat(opj(base_dir,'pp_data','visual_dm',"{end_task}_vd.mat".format(end_task = end_task)))
+visual_dm = visual_dm_file['stim'].transpose([1,0,2])
+
+stimulus = PRFStimulus2D(   screen_size_cm=analysis_info['screen_width'],
+                            screen_distance_cm=analysis_info['screen_distance'],
+                            design_matrix=visual_dm,
+                            TR=analysis_info['TR'])
+
+# random parameters of each model, in the order of return_prediction (without hrf)
+rng = np.random.default_rng(0)
+x, y = rng.uniform(-5, 5, n_params), rng.uniform(-5, 5, n_params)
+size, beta, baseline = rng.uniform(0.5, 5, n_params), rng.uniform(0.5, 2, n_params), rng.uniform(-1, 1, n_params)
+hrf_params = np.c_[rng.uniform(0, 10, n_params), rng.uniform(0, 2, n_params)]
+model_params = [(Iso2DGaussianModel,      np.c_[x, y, size, beta, baseline]),
+                (CSS_Iso2DGaussianModel,  np.c_[x, y, size, beta, baseline, rng.uniform(0.1, 1, n_params)]),
+                (DoG_Iso2DGaussianModel,  np.c_[x, y, size, beta, baseline, rng.uniform(0, 1, n_params),
+                                                size*rng.uniform(1.5, 4, n_params)]),
+                (Norm_Iso2DGaussianModel, np.c_[x, y, size, beta, baseline, rng.uniform(0, 1, n_params),
+                                                size*rng.uniform(1.5, 4, n_params), rng.uniform(0.5, 5, n_params),
+                                                rng.uniform(1, 10, n_params)])]
+filter_settings = [ ('no filter', dict(filter_predictions = False)),
+                    ('dc filter', dict(filter_predictions = True, filter_type = 'dc',
+                                       filter_params = dict(first_modes_to_remove = 3)))]
+
+failed = False
+for model_class, params in model_params:
+    for filter_name, filter_kwargs in filter_settings:
+        for hrf_name, all_params in [('fixed hrf', params), ('fit_hrf', np.c_[params, hrf_params])]:
+            predictions = [model_class(stimulus = stimulus, precompute_convolution = precompute_convolution,
+                                       **filter_kwargs).return_prediction(*list(all_params.T))
+                           for precompute_convolution in [True, False]]
+            difference = np.abs(predictions[0] - predictions[1]).max() / np.abs(predictions[1]).max()
+            failed = failed or not difference < tolerance
+
+            print("{model:<25}{filter_name:<12}{hrf_name:<12}max relative difference {difference:.1e}".format(
+                    model = model_class.__name__, filter_name = filter_name, hrf_name = hrf_name,
+                    difference = difference))
+
+# CSS jacobian: on screen, and small exponents outside the screen (beyond 1.2 times the
+# screen half size) where rf_tc**(n-1) overflows
+half_screen = stimulus.screen_size_degrees / 2
+off_x, off_y = rng.uniform(1.2, 1.5, n_params) * half_screen, rng.uniform(-1, 1, n_params) * half_screen
+jacobian_params = [ ('on screen',       model_params[1][1]),
+                    ('small n, off screen', np.c_[off_x*rng.choice([-1, 1], n_params), off_y,
+                                                  rng.uniform(0.3, 1, n_params), beta, baseline,
+                                                  rng.uniform(0.01, 0.05, n_params)])]
+for filter_name, filter_kwargs in filter_settings:
+    css_model = CSS_Iso2DGaussianModel(stimulus = stimulus, **filter_kwargs)
+    for params_name, params in jacobian_params:
+        _, jacobian = css_model.return_prediction_and_jacobian(*list(params.T))
+        finite_difference = np.zeros_like(jacobian)
+        for param_num in range(params.shape[1]):
+            step = np.zeros(params.shape[1])
+            step[param_num] = 1e-5 * max(1, np.abs(params[:, param_num]).max())
+            finite_difference[:, param_num] = (css_model.return_prediction(*list((params + step).T)) -
+                                               css_model.return_prediction(*list((params - step).T))
+                                               ) / (2 * step[param_num])
+        difference = np.abs(jacobian - finite_difference).max() / np.abs(finite_difference).max()
+        failed = failed or not difference < jacobian_tolerance
+
+        print("{model:<25}{filter_name:<12}{params_name:<20}jacobian max relative difference {difference:.1e}".format(
+                model = CSS_Iso2DGaussianModel.__name__, filter_name = filter_name, params_name = params_name,
+                difference = difference))
+
+if failed:
+    sys.exit('cached convolution or CSS jacobian check failed, tolerances {tolerance:.0e} and {jacobian_tolerance:.0e}'.format(
+                tolerance = tolerance, jacobian_tolerance = jacobian_tolerance))
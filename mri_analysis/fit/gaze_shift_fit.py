@@ -0,0 +1,150 @@
+"""
+-----------------------------------------------------------------------------------------
+gaze_shift_fit.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Create pRF estimates of a gaze condition fitting only the x position, with the y
+position and size of each voxel imported from the GazeCenterFS fit
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: subject name
+sys.argv[2]: task, not a GazeCenterFS task (ex: AttendFixGazeLeft)
+sys.argv[3]: pre-processing steps (fmriprep_dct or fmriprep_dct_pca)
+-----------------------------------------------------------------------------------------
+Output(s):
+Nifti image file with fit parameters (x, y, size, beta, baseline, rsq), named
+*_avg_est_xshift.nii.gz so that it does not replace the full fit of post_fit.py
+-----------------------------------------------------------------------------------------
+To run:
+>> cd to function directory
+>> python fit/gaze_shift_fit.py [subject] [task] [preproc]
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/mszinte/projects/pRFgazeMod/mri_analysis/
+python fit/gaze_shift_fit.py sub-001 AttendFixGazeLeft fmriprep_dct
+python fit/gaze_shift_fit.py sub-001 AttendStimGazeRight fmriprep_dct_pca
+-----------------------------------------------------------------------------------------
+Written by Martin Szinte (martin.szinte@gmail.com)
+-----------------------------------------------------------------------------------------
+"""
+
+# Stop warnings
+# -------------
+import warnings
+warnings.filterwarnings("ignore")
+
+# General imports
+# ---------------
+import sys
+import numpy as np
+import scipy.io
+import os
+import datetime
+import json
+import ipdb
+deb = ipdb.set_trace
+opj = os.path.join
+
+# MRI analysis imports
+# --------------------
+from model.prfpy.stimulus import PRFStimulus2D
+from model.prfpy.model import Iso2DGaussianModel
+from model.prfpy.fit import GazeShift_Iso2DGaussianFitter
+from model.prfpy.voxels import VoxelSource
+import nibabel as nb
+
+# Get inputs
+# ----------
+subject = sys.argv[1]
+task = sys.argv[2]
+preproc = sys.argv[3]
+start_time = datetime.datetime.now()
+
+# Define analysis parameters
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+
+# Define cluster/server specific parameters
+base_dir = analysis_info['base_dir']
+nb_procs = 32
+rsq_threshold = 0.0001
+
+# Gaze condition and its GazeCenterFS reference
+if 'GazeCenterFS' in task:
+    end_task = 'GazeCenterFS'
+elif 'GazeCenter' in task:
+    end_task = 'GazeCenter'
+elif 'GazeRight' in task:
+    end_task = 'GazeRight'
+elif 'GazeLeft' in task:
+    end_task = 'GazeLeft'
+if end_task == 'GazeCenterFS':
+    sys.exit('{task} is the GazeCenterFS reference of the x-only fit, analysis stopped'.format(task = task))
+ref_task = task.replace(end_task, 'GazeCenterFS')
+
+# Load GazeCenterFS estimates (see post_fit.py)
+ref_est_file = "{base_dir}/pp_data/{sub}/gauss/fit/{sub}_task-{ref_task}_{preproc}_avg_est.nii.gz".format(
+                        base_dir = base_dir, sub = subject, ref_task = ref_task, preproc = preproc)
+ref_est_img = nb.load(ref_est_file)
+ref_ests = np.asarray(ref_est_img.dataobj)
+
+# voxels fitted in GazeCenterFS
+vox_indices = np.argwhere(ref_ests[...,-1] > rsq_threshold)
+num_vox = vox_indices.shape[0]
+previous_params = ref_ests[tuple(vox_indices.T)]
+
+# Load data, reading only the slices holding the voxels
+data_file = "{base_dir}/pp_data/{sub}/func/{sub}_task-{task}_{preproc}_avg.nii.gz".format(
+                        base_dir = base_dir, sub = subject, task = task, preproc = preproc)
+data_img = nb.load(data_file)
+data_to_analyse = VoxelSource.from_nifti_voxels(data_img, vox_indices).data
+
+# Create stimulus design (create in matlab - see others/make_visual_dm.m)
+visual_dm_file = scipy.io.loadmat(opj(base_dir,'pp_data','visual_dm',"{end_task}_vd.mat".format(end_task = end_task)))
+visual_dm = visual_dm_file['stim'].transpose([1,0,2])
+
+stimulus = PRFStimulus2D(   screen_size_cm=analysis_info['screen_width'],
+                            screen_distance_cm=analysis_info['screen_distance'],
+                            design_matrix=visual_dm,
+                            TR=analysis_info['TR'])
+
+# define model and x grid
+gauss_model = Iso2DGaussianModel(stimulus = stimulus)
+grid_nr = analysis_info['grid_nr']
+max_ecc_size = analysis_info['max_ecc_size']
+x_grid = np.linspace(-max_ecc_size, max_ecc_size, 2*grid_nr+1)
+
+print("{task} {preproc}: {num_vox} voxels fitted in {ref_task}".format(
+                task = task, preproc = preproc, num_vox = num_vox, ref_task = ref_task))
+
+# grid fit of x
+print("Grid fit")
+gaze_fitter = GazeShift_Iso2DGaussianFitter(model = gauss_model, data = data_to_analyse,
+                                            previous_params = previous_params, n_jobs = nb_procs)
+gaze_fitter.grid_fit(x_grid = x_grid, pos_prfs_only = True)
+
+# iterative fit of x
+print("Iterative fit")
+gaze_fitter.iterative_fit(rsq_threshold = rsq_threshold)
+estimates_fit = gaze_fitter.iterative_search_params
+
+# Save estimates data, in the layout of post_fit.py, next to its full fit of the task
+ests = np.zeros(ref_ests.shape)
+ests[tuple(vox_indices.T)] = estimates_fit
+
+estfn = "{base_dir}/pp_data/{subject}/gauss/fit/{subject}_task-{task}_{preproc}_avg_est_xshift.nii.gz".format(
+                                base_dir = base_dir,
+                                subject = subject,
+                                task = task,
+                                preproc = preproc)
+
+new_img = nb.Nifti1Image(dataobj = ests, affine = ref_est_img.affine, header = ref_est_img.header)
+new_img.to_filename(estfn)
+
+# Print duration
+end_time = datetime.datetime.now()
+print("\nStart time:\t{start_time}\nEnd time:\t{end_time}\nDuration:\t{dur}".format(
+                start_time = start_time,
+                end_time = end_time,
+                dur  = end_time - start_time))
@@ -3,25 +3,27 @@
 prf_fit.py
 -----------------------------------------------------------------------------------------
 Goal of the script:
-Create pRF estimates
+Create pRF estimates of a shard of voxels, for one or several datasets with the same
+design (grid fit against the same predictions in one pass)
 -----------------------------------------------------------------------------------------
 Input(s):
 sys.argv[1]: subject name
-sys.argv[2]: task (ex: GazeCenterFS)
-sys.argv[3]: pre-processing steps (fmriprep_dct or fmriprep_dct_pca)
-sys.argv[4]: slice number
-sys.argv[5]: output filename
+sys.argv[2]: task(s), comma separated (ex: GazeCenterFS or AttendFixGazeCenterFS,AttendStimGazeCenterFS)
+sys.argv[3]: pre-processing steps, comma separated (fmriprep_dct and/or fmriprep_dct_pca)
+sys.argv[4]: voxel index file of the shard (see submit_fit_jobs.py)
+sys.argv[5]: output filename(s), comma separated, one per task and pre-processing (tasks first)
 -----------------------------------------------------------------------------------------
 Output(s):
-Nifti image files with fit parameters for a z slice
+Numpy file(s) with fit parameters of the voxels of the shard, in the order of the voxel index file
 -----------------------------------------------------------------------------------------
 To run:
 >> cd to function directory
->> python fit/prf_fit.py [subject] [task] [preproc][slice_nb] [nifti timeseries]
+>> python fit/prf_fit.py [subject] [task(s)] [preproc(s)] [voxel index file] [output file(s)]
 -----------------------------------------------------------------------------------------
 Exemple:
 cd /home/mszinte/projects/pRFgazeMod/mri_analysis/
-python fit/prf_fit.py sub-001 GazeCenterFS fmriprep_dct 10 /home/.../sub-001....nii.gz
+python fit/prf_fit.py sub-001 GazeCenterFS fmriprep_dct /home/.../sub-001..._shard_10_voxels.npy /home/.../sub-001..._shard_10.npy
+python fit/prf_fit.py sub-001 GazeCenterFS fmriprep_dct,fmriprep_dct_pca /home/.../sub-001..._shard_10_voxels.npy /home/.../sub-001..._fmriprep_dct_avg_est_shard_10.npy,/home/.../sub-001..._fmriprep_dct_pca_avg_est_shard_10.npy
 -----------------------------------------------------------------------------------------
 Written by Martin Szinte (martin.szinte@gmail.com)
 -----------------------------------------------------------------------------------------
@@ -54,15 +56,19 @@ from model.prfpy.timecourse import *
 from model.prfpy.stimulus import PRFStimulus2D
 from model.prfpy.model import Iso2DGaussianModel
 from model.prfpy.fit import Iso2DGaussianFitter
+from model.prfpy.voxels import VoxelSource
 import nibabel as nb
 
 # Get inputs
 # ----------
 subject = sys.argv[1]
-task = sys.argv[2]
-preproc = sys.argv[3]
-slice_nb = int(sys.argv[4])
-opfn = sys.argv[5]
+tasks = sys.argv[2].split(',')
+preprocs = sys.argv[3].split(',')
+voxel_file = sys.argv[4]
+opfns = sys.argv[5].split(',')
+datasets = [(task, preproc) for task in tasks for preproc in preprocs]
+if len(opfns) != len(datasets):
+    sys.exit('%i output files for %i datasets, analysis stopped'%(len(opfns), len(datasets)))
 start_time = datetime.datetime.now()
 
 # Define analysis parameters
@@ -73,34 +79,36 @@ with open('settings.json') as f:
 # Define cluster/server specific parameters
 base_dir = analysis_info['base_dir']
 nb_procs = 32
+grid_chunk_size = 1000
+grid_cache_dir = opj(base_dir, 'pp_data', 'grid_cache')
+checkpoint_seconds = 300
 
 # Load data
-data_file = "{base_dir}/pp_data/{sub}/func/{sub}_task-{task}_{preproc}_avg.nii.gz".format(
-                        base_dir = base_dir, sub = subject, task = task, preproc = preproc)
-data_img = nb.load(data_file)
-data = data_img.get_fdata()
-data_var = np.var(data,axis=3)
-mask = data_var!=0.0
-
-slice_mask = mask[:,:,slice_nb].astype(bool)
-num_vox = np.sum(slice_mask)
-data_slice = data[:,:,slice_nb,:]
-data_to_analyse = data_slice[slice_mask]
-
-# determine voxel indices
-y, x = np.meshgrid( np.arange(data.shape[1]),np.arange(data.shape[0]))
-x_vox,y_vox = x[slice_mask],y[slice_mask]
-vox_indices = [(xx,yy,slice_nb) for xx,yy in zip(x_vox,y_vox)]
+vox_indices = np.load(voxel_file)
+num_vox = vox_indices.shape[0]
+data_to_analyse = []
+for task, preproc in datasets:
+    data_file = "{base_dir}/pp_data/{sub}/func/{sub}_task-{task}_{preproc}_avg.nii.gz".format(
+                            base_dir = base_dir, sub = subject, task = task, preproc = preproc)
+    data_img = nb.load(data_file)
+
+    # read only the slices holding the voxels of the shard, rather than the whole image
+    data_to_analyse.append(VoxelSource.from_nifti_voxels(data_img, vox_indices).data)
 
 # Create stimulus design (create in matlab - see others/make_visual_dm.m)
-if 'GazeCenterFS' in task: 
-    end_task = 'GazeCenterFS'
-elif 'GazeCenter' in task:
-    end_task = 'GazeCenter'
-elif 'GazeRight' in task:
-    end_task = 'GazeRight'
-elif 'GazeLeft' in task:
-    end_task = 'GazeLeft'
+end_tasks = []
+for task in tasks:
+    if 'GazeCenterFS' in task: 
+        end_tasks.append('GazeCenterFS')
+    elif 'GazeCenter' in task:
+        end_tasks.append('GazeCenter')
+    elif 'GazeRight' in task:
+        end_tasks.append('GazeRight')
+    elif 'GazeLeft' in task:
+        end_tasks.append('GazeLeft')
+if len(set(end_tasks)) != 1:
+    sys.exit('tasks with different designs, analysis stopped')
+end_task = end_tasks[0]
 
 visual_dm_file = scipy.io.loadmat(opj(base_dir,'pp_data','visual_dm',"{end_task}_vd.mat".format(end_task = end_task)))
 visual_dm = visual_dm_file['stim'].transpose([1,0,2])
@@ -118,26 +126,37 @@ sizes = max_ecc_size * np.linspace(0.25,1,grid_nr)**2
 eccs = max_ecc_size * np.linspace(0.1,1,grid_nr)**2
 polars = np.linspace(0, 2*np.pi, grid_nr)
 
-print("Slice {slice_nb} containing {num_vox} brain mask voxels".format(slice_nb = slice_nb, num_vox = num_vox))
+print("Shard {voxel_file} containing {num_vox} brain mask voxels, for {num_datasets} dataset(s)".format(
+                voxel_file = voxel_file, num_vox = num_vox, num_datasets = len(datasets)))
 
-# grid fit
+# grid fit, of all datasets against the same predictions
 print("Grid fit")
-gauss_fitter = Iso2DGaussianFitter(data = data_to_analyse, model = gauss_model, n_jobs = nb_procs)
-gauss_fitter.grid_fit(ecc_grid = eccs, polar_grid = polars, size_grid = sizes, pos_prfs_only = True)
-
-# iterative fit
-print("Iterative fit")
-gauss_fitter.iterative_fit(rsq_threshold = 0.0001, verbose = False)
-estimates_fit = gauss_fitter.iterative_search_params
-
-# Re-arrange data
-estimates_mat = np.zeros((data.shape[0],data.shape[1],data.shape[2],6))
-for est,vox in enumerate(vox_indices):
-    estimates_mat[vox] = estimates_fit[est]
-
-# Save estimates data
-new_img = nb.Nifti1Image(dataobj = estimates_mat, affine = data_img.affine, header = data_img.header)
-new_img.to_filename(opfn)
+gauss_fitters = [Iso2DGaussianFitter(data = data, model = gauss_model, n_jobs = nb_procs) for data in data_to_analyse]
+gauss_fitters[0].grid_fit(ecc_grid = eccs, polar_grid = polars, size_grid = sizes, pos_prfs_only = True,
+                          grid_chunk_size = grid_chunk_size, grid_cache_dir = grid_cache_dir,
+                          other_fitters = gauss_fitters[1:])
+
+for (task, preproc), gauss_fitter, opfn in zip(datasets, gauss_fitters, opfns):
+
+    # iterative fit, checkpointed so that a job resubmitted after reaching its
+    # time limit resumes from the voxels already fitted, slice by slice with
+    # voxels starting from the fits of their neighbours when these are better
+    print("Iterative fit {task} {preproc}".format(task = task, preproc = preproc))
+    checkpoint_file = opfn.replace('.npy', '_checkpoint.dat')
+    gauss_fitter.iterative_fit(rsq_threshold = 0.0001, verbose = False,
+                               checkpoint_file = checkpoint_file, checkpoint_seconds = checkpoint_seconds,
+                               unit_coordinates = vox_indices)
+    estimates_fit = gauss_fitter.iterative_search_params
+    if hasattr(gauss_fitter, 'optimizer_stats'):
+        print("{warm_started} of {num_fit} voxels warm started, median evaluations {warm:.0f} (warm started) and {grid:.0f} (grid started)".format(
+                warm_started = gauss_fitter.optimizer_stats['warm_started'],
+                num_fit = gauss_fitter.optimizer_stats['n_units'],
+                warm = gauss_fitter.optimizer_stats['median_evaluations_warm_started'],
+                grid = gauss_fitter.optimizer_stats['median_evaluations_grid_started']))
+
+    # Save estimates data, merged by voxel index in post_fit.py
+    np.save(opfn, estimates_fit)
+    os.remove(checkpoint_file)
 
 # Print duration
 end_time = datetime.datetime.now()
@@ -3,25 +3,30 @@
 submit_fit_jobs.py
 -----------------------------------------------------------------------------------------
 Goal of the script:
-Create jobscript to fit pRFs
+Create jobscript to fit pRFs, on shards of brain voxels of equal estimated cost.
+Several tasks and pre-processings with the same design are fit in the same jobs,
+against the same grid predictions.
 -----------------------------------------------------------------------------------------
 Input(s):
 sys.argv[1]: subject name (e.g. 'sub-01')
-sys.argv[2]: task (ex: GazeCenterFS)
-sys.argv[3]: pre-processing steps (fmriprep_dct or fmriprep_dct_pca)
+sys.argv[2]: task(s), comma separated (ex: GazeCenterFS or AttendFixGazeCenterFS,AttendStimGazeCenterFS)
+sys.argv[3]: pre-processing steps, comma separated (fmriprep_dct and/or fmriprep_dct_pca)
+sys.argv[4]: number of shards (optional, default: enough for job_hours per job)
 -----------------------------------------------------------------------------------------
 Output(s):
+voxel index file per shard and dataset
 .sh file to execute in server
 -----------------------------------------------------------------------------------------
 To run:
 >> cd to function
->> python fit/submit_fit_fs_jobs.py [subject] [task] [preproc]
+>> python fit/submit_fit_jobs.py [subject] [task(s)] [preproc(s)] [number of shards]
 -----------------------------------------------------------------------------------------
 Exemple:
 cd /home/mszinte/projects/pRFgazeMod/mri_analysis/
 python fit/submit_fit_jobs.py sub-001 GazeCenterFS fmriprep_dct_pca
 python fit/submit_fit_jobs.py sub-001 AttendFixGazeCenterFS fmriprep_dct_pca
-python fit/submit_fit_jobs.py sub-001 AttendStimGazeCenterFS fmriprep_dct_pca
+python fit/submit_fit_jobs.py sub-001 AttendStimGazeCenterFS fmriprep_dct_pca 20
+python fit/submit_fit_jobs.py sub-001 AttendFixGazeCenterFS,AttendStimGazeCenterFS fmriprep_dct,fmriprep_dct_pca
 -----------------------------------------------------------------------------------------
 Written by Martin Szinte (martin.szinte@gmail.com)
 -----------------------------------------------------------------------------------------
@@ -46,12 +51,22 @@ import datetime
 deb = ipdb.set_trace
 opj = os.path.join
 
+# MRI analysis imports
+# --------------------
+from model.prfpy.voxels import brain_voxel_indices, balanced_shards
+
 # Settings
 # --------
 # Inputs
 subject = sys.argv[1]
-task = sys.argv[2]
-preproc = sys.argv[3]
+tasks = sys.argv[2].split(',')
+preprocs = sys.argv[3].split(',')
+datasets = [(task, preproc) for task in tasks for preproc in preprocs]
+job_name = "{tasks}_{preprocs}".format(tasks = '+'.join(tasks), preprocs = '+'.join(preprocs))
+if len(sys.argv) > 4:
+    n_shards = int(sys.argv[4])
+else:
+    n_shards = None
 
 # Analysis parameters
 with open('settings.json') as f:
@@ -62,6 +77,7 @@ with open('settings.json') as f:
 base_dir = analysis_info['base_dir']
 sub_command = 'sbatch '
 fit_per_hour = 6000.0
+job_hours = 2.0
 nb_procs = 32
 memory_val = 48
 proj_name = 'b161'
@@ -74,40 +90,85 @@ try:
     os.makedirs(opj(base_dir, 'pp_data', subject, 'gauss', 'log_outputs'))
 except:
     pass
+shard_dir = opj(base_dir, 'pp_data', subject, 'gauss', 'shards')
+os.makedirs(shard_dir, exist_ok=True)
 
 # Determine data to analyse
-data_file = "{base_dir}/pp_data/{sub}/func/{sub}_task-{task}_{preproc}_avg.nii.gz".format(
-                        base_dir = base_dir, sub = subject, preproc = preproc, task = task)
-
-img_data = nb.load(data_file)
-data = img_data.get_fdata()
-data_var = np.var(data,axis=3)
-mask = data_var!=0.0
-slices = np.arange(mask.shape[2])[mask.sum(axis=(0,1))>0]
-
-for slice_nb in slices:
-
-    num_vox = mask[:, :, slice_nb].sum()
-    job_dur = str(datetime.timedelta(hours = np.ceil(num_vox/fit_per_hour)))
-
-    # Define output file
-    opfn = "{base_dir}/pp_data/{subject}/gauss/fit/{subject}_task-{task}_{preproc}_avg_est_z_{slice_nb}.nii.gz".format(
-                                base_dir = base_dir,
-                                subject = subject,
-                                task = task,                        
-                                preproc = preproc,                                
-                                slice_nb = slice_nb)
+voxel_indices = []
+for task, preproc in datasets:
+    data_file = "{base_dir}/pp_data/{sub}/func/{sub}_task-{task}_{preproc}_avg.nii.gz".format(
+                            base_dir = base_dir, sub = subject, preproc = preproc, task = task)
+
+    img_data = nb.load(data_file)
+
+    # brain voxels, read one slice at a time
+    voxel_indices.append(brain_voxel_indices(img_data))
+
+# brain voxels of any dataset, ordered by slice
+voxel_indices = np.unique(np.concatenate(voxel_indices), axis=0)
+voxel_indices = voxel_indices[np.lexsort(voxel_indices.T)]
+num_vox = voxel_indices.shape[0]
+
+# all voxels are estimated to cost the same (grid and iterative fit) per dataset,
+# so that shards have equal numbers of voxels
+voxel_costs = np.full(num_vox, len(datasets))
+if n_shards is None:
+    n_shards = int(np.ceil(voxel_costs.sum()/(fit_per_hour*job_hours)))
+shards = balanced_shards(voxel_costs, n_shards)
+
+print("{num_vox} brain mask voxels in {n_shards} shards".format(num_vox = num_vox, n_shards = n_shards))
+
+# remove voxel index files of shards of a previous, finer split
+for task, preproc in datasets:
+    for voxel_file in glob.glob("{shard_dir}/{subject}_task-{task}_{preproc}_shard_*_voxels.npy".format(
+                                    shard_dir = shard_dir, subject = subject, task = task, preproc = preproc)):
+        if int(voxel_file.split('_shard_')[-1].split('_')[0]) >= n_shards:
+            os.remove(voxel_file)
+
+for shard_nb, shard in enumerate(shards):
+
+    job_dur = str(datetime.timedelta(hours = np.ceil(voxel_costs[shard].sum()/fit_per_hour)))
+
+    # Define voxel index and output files, per dataset
+    voxel_files, opfns = [], []
+    for task, preproc in datasets:
+        voxel_files.append("{shard_dir}/{subject}_task-{task}_{preproc}_shard_{shard_nb}_voxels.npy".format(
+                                    shard_dir = shard_dir,
+                                    subject = subject,
+                                    task = task,
+                                    preproc = preproc,
+                                    shard_nb = shard_nb))
+        opfns.append("{base_dir}/pp_data/{subject}/gauss/fit/{subject}_task-{task}_{preproc}_avg_est_shard_{shard_nb}.npy".format(
+                                    base_dir = base_dir,
+                                    subject = subject,
+                                    task = task,                        
+                                    preproc = preproc,                                
+                                    shard_nb = shard_nb))
     log_dir = opj(base_dir,'pp_data',subject,'gauss','log_outputs')
 
-    if os.path.isfile(opfn):
-        if os.path.getsize(opfn) != 0:
-            print("output file {opfn} already exists and is non-empty. aborting analysis of slice {slice_nb}".format(
-                                opfn = opfn,
-                                slice_nb = slice_nb))
-            continue
-
-        # create job shell
-
+    # outputs of a previous split are only kept if the shard is unchanged
+    shard_unchanged, shard_done = [], True
+    for voxel_file, opfn in zip(voxel_files, opfns):
+        shard_unchanged.append(os.path.isfile(voxel_file) and np.array_equal(np.load(voxel_file), voxel_indices[shard]))
+        if not (shard_unchanged[-1] and os.path.isfile(opfn) and os.path.getsize(opfn) != 0):
+            shard_done = False
+    if shard_done:
+        print("output files {opfns} already exist and are non-empty. aborting analysis of shard {shard_nb}".format(
+                            opfns = ', '.join(opfns),
+                            shard_nb = shard_nb))
+        continue
+
+    # the voxel index file of each dataset is used to merge its estimates (see post_fit.py),
+    # so outputs and iterative fit checkpoints of a previous split of the shard are removed.
+    # checkpoints of an unchanged shard are kept, for the job to resume the iterative fit.
+    for voxel_file, opfn, unchanged in zip(voxel_files, opfns, shard_unchanged):
+        if not unchanged:
+            np.save(voxel_file, voxel_indices[shard])
+            for old_file in [opfn, opfn.replace('.npy', '_checkpoint.dat')]:
+                if os.path.isfile(old_file):
+                    os.remove(old_file)
+
+    # create job shell
     slurm_cmd = """\
 #!/bin/bash
 #SBATCH -p skylake
@@ -116,33 +177,31 @@ for slice_nb in slices:
 #SBATCH --mem={memory_val}gb
 #SBATCH --cpus-per-task={nb_procs}
 #SBATCH --time={job_dur}
-#SBATCH -e {log_dir}/{subject}_{task}_{preproc}_fit_slice_{slice_nb}_%N_%j_%a.err
-#SBATCH -o {log_dir}/{subject}_{task}_{preproc}_fit_slice_{slice_nb}_%N_%j_%a.out
-#SBATCH -J {subject}_{task}_{preproc}_fit_slice_{slice_nb}\n\n""".format(proj_name = proj_name,
+#SBATCH -e {log_dir}/{subject}_{job_name}_fit_shard_{shard_nb}_%N_%j_%a.err
+#SBATCH -o {log_dir}/{subject}_{job_name}_fit_shard_{shard_nb}_%N_%j_%a.out
+#SBATCH -J {subject}_{job_name}_fit_shard_{shard_nb}\n\n""".format(proj_name = proj_name,
                                             nb_procs = nb_procs,
                                             memory_val = memory_val,
                                             log_dir = log_dir,
                                             job_dur = job_dur,
                                             subject = subject,
-                                            preproc = preproc,
-                                            task = task,
-                                            slice_nb = slice_nb)
+                                            job_name = job_name,
+                                            shard_nb = shard_nb)
 
     # define fit cmd
-    fit_cmd = "python fit/prf_fit.py {subject} {task} {preproc} {slice_nb} {opfn}".format(
+    fit_cmd = "python fit/prf_fit.py {subject} {tasks} {preprocs} {voxel_file} {opfns}".format(
                 subject = subject,
-                task = task,
-                preproc = preproc,
-                slice_nb = slice_nb,
-                opfn = opfn)
+                tasks = ','.join(tasks),
+                preprocs = ','.join(preprocs),
+                voxel_file = voxel_files[0],
+                opfns = ','.join(opfns))
     
     # create sh folder and file
-    sh_dir = "{base_dir}/pp_data/{subject}/gauss/jobs/{subject}_{task}_{preproc}_fit_slice_{slice_nb}.sh".format(
+    sh_dir = "{base_dir}/pp_data/{subject}/gauss/jobs/{subject}_{job_name}_fit_shard_{shard_nb}.sh".format(
                 base_dir = base_dir,
                 subject = subject,
-                task = task,
-                preproc = preproc,
-                slice_nb = slice_nb)
+                job_name = job_name,
+                shard_nb = shard_nb)
 
     try:
         os.makedirs(opj(base_dir,'pp_data',subject,'gauss','fit'))
@@ -158,4 +217,3 @@ for slice_nb in slices:
     # Submit jobs
     print("Submitting {sh_dir} to queue".format(sh_dir = sh_dir))
     os.system("{sub_command} {sh_dir}".format(sub_command = sub_command, sh_dir = sh_dir))
-    
\ No newline at end of file
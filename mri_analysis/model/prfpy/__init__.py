@@ -16,6 +16,7 @@ from .stimulus import PRFStimulus2D, PRFStimulus1D
 
 from .model import Iso2DGaussianModel
 from .fit import Iso2DGaussianFitter
+from .voxels import VoxelSource
 
 # keras is a full dependency due to this pilot project.
 # scaling that back - can be imported specifically.
@@ -0,0 +1,140 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+
+def hash_items(*items):
+    """hash_items
+
+    content hash of a sequence of arrays, scalars, strings, lists and dicts,
+    used as the key of cached arrays
+
+    Parameters
+    ----------
+    *items : numpy.ndarray, list, tuple, dict or other
+        items to hash. Arrays are hashed by dtype, shape and contents,
+        dicts by their sorted items, anything else by its repr.
+
+    Returns
+    -------
+    str
+        hexadecimal digest
+    """
+    h = hashlib.sha1()
+
+    def update(item):
+        if isinstance(item, np.ndarray):
+            h.update(str((item.dtype.str, item.shape)).encode())
+            h.update(np.ascontiguousarray(item).tobytes())
+        elif isinstance(item, dict):
+            h.update(b'dict')
+            for key in sorted(item, key=repr):
+                update(key)
+                update(item[key])
+        elif isinstance(item, (list, tuple)):
+            h.update(type(item).__name__.encode())
+            for sub_item in item:
+                update(sub_item)
+        else:
+            h.update(repr(item).encode())
+
+    for item in items:
+        update(item)
+
+    return h.hexdigest()
+
+
+def cached_array_path(cache_dir, key, name):
+    """cached_array_path
+
+    path of the .npy file holding array `name` for `key`
+
+    Parameters
+    ----------
+    cache_dir : str
+        cache folder
+    key : str
+        content hash, see hash_items
+    name : str
+        name of the array (e.g. 'predictions')
+
+    Returns
+    -------
+    str
+        path to the .npy file
+    """
+    return os.path.join(cache_dir, "{key}_{name}.npy".format(key=key, name=name))
+
+
+def load_cached_array(cache_dir, key, name, mmap_mode='r'):
+    """load_cached_array
+
+    opens a cached array, memory-mapped by default so that all processes
+    on a node share the same pages of the OS page cache
+
+    Parameters
+    ----------
+    cache_dir : str
+        cache folder
+    key : str
+        content hash, see hash_items
+    name : str
+        name of the array
+    mmap_mode : str or None, optional
+        passed to numpy.load. The default is 'r' (read-only memory map).
+
+    Returns
+    -------
+    numpy.ndarray or None
+        the cached array, or None if it is not in the cache
+    """
+    path = cached_array_path(cache_dir, key, name)
+    if not os.path.isfile(path):
+        return None
+
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def save_cached_array(cache_dir, key, name, array):
+    """save_cached_array
+
+    writes an array to the cache. The array is first written to a temporary
+    file in cache_dir, which is then atomically renamed, so that concurrent
+    jobs writing the same key never leave (or read) a partial file.
+
+    Parameters
+    ----------
+    cache_dir : str
+        cache folder, created if needed
+    key : str
+        content hash, see hash_items
+    name : str
+        name of the array
+    array : numpy.ndarray
+        array to cache
+
+    Returns
+    -------
+    str
+        path to the cached .npy file
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cached_array_path(cache_dir, key, name)
+
+    tmp_file = tempfile.NamedTemporaryFile(dir=cache_dir, prefix='.'+os.path.basename(path),
+                                           suffix='.tmp', delete=False)
+    try:
+        with tmp_file:
+            np.save(tmp_file, array)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        # temporary files are private by default
+        os.chmod(tmp_file.name, 0o644)
+        os.replace(tmp_file.name, path)
+    except BaseException:
+        if os.path.exists(tmp_file.name):
+            os.remove(tmp_file.name)
+        raise
+
+    return path
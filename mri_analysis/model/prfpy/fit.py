@@ -1,8 +1,14 @@
+import os
+import time
+import warnings
 import numpy as np
-from scipy.optimize import fmin_powell, minimize, basinhopping, shgo, dual_annealing
+from scipy.optimize import fmin_powell, minimize, basinhopping, shgo, dual_annealing, differential_evolution
 from scipy.stats import pearsonr
 from copy import deepcopy
+from collections import OrderedDict
 from joblib import Parallel, delayed
+from .cache import load_cached_array, save_cached_array
+from .voxels import VoxelSource, allocate_output
 
 
 def error_function(
@@ -32,8 +38,372 @@ def error_function(
     #return 1-np.nan_to_num(pearsonr(data,np.nan_to_num(objective_function(*list(parameters), **args)[0]))[0])
 
 
+def error_function_and_gradient(
+        parameters,
+        args,
+        data,
+        objective_function):
+    """
+    Parameters
+    ----------
+    parameters : list or ndarray
+        A tuple of values representing a model setting.
+    args : dictionary
+        Extra arguments to `objective_function` beyond those in `parameters`.
+    data : ndarray
+       The actual, measured time-series against which the model is fit.
+    objective_function : callable
+        The objective function that takes `parameters` and `args` and
+        produces a model time-series and its derivatives with respect to
+        `parameters` (e.g. Model.return_prediction_and_jacobian).
+
+    Returns
+    -------
+    error : float
+        The residual sum of squared errors between the prediction and data.
+    gradient : ndarray
+        The derivatives of the error with respect to `parameters`.
+    """
+    prediction, jacobian = objective_function(*list(parameters), **args)
+    residuals = data - prediction[0]
+
+    return np.nan_to_num(np.sum(residuals**2), nan=1), \
+        np.nan_to_num(-2 * jacobian[0] @ residuals)
+
+
+def population_error_function(
+        population,
+        args,
+        data,
+        objective_function,
+        chunk_size=256):
+    """
+    Vectorized error_function, for many candidate parameters at once: the
+    predictions of chunk_size candidates are computed with a single call
+    to `objective_function` (e.g. one matrix product with the design matrix
+    for Iso2DGaussianModel.return_prediction).
+
+    Parameters
+    ----------
+    population : ndarray
+        candidate parameters, [params], [candidates, params], or
+        [units, candidates, params] with one row of `data` per unit.
+    args : dictionary
+        Extra arguments to `objective_function` beyond those in `population`.
+    data : ndarray
+       The actual, measured time-series against which the model is fit,
+       [time], or [units, time] for a 3D population.
+    objective_function : callable
+        The objective function that takes the parameters of many candidates
+        (as arrays) and `args` and produces their model time-series.
+    chunk_size : int, optional
+        number of candidates predicted at a time. The default is 256.
+
+    Returns
+    -------
+    errors : float or ndarray
+        The residual sum of squared errors of each candidate, in the shape
+        of `population` without its last dimension.
+    """
+    population = np.asarray(population, dtype='float64')
+    candidates = population.reshape(-1, population.shape[-1])
+    if population.ndim == 3:
+        # data row of each candidate
+        data_rows = np.repeat(np.arange(population.shape[0]), population.shape[1])
+
+    errors = np.zeros(candidates.shape[0])
+    for start in range(0, candidates.shape[0], chunk_size):
+        stop = min(start+chunk_size, candidates.shape[0])
+        predictions = objective_function(*list(candidates[start:stop].T), **args)
+        candidate_data = data if population.ndim < 3 else data[data_rows[start:stop]]
+        errors[start:stop] = np.sum((candidate_data - predictions)**2, axis=-1)
+
+    errors = np.nan_to_num(errors, nan=1).reshape(population.shape[:-1])
+    return errors if population.ndim > 1 else errors[()]
+
+
+optimizers = {}
+
+
+def register_optimizer(name, supports_bounds=True, supports_constraints=False,
+                       requires_bounds=False, uses_gradient=False, population=False,
+                       uses_start_params=True):
+    """register_optimizer
+
+    decorator adding a minimization backend to the optimizers registry,
+    used by iterative_search. A backend is called as
+    backend(objective, start_params, objective_args, jac, bounds,
+    constraints, xtol, ftol, verbose), where objective(params, *objective_args)
+    returns the error (and, if jac is True, its gradient), and returns the
+    parameters, the error and the number of iterations.
+
+    Parameters
+    ----------
+    name : str
+        name of the backend, as given to iterative_search
+    supports_bounds : bool, optional
+        whether the backend enforces bounds. The default is True.
+    supports_constraints : bool, optional
+        whether the backend enforces scipy.optimize constraints.
+        The default is False.
+    requires_bounds : bool, optional
+        whether the backend needs (finite) bounds. The default is False.
+    uses_gradient : bool, optional
+        whether the backend uses the analytic gradient of the error, when
+        the model provides it. The default is False.
+    population : bool, optional
+        whether the backend evaluates populations of candidates, with
+        population_error_function as objective. The default is False.
+    uses_start_params : bool, optional
+        whether the backend starts from start_params. If not,
+        iterative_search also evaluates start_params, and keeps them if
+        the backend finds a higher error. The default is True.
+    """
+    def register(backend):
+        optimizers[name] = dict(minimize=backend,
+                                supports_bounds=supports_bounds,
+                                supports_constraints=supports_constraints,
+                                requires_bounds=requires_bounds,
+                                uses_gradient=uses_gradient,
+                                population=population,
+                                uses_start_params=uses_start_params)
+        return backend
+
+    return register
+
+
+def default_optimizer(bounds=None, constraints=None):
+    """default_optimizer
+
+    backend used by iterative_search if none is given: L-BFGS-B for bounded
+    minimization, trust-constr if there are also constraints, and Powell
+    for unbounded minimization
+    """
+    if bounds is None:
+        return 'Powell'
+    elif constraints is None:
+        return 'L-BFGS-B'
+    else:
+        return 'trust-constr'
+
+
+@register_optimizer('L-BFGS-B', uses_gradient=True)
+def lbfgsb_minimize(objective, start_params, objective_args, jac, bounds, constraints, xtol, ftol, verbose):
+    output = minimize(objective, start_params, bounds=bounds,
+                      args=objective_args,
+                      jac=jac,
+                      method='L-BFGS-B',
+                      # default max line searches is 20
+                      options=dict(ftol=ftol,
+                                   maxls=40,
+                                   disp=verbose))
+    return output['x'], output['fun'], output['nit']
+
+
+@register_optimizer('trust-constr', supports_constraints=True, uses_gradient=True)
+def trust_constr_minimize(objective, start_params, objective_args, jac, bounds, constraints, xtol, ftol, verbose):
+    output = minimize(objective, start_params, bounds=bounds,
+                      args=objective_args,
+                      jac=jac,
+                      method='trust-constr',
+                      constraints=constraints,
+                      tol=ftol,
+                      options=dict(xtol=xtol,
+                                   disp=verbose))
+    return output['x'], output['fun'], output['nit']
+
+
+@register_optimizer('Powell', supports_bounds=False)
+def powell_minimize(objective, start_params, objective_args, jac, bounds, constraints, xtol, ftol, verbose):
+    output = fmin_powell(objective, start_params,
+                         xtol=xtol,
+                         ftol=ftol,
+                         args=objective_args,
+                         full_output=True,
+                         disp=verbose)
+    return output[0], output[1], output[3]
+
+
+@register_optimizer('basinhopping', uses_gradient=True)
+def basinhopping_minimize(objective, start_params, objective_args, jac, bounds, constraints, xtol, ftol, verbose):
+    data = objective_args[1]
+    output = basinhopping(objective, start_params,
+                          niter=10, T=0.01*(len(data) * data.var()), stepsize=2,
+                          minimizer_kwargs=dict(method='L-BFGS-B',
+                                                bounds=bounds,
+                                                jac=jac,
+                                                options=dict(ftol=ftol, maxls=60),
+                                                args=objective_args),
+                          disp=verbose)
+    return output['x'], output['fun'], output['nit']
+
+
+@register_optimizer('shgo', requires_bounds=True, uses_start_params=False)
+def shgo_minimize(objective, start_params, objective_args, jac, bounds, constraints, xtol, ftol, verbose):
+    output = shgo(objective, bounds=bounds,
+                  args=objective_args,
+                  options=dict(disp=verbose),
+                  minimizer_kwargs=dict(method='L-BFGS-B',
+                                        bounds=bounds,
+                                        args=objective_args))
+    return output['x'], output['fun'], output['nit']
+
+
+@register_optimizer('dual_annealing', requires_bounds=True)
+def dual_annealing_minimize(objective, start_params, objective_args, jac, bounds, constraints, xtol, ftol, verbose):
+    output = dual_annealing(objective, bounds=bounds,
+                            args=objective_args,
+                            x0=start_params)
+    return output['x'], output['fun'], output['nit']
+
+
+@register_optimizer('differential_evolution', requires_bounds=True, population=True)
+def differential_evolution_minimize(objective, start_params, objective_args, jac, bounds, constraints, xtol, ftol, verbose):
+    # each generation is evaluated with one call of the population objective,
+    # which scipy passes as [params, candidates]. x0 must be within the bounds
+    lower, upper = np.array(bounds, dtype='float64').T
+    output = differential_evolution(lambda population, *args: objective(population.T, *args),
+                                    bounds=bounds,
+                                    args=objective_args,
+                                    x0=np.clip(start_params, lower, upper),
+                                    tol=ftol,
+                                    polish=False,
+                                    updating='deferred',
+                                    vectorized=True,
+                                    seed=0,
+                                    disp=verbose)
+    return output['x'], output['fun'], output['nit']
+
+
+@register_optimizer('multistart', requires_bounds=True, population=True)
+def multistart_minimize(objective, start_params, objective_args, jac, bounds, constraints, xtol, ftol, verbose,
+                        n_starts=8, max_generations=1000):
+    # compass search from start_params and n_starts-1 random starts within the
+    # bounds: each generation evaluates the 2 steps along each parameter of
+    # every start at once, moves each start to its best step if it improves
+    # the error by more than ftol (relative), and otherwise halves its steps.
+    # Stops when all steps are below xtol times the bounds range.
+    lower, upper = np.array(bounds, dtype='float64').T
+    n_params = lower.shape[0]
+    rng = np.random.default_rng(0)
+    starts = np.r_[np.clip(np.array(start_params, dtype='float64')[np.newaxis], lower, upper),
+                   rng.uniform(lower, upper, (n_starts-1, n_params))]
+    errors = objective(starts, *objective_args)
+    steps = np.tile(0.25 * (upper - lower), (n_starts, 1))
+    directions = np.r_[np.eye(n_params), -np.eye(n_params)]
+
+    for generation in range(max_generations):
+        if np.all(steps < xtol * (upper - lower)):
+            break
+        # [starts, 2*params, params]
+        candidates = np.clip(starts[:, np.newaxis] + directions[np.newaxis] * np.tile(steps, 2)[:, :, np.newaxis],
+                             lower, upper)
+        candidate_errors = objective(candidates.reshape(-1, n_params), *objective_args).reshape(n_starts, -1)
+        best = np.argmin(candidate_errors, axis=1)
+        best_errors = candidate_errors[np.arange(n_starts), best]
+
+        improved = best_errors < errors - ftol * np.abs(errors)
+        starts[improved] = candidates[improved, best[improved]]
+        errors[improved] = best_errors[improved]
+        steps[~improved] /= 2
+
+    best_start = np.argmin(errors)
+    return starts[best_start], errors[best_start], generation
+
+
+class OptimizerBudgetExceeded(Exception):
+    """raised by BudgetedObjective when the budget of a minimization is spent"""
+
+
+class BudgetedObjective(object):
+    """BudgetedObjective
+
+    wraps the objective of a minimization, counting its evaluations and
+    keeping the best parameters evaluated. A population of candidates,
+    [candidates, params], counts as one evaluation per candidate. Once
+    max_evaluations evaluations or max_seconds seconds are spent, it raises
+    OptimizerBudgetExceeded, after which the best parameters are used.
+
+    """
+
+    def __init__(self, objective, max_evaluations=None, max_seconds=None):
+        self.objective = objective
+        self.max_evaluations = max_evaluations
+        self.max_seconds = max_seconds
+        self.n_evaluations = 0
+        self.best_params, self.best_error = None, np.inf
+        self.start_time = time.perf_counter()
+
+    def __call__(self, parameters, *args):
+        if (self.max_evaluations is not None and self.n_evaluations >= self.max_evaluations) or \
+                (self.max_seconds is not None and time.perf_counter() - self.start_time >= self.max_seconds):
+            raise OptimizerBudgetExceeded
+
+        value = self.objective(parameters, *args)
+
+        if np.ndim(parameters) == 2:
+            self.n_evaluations += len(parameters)
+            best = np.argmin(value)
+            error, parameters = value[best], parameters[best]
+        else:
+            self.n_evaluations += 1
+            error = value[0] if isinstance(value, tuple) else value
+        if error < self.best_error:
+            self.best_params, self.best_error = np.array(parameters, dtype='float64'), error
+
+        return value
+
+
+class PredictionCache(object):
+    """PredictionCache
+
+    bounded least-recently-used cache of the predictions of one unit's
+    minimization, wrapping a model's `return_prediction` (or
+    `return_prediction_and_jacobian`), so that parameters revisited by
+    line searches are not predicted again. Parameters are keyed after
+    rounding to multiples of tolerance, so that parameters closer than
+    tolerance may share a prediction; tolerance 0 only matches identical
+    parameters. Other arguments are not part of the key, as they are the
+    same throughout a minimization.
+
+    """
+
+    def __init__(self, prediction_function, max_size=128, tolerance=0.0):
+        self.prediction_function = prediction_function
+        self.max_size = max_size
+        self.tolerance = tolerance
+        self.predictions = OrderedDict()
+        self.hits, self.lookups = 0, 0
+
+    def __call__(self, *parameters, **args):
+        parameters = np.asarray(parameters, dtype='float64')
+        if self.tolerance > 0:
+            key = np.round(parameters / self.tolerance).tobytes()
+        else:
+            key = parameters.tobytes()
+
+        self.lookups += 1
+        if key in self.predictions:
+            self.hits += 1
+            self.predictions.move_to_end(key)
+            return self.predictions[key]
+
+        prediction = self.prediction_function(*list(parameters), **args)
+        self.predictions[key] = prediction
+        if len(self.predictions) > self.max_size:
+            self.predictions.popitem(last=False)
+        return prediction
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else np.nan
+
+
 def iterative_search(model, data, start_params, args, xtol, ftol, verbose=True,
-                     bounds=None, constraints=None, **kwargs):
+                     bounds=None, constraints=None, analytic_gradient=True,
+                     optimizer=None, max_evaluations=None, max_seconds=None,
+                     prediction_cache_size=0, prediction_cache_tolerance=0.0,
+                     return_stats=False, **kwargs):
     """iterative_search
 
     Generic minimization function called by iterative_fit.
@@ -64,6 +434,29 @@ def iterative_search(model, data, start_params, args, xtol, ftol, verbose=True,
         length as start_params. The default is None.
     constrains: list of  scipy.optimize.LinearConstraints and/or
         scipy.optimize.NonLinearConstraints
+    analytic_gradient : bool, optional
+        whether backends using gradients use the analytic gradient of the
+        error, from the model's `return_prediction_and_jacobian` method,
+        instead of finite differences. Ignored for models without this
+        method (set to None). The default is True.
+    optimizer : str, optional
+        name of the backend in the optimizers registry (see
+        register_optimizer). The default is None, see default_optimizer.
+    max_evaluations : int, optional
+        maximum number of evaluations of the error (see BudgetedObjective).
+        The default is None, no maximum.
+    max_seconds : float, optional
+        maximum duration of the minimization, in seconds. The default is
+        None, no maximum.
+    prediction_cache_size : int, optional
+        number of predictions kept in a PredictionCache for this
+        minimization, for backends that evaluate one parameter set at a
+        time. The default is 0, no cache.
+    prediction_cache_tolerance : float, optional
+        parameters closer than this share cached predictions (see
+        PredictionCache). The default is 0.0, identical parameters only.
+    return_stats : bool, optional
+        whether to also return the minimization statistics. The default is False.
 
     **kwargs : TYPE
         DESCRIPTION.
@@ -71,83 +464,967 @@ def iterative_search(model, data, start_params, args, xtol, ftol, verbose=True,
     Raises
     ------
     AssertionError
-        Raised if parameters and bounds do not have the same length.
+        Raised if parameters and bounds do not have the same length, or if
+        the backend does not support the bounds or constraints.
 
     Returns
     -------
-    2-tuple
-        first element: parameter values,
-        second element: rsq value
+    numpy.ndarray
+        parameter values, followed by the rsq value
+    numpy.ndarray, if return_stats
+        number of evaluations, number of iterations (nan if the budget was
+        spent), duration in seconds, whether the budget was spent, and the
+        number of prediction cache hits and lookups
     """
+    if optimizer is None:
+        optimizer = default_optimizer(bounds, constraints)
+    assert optimizer in optimizers, "unknown optimizer " + str(optimizer)
+    backend = optimizers[optimizer]
+
     if bounds is not None:
         assert len(bounds) == len(
             start_params), "Unequal bounds and parameters"
+        assert backend['supports_bounds'], optimizer + " does not support bounds"
+    else:
+        assert not backend['requires_bounds'], optimizer + " requires bounds"
+    if constraints:
+        assert backend['supports_constraints'], optimizer + " does not support constraints"
+
+    if backend['population']:
+        objective = population_error_function
+        objective_args = (args, data, model.return_prediction)
+        jac = None
+    elif backend['uses_gradient'] and analytic_gradient and \
+            getattr(model, 'return_prediction_and_jacobian', None) is not None:
+        objective = error_function_and_gradient
+        objective_args = (args, data, model.return_prediction_and_jacobian)
+        jac = True
+    else:
+        objective = error_function
+        objective_args = (args, data, model.return_prediction)
+        jac = None
+
+    if prediction_cache_size > 0 and not backend['population']:
+        prediction_cache = PredictionCache(objective_args[2], max_size=prediction_cache_size,
+                                           tolerance=prediction_cache_tolerance)
+        objective_args = objective_args[:2] + (prediction_cache,)
+    else:
+        prediction_cache = None
+
+    if verbose:
+        print('Performing minimization (' + optimizer + ').')
+
+    budgeted_objective = BudgetedObjective(objective, max_evaluations=max_evaluations,
+                                           max_seconds=max_seconds)
+    try:
+        if not backend['uses_start_params']:
+            # start params (within the bounds), kept if the backend ends higher
+            guard_params = np.array(start_params, dtype='float64')
+            if bounds is not None:
+                lower, upper = np.array(bounds, dtype='float64').T
+                guard_params = np.clip(guard_params, np.nan_to_num(lower, nan=-np.inf),
+                                       np.nan_to_num(upper, nan=np.inf))
+            guard_error = budgeted_objective(guard_params[np.newaxis] if backend['population'] else guard_params,
+                                             *objective_args)
+            guard_error = guard_error[0] if isinstance(guard_error, tuple) or backend['population'] else guard_error
+
+        params, error, n_iterations = backend['minimize'](
+            budgeted_objective, start_params, objective_args, jac, bounds, constraints, xtol, ftol, verbose)
+        budget_spent = False
+
+        if not backend['uses_start_params'] and guard_error < error:
+            params, error = guard_params, guard_error
+    except OptimizerBudgetExceeded:
+        params, error, n_iterations = budgeted_objective.best_params, budgeted_objective.best_error, np.nan
+        budget_spent = True
+        if params is None:
+            params = np.array(start_params, dtype='float64')
+
+    result = np.nan_to_num(np.r_[params, 1 - error/(len(data) * data.var())])
+
+    if return_stats:
+        return result, np.array([budgeted_objective.n_evaluations, n_iterations,
+                                 time.perf_counter() - budgeted_objective.start_time, budget_spent,
+                                 getattr(prediction_cache, 'hits', 0),
+                                 getattr(prediction_cache, 'lookups', 0)])
+    return result
+
+
+def summarize_optimizer_stats(stats, rsq, wall_seconds):
+    """summarize_optimizer_stats
+
+    aggregates the minimization statistics of the units of a fit (see
+    iterative_search), to compare optimizer backends on the same units:
+    the fastest backend reaching the same rsq.
 
+    Parameters
+    ----------
+    stats : numpy.ndarray, [units, 6]
+        evaluations, iterations, seconds, budget spent, prediction cache
+        hits and lookups of each unit (nan for units fit otherwise, e.g.
+        by batched_lm)
+    rsq : numpy.ndarray
+        rsq of each unit
+    wall_seconds : float
+        duration of the whole fit, in seconds
 
-        if constraints is None:
-            if verbose:
-                print('Performing bounded, unconstrained minimization (L-BFGS-B).')
+    Returns
+    -------
+    dict
+        n_units, n_search_units (units with statistics), total and median
+        evaluations, median iterations, total (summed over units) and median
+        seconds, number of units whose budget was spent, prediction cache
+        hits and hit rate, mean and median rsq, and wall_seconds
+    """
+    stats = np.asarray(stats, dtype='float64').reshape(-1, 6)
+    # units fit by iterative_search
+    stats = stats[~np.isnan(stats[:, 0])]
+    with warnings.catch_warnings():
+        # statistics of no units are nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return dict(n_units=len(rsq),
+                    n_search_units=stats.shape[0],
+                    total_evaluations=float(stats[:, 0].sum()) if stats.shape[0] else np.nan,
+                    median_evaluations=float(np.median(stats[:, 0])),
+                    median_iterations=float(np.nanmedian(stats[:, 1])),
+                    total_seconds=float(stats[:, 2].sum()) if stats.shape[0] else np.nan,
+                    median_seconds=float(np.median(stats[:, 2])),
+                    budget_spent=int(stats[:, 3].sum()),
+                    prediction_cache_hits=int(stats[:, 4].sum()),
+                    prediction_cache_hit_rate=float(stats[:, 4].sum() / stats[:, 5].sum())
+                    if stats[:, 5].sum() else np.nan,
+                    mean_rsq=float(np.mean(rsq)),
+                    median_rsq=float(np.median(rsq)),
+                    wall_seconds=wall_seconds)
+
+
+def unit_neighbours(coordinates):
+    """unit_neighbours
+
+    indices of the units adjacent to each unit (26-connectivity), e.g. of
+    voxels given by their x, y and z indices
 
-            output = minimize(error_function, start_params, bounds=bounds,
-                              args=(
-                                  args, data, model.return_prediction),
-                               method='L-BFGS-B',
-                              # default max line searches is 20
-                              options=dict(ftol=ftol,
-                                           maxls=40,
-                                           disp=verbose))
-        else:
-            if verbose:
-                print('Performing bounded, constrained minimization (trust-constr).')
+    Parameters
+    ----------
+    coordinates : numpy.ndarray, [units, 3]
+        integer coordinates of the units
 
-            output = minimize(error_function, start_params, bounds=bounds,
-                              args=(args, data,
-                                    model.return_prediction),
-                              method='trust-constr',
-                              constraints=constraints,
-                              tol=ftol,
-                              options=dict(xtol=xtol,
-                                           disp=verbose))
+    Returns
+    -------
+    numpy.ndarray, [units, 26]
+        unit index of each neighbour, -1 where there is no unit
+    """
+    coordinates = np.asarray(coordinates, dtype=int)
+    # volume of unit indices, padded so that neighbours of border units are -1
+    positions = coordinates - coordinates.min(axis=0) + 1
+    volume = np.full(tuple(positions.max(axis=0) + 2), -1, dtype=int)
+    volume[tuple(positions.T)] = np.arange(coordinates.shape[0])
+
+    offsets = np.argwhere(np.ones((3, 3, 3))) - 1
+    offsets = offsets[np.any(offsets != 0, axis=1)]
+    return volume[tuple(np.moveaxis(positions[:, np.newaxis] + offsets[np.newaxis], -1, 0))]
+
+
+def warm_start_params(model, data, start_params, params, neighbours, converged, args={}):
+    """warm_start_params
+
+    starting parameters of units, as the best (lowest error, see
+    population_error_function) of their own starting parameters and the
+    fitted parameters of their converged neighbours
+
+    Parameters
+    ----------
+    model : Model
+        model whose `return_prediction` gives the predictions
+    data : numpy.ndarray, [units, time]
+        data of the units
+    start_params : numpy.ndarray, [units, params]
+        starting parameters of the units (e.g. from the grid fit)
+    params : numpy.ndarray, [all units, params]
+        fitted parameters of all units
+    neighbours : numpy.ndarray, [units, neighbours]
+        indices (in params) of the neighbours of the units, -1 for none
+        (see unit_neighbours)
+    converged : numpy.ndarray, [all units]
+        whether each unit's params are fitted
+    args : dictionary, optional
+        further arguments of `return_prediction`. The default is {}.
 
+    Returns
+    -------
+    numpy.ndarray, [units, params]
+        starting parameters
+    numpy.ndarray, [units]
+        whether the parameters of a neighbour were chosen
+    """
+    start_params = np.array(start_params, dtype='float64')
+    start_errors = population_error_function(start_params[:, np.newaxis], args, data, model.return_prediction)[:, 0]
 
-            # output = basinhopping(error_function, start_params,
-            #                       niter=10, T=0.01*(len(data) * data.var()), stepsize=2,
-            #                       minimizer_kwargs=dict(method='L-BFGS-B',
-            #                                             bounds=bounds,
-            #                                             options=dict(maxls=60, disp=verbose),
-            #                                             args=(args, data, model.return_prediction)))
+    unit_rows, slots = np.nonzero((neighbours >= 0) & converged[neighbours])
+    neighbour_errors = np.full(neighbours.shape, np.inf)
+    if unit_rows.shape[0] > 0:
+        neighbour_errors[unit_rows, slots] = population_error_function(
+            params[neighbours[unit_rows, slots]][:, np.newaxis], args, data[unit_rows], model.return_prediction)[:, 0]
 
-            # output = shgo(error_function, bounds=bounds,
-            #               args=(args, data, model.return_prediction),
-            #                       options=dict(disp=verbose),
-            #                       minimizer_kwargs=dict(method='L-BFGS-B',
-            #                                             bounds=bounds,
-            #                                             args=(args, data, model.return_prediction)))
+    best_slots = np.argmin(neighbour_errors, axis=1)
+    warm_started = neighbour_errors[np.arange(neighbours.shape[0]), best_slots] < start_errors
+    start_params[warm_started] = params[neighbours[warm_started, best_slots[warm_started]]]
 
-            # output = dual_annealing(error_function, bounds=bounds,
-            #               args=(args, data, model.return_prediction),
-            #                       x0=start_params)
+    return start_params, warm_started
 
-        return np.nan_to_num(np.r_[output['x'], 1 -
-                     (output['fun'])/(len(data) * data.var())])
 
+def batched_levenberg_marquardt(model, data, start_params, args={}, bounds=None,
+                                xtol=1e-4, ftol=1e-3, max_iter=100):
+    """batched_levenberg_marquardt
+
+    Levenberg-Marquardt minimization of the residual sum of squares of many
+    units at once. Residuals, jacobians (from the model's
+    `return_prediction_and_jacobian` method) and the normal equations are
+    stacked arrays over units, each unit has its own damping, and units
+    are dropped from the computation as they converge.
+    Bounds are enforced by clipping the parameters after each step.
+    Called by iterative_fit(engine='batched_lm').
+
+    Parameters
+    ----------
+    model : Model
+        Object that provides the predictions and their derivatives using its
+        `return_prediction_and_jacobian` method
+    data : 2D numpy.ndarray
+        the data to fit, first dimension units, second dimension time
+    start_params : 2D numpy.ndarray
+        initial values for the fit, first dimension units, second dimension parameters
+    args : dictionary, arguments to model.return_prediction_and_jacobian that
+        are not optimized
+    bounds : list of tuples, optional
+        Bounds for the parameters. The default is None.
+    xtol : float, optional
+        a unit converges when its parameter step is smaller than xtol
+        (relative to the parameters). The default is 1e-4.
+    ftol : float, optional
+        a unit converges when an accepted step decreases its error by less
+        than ftol (relative). The default is 1e-3.
+    max_iter : int, optional
+        maximum number of iterations. The default is 100.
+
+    Returns
+    -------
+    2D numpy.ndarray
+        parameter values and rsq, first dimension units
+    """
+    assert getattr(model, 'return_prediction_and_jacobian', None) is not None, \
+        "batched_lm requires a model with return_prediction_and_jacobian"
+
+    data = data.astype('float64')
+    params = np.array(start_params, dtype='float64')
+    n_units, n_params = params.shape
+
+    if bounds is not None:
+        assert len(bounds) == n_params, "Unequal bounds and parameters"
+        lower = np.array([-np.inf if b[0] is None else b[0] for b in bounds], dtype='float64')
+        upper = np.array([np.inf if b[1] is None else b[1] for b in bounds], dtype='float64')
     else:
-        if verbose:
-            print('Performing unbounded, unconstrained minimization (Powell).')
+        lower, upper = np.full(n_params, -np.inf), np.full(n_params, np.inf)
+    params = np.clip(params, lower, upper)
+
+    def residuals_and_jacobian(units, unit_params):
+        prediction, jacobian = model.return_prediction_and_jacobian(*list(unit_params.T), **args)
+        return data[units] - prediction, jacobian
+
+    residuals, jacobian = residuals_and_jacobian(np.arange(n_units), params)
+    errors = np.nan_to_num(np.sum(residuals**2, axis=-1), nan=np.inf)
+    damping = np.full(n_units, 1e-3)
+    active = np.arange(n_units)
+
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+
+        jtj = np.einsum('nkt,nlt->nkl', jacobian, jacobian)
+        gradient = np.einsum('nkt,nt->nk', jacobian, residuals)
+
+        # marquardt scaling of the damping, floored for parameters without effect
+        diagonal = np.diagonal(jtj, axis1=1, axis2=2)
+        diagonal = np.maximum(diagonal, 1e-9*diagonal.max(axis=-1, keepdims=True) + 1e-12)
+        damped = jtj + (damping[active, np.newaxis] * diagonal)[..., np.newaxis] * np.eye(n_params)
+        try:
+            steps = np.linalg.solve(damped, gradient[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            steps = np.einsum('nkl,nl->nk', np.linalg.pinv(damped), gradient)
+
+        new_params = np.clip(params[active] + steps, lower, upper)
+        new_residuals, new_jacobian = residuals_and_jacobian(active, new_params)
+        new_errors = np.nan_to_num(np.sum(new_residuals**2, axis=-1), nan=np.inf)
+
+        accepted = new_errors < errors[active]
+        converged = (accepted & ((errors[active] - new_errors) <= ftol * errors[active])) | \
+            (np.linalg.norm(new_params - params[active], axis=-1) <=
+             xtol * (np.linalg.norm(params[active], axis=-1) + xtol)) | \
+            (damping[active] > 1e10)
+
+        accepted_units = active[accepted]
+        params[accepted_units] = new_params[accepted]
+        errors[accepted_units] = new_errors[accepted]
+        damping[accepted_units] /= 10
+        damping[active[~accepted]] *= 10
+
+        # keep the residuals and jacobians at the current parameters of active units
+        residuals = np.where(accepted[:, np.newaxis], new_residuals, residuals)
+        jacobian = np.where(accepted[:, np.newaxis, np.newaxis], new_jacobian, jacobian)
+
+        active, residuals, jacobian = active[~converged], residuals[~converged], jacobian[~converged]
+
+    return np.nan_to_num(np.c_[params, 1 - errors / (data.shape[-1] * data.var(axis=-1))])
+
+
+def least_squares_rss(dots,
+                      sum_data,
+                      data_var,
+                      sum_preds,
+                      square_norm_preds,
+                      n_timepoints,
+                      pos_prfs_only=True):
+    """least_squares_rss
+
+    closed-form slopes, baselines and residual sums of squares of the
+    least-squares fit of each prediction to each unit, from the inner
+    products of data and predictions
+
+    Parameters
+    ----------
+    dots : ndarray [units, predictions]
+        inner products of the data of each unit with each prediction
+    sum_data : ndarray [units]
+        sum over time of the data of each unit
+    data_var : ndarray [units]
+        variance of the data of each unit
+    sum_preds : ndarray [predictions] or [units, predictions]
+        sum over time of each prediction
+    square_norm_preds : ndarray [predictions] or [units, predictions]
+        squared L2 norm of each prediction
+    n_timepoints : int
+        number of timepoints
+    pos_prfs_only : bool, optional
+        For units with at least one positive slope, set the rss of
+        predictions with non-positive slopes to inf. The default is True.
+
+    Returns
+    -------
+    rss, slopes, baselines : ndarray [units, predictions]
+        rss is inf where it is undefined
+    """
+    sum_data = sum_data[:, np.newaxis]
+
+    # best slopes and baselines for each unit and prediction
+    cov = n_timepoints * dots - sum_data * sum_preds
+    slopes = cov / (n_timepoints * square_norm_preds - sum_preds**2)
+    baselines = (sum_data - slopes * sum_preds) / n_timepoints
+
+    # residual sum of squares of the least-squares fit
+    rss = n_timepoints * data_var[:, np.newaxis] - cov * slopes / n_timepoints
+    rss[np.isnan(rss)] = np.inf
+
+    #to enforce, if possible, positive prf amplitude
+    if pos_prfs_only:
+        pos_units = np.any(slopes > 0, axis=-1)
+        rss[pos_units[:, np.newaxis] & ~(slopes > 0)] = np.inf
+
+    return rss, slopes, baselines
+
+
+def best_correlated_predictions(correlations, pos_prfs_only=True, n_best=1):
+    """best_correlated_predictions
+
+    indices of the best-fitting predictions of each unit, from the inner
+    products of the mean-removed data with mean-removed, unit-norm
+    predictions. The least-squares rss of a prediction is
+    n_timepoints*var - correlation**2, so the best predictions have the
+    largest absolute correlations (the largest positive ones, for units
+    with any positive correlation, with pos_prfs_only).
+
+    Parameters
+    ----------
+    correlations : ndarray [units, predictions]
+        inner products of mean-removed data and normalized predictions
+    pos_prfs_only : bool, optional
+        Prefer predictions with positive slopes. The default is True.
+    n_best : int, optional
+        Number of predictions returned per unit. The default is 1.
+
+    Returns
+    -------
+    ndarray [units, n_best]
+        indices of the best predictions of each unit, in no particular order
+    """
+    if pos_prfs_only:
+        # only units without positive correlations rank by absolute value
+        scores = correlations
+        neg_units = np.max(correlations, axis=-1) <= 0
+        if np.any(neg_units):
+            scores = correlations.copy()
+            scores[neg_units] = np.abs(scores[neg_units])
+    else:
+        scores = np.abs(correlations)
+
+    if n_best == 1:
+        return np.argmax(scores, axis=-1)[:, np.newaxis]
+
+    # the n_best largest scores lie in the n_best groups of predictions with
+    # the largest maxima, so only the members of these groups are partitioned.
+    # Group g holds predictions g, g+n_groups, g+2*n_groups, ..., so that
+    # group maxima are elementwise maxima of contiguous blocks of scores.
+    group_size = 64
+    n_units, n_predictions = scores.shape
+    n_groups = -(-n_predictions // group_size)
+    if n_groups <= n_best:
+        return np.argpartition(-scores, n_best-1, axis=-1)[:, :n_best]
+
+    if n_predictions % group_size != 0:
+        padded_scores = np.full((n_units, n_groups * group_size), -np.inf, dtype=scores.dtype)
+        padded_scores[:, :n_predictions] = scores
+        scores = padded_scores
+
+    group_maxima = scores.reshape(n_units, group_size, n_groups).max(axis=1)
+    best_groups = np.argpartition(-group_maxima, n_best-1, axis=-1)[:, :n_best]
+
+    members = (best_groups[..., np.newaxis] + np.arange(group_size) * n_groups).reshape(n_units, -1)
+    best_members = np.argpartition(-np.take_along_axis(scores, members, axis=-1),
+                                   n_best-1, axis=-1)[:, :n_best]
+
+    return np.take_along_axis(members, best_members, axis=-1)
+
+
+def search_prediction_index(queries, index, absolute=False, n_probe=None):
+    """search_prediction_index
+
+    maximum-inner-product search of unit-norm queries in an IVF index of
+    normalized predictions (see Model.grid_prediction_index). The clusters of
+    each query are visited in decreasing order of the upper bound
+    centroid score + radius (|centroid score| + radius, if absolute) on the
+    scores of their members, and the search of a query stops when its best
+    score so far reaches the bound of its next cluster, so the result is
+    exact. With n_probe, at most n_probe clusters are visited per query,
+    which is approximate.
+
+    Parameters
+    ----------
+    queries : ndarray [units, time]
+        unit-norm (mean-removed) data
+    index : dict
+        index returned by Model.grid_prediction_index
+    absolute : bool, optional
+        maximize absolute inner products. The default is False.
+    n_probe : int, optional
+        maximum number of clusters visited per query. The default is None (exact).
+
+    Returns
+    -------
+    best_indices : ndarray [units]
+        position of the best prediction of each query in the sorted
+        predictions of the index (see index['order'])
+    best_scores : ndarray [units]
+        (absolute) inner product with the best prediction
+    n_evaluated : int
+        number of inner products with predictions computed
+    """
+    normalized_predictions, offsets = index['normalized_predictions'], index['offsets']
+    centroid_scores = queries @ index['centroids'].T
+    if absolute:
+        centroid_scores = np.abs(centroid_scores)
+    bounds = centroid_scores + index['radii']
+    cluster_order = np.argsort(-bounds, axis=-1)
+    ordered_bounds = np.take_along_axis(bounds, cluster_order, axis=-1)
+
+    n_rounds = cluster_order.shape[-1] if n_probe is None else min(n_probe, cluster_order.shape[-1])
+    best_indices = np.zeros(queries.shape[0], dtype=int)
+    best_scores = np.full(queries.shape[0], -np.inf)
+    n_evaluated = 0
+    active = np.arange(queries.shape[0])
+
+    for visit in range(n_rounds):
+        active = active[best_scores[active] < ordered_bounds[active, visit]]
+        if active.size == 0:
+            break
+        clusters = cluster_order[active, visit]
+
+        for cluster in np.unique(clusters):
+            start, stop = offsets[cluster], offsets[cluster+1]
+            if stop == start:
+                continue
+            units = active[clusters == cluster]
+            scores = queries[units] @ normalized_predictions[start:stop].T
+            if absolute:
+                scores = np.abs(scores)
+            best = np.argmax(scores, axis=-1)
+            scores = scores[np.arange(units.size), best]
+            improved = scores > best_scores[units]
+            best_scores[units[improved]] = scores[improved]
+            best_indices[units[improved]] = start + best[improved]
+            n_evaluated += scores.size * (stop - start)
+
+    return best_indices, best_scores, n_evaluated
+
+
+def rsq_betas_for_batch(data,
+                        vox_num,
+                        predictions,
+                        n_timepoints,
+                        data_var,
+                        sum_preds,
+                        square_norm_preds,
+                        pos_prfs_only=True,
+                        block_size=64):
+    """rsq_betas_for_batch
+
+    Analytically computes best-fit rsq, slope, and baseline over all
+    predictions, for a given batch of units (faster than scipy/numpy lstsq).
+
+    Units are processed in blocks: the inner products of a block of units
+    with all predictions are obtained with a single matrix multiplication,
+    from which slopes, baselines and residual sums of squares follow in
+    closed form, using the prediction sums and squared norms.
+
+    Parameters
+    ----------
+    data : ndarray [units, time]
+        data of the units in the batch
+    vox_num : ndarray [units]
+        indices of the units in data_var
+    predictions : ndarray [predictions, time]
+        grid predictions
+    n_timepoints : int
+        number of timepoints
+    data_var : ndarray
+        variance of the data of all units
+    sum_preds : ndarray [predictions]
+        sum over time of each prediction
+    square_norm_preds : ndarray [predictions]
+        squared L2 norm of each prediction
+    pos_prfs_only : bool, optional
+        Enforce, if possible, positive prf amplitudes. The default is True.
+    block_size : int, optional
+        Number of units per matrix multiplication. The default is 64.
+
+    Returns
+    -------
+    ndarray [units, 4]
+        index of the best prediction, rsq, baseline and slope, per unit
+    """
+    result = np.zeros((data.shape[0], 4), dtype='float32')
+
+    for start in range(0, data.shape[0], block_size):
+        stop = min(start+block_size, data.shape[0])
+        block_var = data_var[vox_num[start:stop]].astype('float64')
+
+        rss, slopes, baselines = least_squares_rss(
+            np.dot(data[start:stop], predictions.T).astype('float64'),
+            np.sum(data[start:stop], axis=-1, dtype='float64'),
+            block_var,
+            sum_preds,
+            square_norm_preds,
+            n_timepoints,
+            pos_prfs_only=pos_prfs_only)
+
+        best_preds = np.argmin(rss, axis=-1)
+        units = np.arange(stop-start)
+        best_rss = np.maximum(rss[units, best_preds], 0)
+
+        result[start:stop, 0] = best_preds
+        result[start:stop, 1] = 1 - best_rss / (n_timepoints * block_var)
+        result[start:stop, 2] = baselines[units, best_preds]
+        result[start:stop, 3] = slopes[units, best_preds]
+
+    return result
+
+
+def norm_rsq_betas_for_batch(data,
+                             vox_nums,
+                             model,
+                             n_predictions,
+                             n_timepoints,
+                             data_var,
+                             sa, ss, nb, sb,
+                             gaussian_params,
+                             pos_prfs_only=True,
+                             block_size=32):
+    """norm_rsq_betas_for_batch
+
+    grid fit of the normalization model parameters for a batch of units.
+    The grid predictions depend on the Gaussian parameters of each unit,
+    so they are created per block of block_size units
+    (see Norm_Iso2DGaussianModel.create_grid_predictions), and fit in
+    closed form (see least_squares_rss).
+
+    Parameters
+    ----------
+    data : ndarray [units, time]
+        data of the batch
+    vox_nums : ndarray [units]
+        indices of the units of the batch
+    model : Norm_Iso2DGaussianModel
+        model (or its prediction kernel) creating the predictions
+    n_predictions, n_timepoints : int
+        number of grid predictions and of timepoints
+    data_var : ndarray
+        variance of the data of all units
+    sa, ss, nb, sb : ndarray [n_predictions]
+        raveled grid of the normalization model parameters
+    gaussian_params : ndarray
+        [x position, y position, prf size, rsq] of all units
+    pos_prfs_only : bool, optional
+        Enforce positive PRFs only. The default is True.
+    block_size : int, optional
+        Number of units whose predictions are created at once. The default is 32.
+
+    Returns
+    -------
+    ndarray [units, 4]
+        index of the best grid prediction, rsq, baseline and slope, per unit
+    """
+    result = np.zeros((data.shape[0], 4), dtype='float32')
+
+    for start in range(0, data.shape[0], block_size):
+        block_data = data[start:start+block_size]
+        block_vox_nums = vox_nums[start:start+block_size]
+        block_data_var = data_var[block_vox_nums].astype('float64')
+
+        predictions = model.create_grid_predictions(
+            gaussian_params[block_vox_nums, :-1], n_predictions, n_timepoints, sa, ss, nb, sb)
+        if predictions.ndim == 2:
+            predictions = predictions[np.newaxis]
+
+        rss, slopes, baselines = least_squares_rss(
+            np.einsum('ut,upt->up', block_data, predictions, dtype='float64'),
+            np.sum(block_data, axis=-1, dtype='float64'),
+            block_data_var,
+            np.sum(predictions, axis=-1, dtype='float64'),
+            np.einsum('upt,upt->up', predictions, predictions, dtype='float64'),
+            n_timepoints,
+            pos_prfs_only=pos_prfs_only)
+
+        best = np.argmin(rss, axis=-1)
+        units = np.arange(block_data.shape[0])
+
+        result[start:start+block_size, 0] = best
+        result[start:start+block_size, 1] = 1 - np.maximum(rss[units, best], 0) / (n_timepoints * block_data_var)
+        result[start:start+block_size, 2] = baselines[units, best]
+        result[start:start+block_size, 3] = slopes[units, best]
+
+    return result
+
+
+def x_shift_rss(data, data_var, model, fixed_params, x_positions, pos_prfs_only=True):
+    """x_shift_rss
+
+    closed-form slopes, baselines and residual sums of squares of the
+    predictions of isotropic gaussian prfs at the given x positions, with
+    the y position and size (and hrf) of each unit fixed
+
+    Parameters
+    ----------
+    data : ndarray [units, time]
+        data of the units
+    data_var : ndarray [units]
+        variance of the data of the units
+    model : Iso2DGaussianModel
+        model (or its prediction kernel) creating the predictions
+    fixed_params : ndarray [units, 2] or [units, 4]
+        y position and size (and hrf_1 and hrf_2) of each unit
+    x_positions : ndarray [units, positions]
+        x positions at which each unit is evaluated
+    pos_prfs_only : bool, optional
+        see least_squares_rss. The default is True.
+
+    Returns
+    -------
+    rss, slopes, baselines : ndarray [units, positions]
+    """
+    n_units, n_positions = x_positions.shape
+
+    # x, y, size, beta, baseline and hrf parameters of each prediction
+    params = np.zeros((n_units, n_positions, 3 + fixed_params.shape[-1]))
+    params[..., 0] = x_positions
+    params[..., 1:3] = fixed_params[:, np.newaxis, :2]
+    params[..., 3] = 1
+    params[..., 5:] = fixed_params[:, np.newaxis, 2:]
+
+    predictions = model.predict_batch(params.reshape(n_units * n_positions, -1)).reshape(
+        n_units, n_positions, -1)
+
+    return least_squares_rss(
+        np.einsum('ut,upt->up', data, predictions, dtype='float64'),
+        np.sum(data, axis=-1, dtype='float64'),
+        data_var.astype('float64'),
+        np.sum(predictions, axis=-1, dtype='float64'),
+        np.einsum('upt,upt->up', predictions, predictions, dtype='float64'),
+        data.shape[-1],
+        pos_prfs_only=pos_prfs_only)
+
+
+def x_grid_rsq_betas_for_batch(data,
+                               model,
+                               fixed_params,
+                               x_grid,
+                               data_var,
+                               pos_prfs_only=True,
+                               block_size=64):
+    """x_grid_rsq_betas_for_batch
+
+    grid fit of the x position of a batch of units, with the y position and
+    size (and hrf) of each unit fixed (see x_shift_rss). The predictions of
+    a block of block_size units are created at once.
+
+    Parameters
+    ----------
+    data : ndarray [units, time]
+        data of the batch
+    model : Iso2DGaussianModel
+        model (or its prediction kernel) creating the predictions
+    fixed_params : ndarray [units, 2] or [units, 4]
+        y position and size (and hrf_1 and hrf_2) of the units of the batch
+    x_grid : ndarray
+        x positions of the grid
+    data_var : ndarray [units]
+        variance of the data of the batch
+    pos_prfs_only : bool, optional
+        Enforce positive PRFs only. The default is True.
+    block_size : int, optional
+        Number of units whose predictions are created at once. The default is 64.
+
+    Returns
+    -------
+    ndarray [units, 4]
+        best x position, rsq, baseline and slope, per unit
+    """
+    result = np.zeros((data.shape[0], 4), dtype='float32')
+
+    for start in range(0, data.shape[0], block_size):
+        stop = min(start+block_size, data.shape[0])
+        block_var = data_var[start:stop].astype('float64')
+
+        rss, slopes, baselines = x_shift_rss(
+            data[start:stop], block_var, model, fixed_params[start:stop],
+            np.tile(x_grid, (stop-start, 1)), pos_prfs_only=pos_prfs_only)
+
+        best = np.argmin(rss, axis=-1)
+        units = np.arange(stop-start)
+
+        result[start:stop, 0] = x_grid[best]
+        result[start:stop, 1] = 1 - np.maximum(rss[units, best], 0) / (data.shape[-1] * block_var)
+        result[start:stop, 2] = baselines[units, best]
+        result[start:stop, 3] = slopes[units, best]
+
+    return result
+
+
+def x_refine_for_batch(data,
+                       model,
+                       fixed_params,
+                       lower,
+                       upper,
+                       start_x,
+                       data_var,
+                       xtol=1e-3,
+                       pos_prfs_only=True):
+    """x_refine_for_batch
 
-        output = fmin_powell(
-            error_function,
-            start_params,
-            xtol=xtol,
-            ftol=ftol,
-            args=(
-                args,
-                data,
-                model.return_prediction),
-            full_output=True,
-            disp=verbose)
+    bounded refinement of the x position of a batch of units, with the y
+    position and size (and hrf) of each unit fixed (see x_shift_rss).
+    A golden-section search within [lower, upper] is run for all units at
+    once: each iteration creates one prediction per unit. The best position
+    evaluated, including start_x, is returned.
 
-        return np.nan_to_num(np.r_[output[0], 1 - (output[1])/(len(data) * data.var())])
+    Parameters
+    ----------
+    data : ndarray [units, time]
+        data of the batch
+    model : Iso2DGaussianModel
+        model (or its prediction kernel) creating the predictions
+    fixed_params : ndarray [units, 2] or [units, 4]
+        y position and size (and hrf_1 and hrf_2) of the units of the batch
+    lower, upper : ndarray [units]
+        bracket of the x position of each unit
+    start_x : ndarray [units]
+        starting x position of each unit (e.g. of the grid fit)
+    data_var : ndarray [units]
+        variance of the data of the batch
+    xtol : float, optional
+        the search stops when all brackets are narrower than xtol.
+        The default is 1e-3.
+    pos_prfs_only : bool, optional
+        Enforce positive PRFs only, if the prf at start_x is positive.
+        The default is True.
+
+    Returns
+    -------
+    ndarray [units, 4]
+        best x position, rsq, baseline and slope, per unit
+    """
+    golden = (np.sqrt(5) - 1) / 2
+    lower, upper = lower.astype('float64'), upper.astype('float64')
+    left = upper - golden * (upper - lower)
+    right = lower + golden * (upper - lower)
+
+    rss, slopes, baselines = x_shift_rss(data, data_var, model, fixed_params,
+                                         np.c_[start_x, left, right], pos_prfs_only=False)
+    pos_units = pos_prfs_only & (slopes[:, 0] > 0)
+    rss[pos_units[:, np.newaxis] & ~(slopes > 0)] = np.inf
+
+    best_x, best_rss = start_x.astype('float64'), rss[:, 0]
+    best_slopes, best_baselines = slopes[:, 0], baselines[:, 0]
+    left_rss, right_rss = rss[:, 1], rss[:, 2]
+
+    def keep_best(x, x_rss, x_slopes, x_baselines):
+        better = x_rss < best_rss
+        for best, new in [(best_x, x), (best_rss, x_rss), (best_slopes, x_slopes), (best_baselines, x_baselines)]:
+            best[better] = new[better]
+
+    keep_best(left, left_rss, slopes[:, 1], baselines[:, 1])
+    keep_best(right, right_rss, slopes[:, 2], baselines[:, 2])
+
+    while np.max(upper - lower) > xtol:
+        # the minimum is in [lower, right] if left is better, else in [left, upper]
+        go_left = left_rss < right_rss
+        upper = np.where(go_left, right, upper)
+        lower = np.where(go_left, lower, left)
+        right, right_rss = np.where(go_left, left, right), np.where(go_left, left_rss, right_rss)
+        left, left_rss = np.where(go_left, left, right), np.where(go_left, left_rss, right_rss)
+
+        # one new position per unit
+        new_x = np.where(go_left, upper - golden * (upper - lower), lower + golden * (upper - lower))
+        rss, slopes, baselines = x_shift_rss(data, data_var, model, fixed_params,
+                                             new_x[:, np.newaxis], pos_prfs_only=False)
+        rss, slopes, baselines = rss[:, 0], slopes[:, 0], baselines[:, 0]
+        rss[pos_units & ~(slopes > 0)] = np.inf
+        keep_best(new_x, rss, slopes, baselines)
+
+        left, left_rss = np.where(go_left, new_x, left), np.where(go_left, rss, left_rss)
+        right, right_rss = np.where(go_left, right, new_x), np.where(go_left, right_rss, rss)
+
+    return np.c_[best_x,
+                 1 - np.maximum(best_rss, 0) / (data.shape[-1] * data_var),
+                 best_baselines,
+                 best_slopes]
+
+
+def shifted_prediction_rsq(model, data, params, x_offsets, fit_betas=False, block_size=1024):
+    """shifted_prediction_rsq
+
+    rsq of the predictions of given parameters under the stimulus translated
+    horizontally by each of x_offsets degrees (see
+    Iso2DGaussianModel.shifted_predictions), for all units at once, e.g. to
+    compare how well GazeCenterFS pRFs predict a shifted gaze condition under
+    retinotopic and spatiotopic coding, without refitting
+
+    Parameters
+    ----------
+    model : Iso2DGaussianModel
+        model of the stimulus to translate
+    data : ndarray [units, time] or VoxelSource
+        data of the units, read in blocks
+    params : ndarray [units, 5] or [units, 7]
+        parameters of each unit, the arguments of return_prediction in order
+    x_offsets : list of float
+        horizontal translations of the stimulus, in degrees (positive rightward)
+    fit_betas : bool, optional
+        whether amplitude and baseline are refit in closed form for each
+        translation (see least_squares_rss), rather than taken from params.
+        The default is False.
+    block_size : int, optional
+        number of units predicted at a time. The default is 1024.
+
+    Returns
+    -------
+    ndarray [translations, units, 3]
+        rsq, baseline and slope of each unit, for each translation
+    """
+    params = np.asarray(params, dtype='float64')
+    result = np.zeros((len(x_offsets), params.shape[0], 3))
+
+    for start in range(0, params.shape[0], block_size):
+        block_params = params[start:start+block_size].copy()
+        block_data = np.asarray(data[start:start+block_size], dtype='float64')
+        n_timepoints = block_data.shape[-1]
+        ss_data = n_timepoints * block_data.var(axis=-1)
+
+        if fit_betas:
+            block_params[:, 3], block_params[:, 4] = 1, 0
+        predictions = model.shifted_predictions(block_params, x_offsets)
+
+        for shift_nb in range(len(x_offsets)):
+            if fit_betas:
+                rss, slopes, baselines = least_squares_rss(
+                    np.einsum('ut,ut->u', block_data, predictions[shift_nb])[:, np.newaxis],
+                    block_data.sum(axis=-1),
+                    block_data.var(axis=-1),
+                    predictions[shift_nb].sum(axis=-1, dtype='float64')[:, np.newaxis],
+                    np.einsum('ut,ut->u', predictions[shift_nb], predictions[shift_nb], dtype='float64')[:, np.newaxis],
+                    n_timepoints,
+                    pos_prfs_only=False)
+                rss, slopes, baselines = rss[:, 0], slopes[:, 0], baselines[:, 0]
+
+                # flat predictions (e.g. of a stimulus translated off the screen) only fit the baseline
+                flat = np.ptp(predictions[shift_nb], axis=-1) == 0
+                rss[flat], slopes[flat], baselines[flat] = ss_data[flat], 0, block_data[flat].mean(axis=-1)
+            else:
+                rss = np.sum((block_data - predictions[shift_nb])**2, axis=-1)
+                slopes, baselines = block_params[:, 3], block_params[:, 4]
+
+            result[shift_nb, start:start+block_size] = np.c_[1 - rss / ss_data, baselines, slopes]
+
+    return np.nan_to_num(result)
+
+
+def append_checkpoint(filename, units, params):
+    """append_checkpoint
+
+    appends the indices and fitted params of completed units to a checkpoint
+    file, as rows of float64 [unit index, params], and flushes it to disk.
+    A row cut short (e.g. by a job killed while writing) is ignored by
+    read_checkpoint.
+
+    Parameters
+    ----------
+    filename : str
+        checkpoint file
+    units : ndarray [units]
+        indices of the completed units
+    params : ndarray [units, params]
+        fitted params (and rsq) of the completed units
+    """
+    with open(filename, 'ab') as f:
+        np.c_[units, params].astype('float64').tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_checkpoint(filename, n_columns):
+    """read_checkpoint
+
+    reads the completed rows of a checkpoint file (see append_checkpoint)
+
+    Parameters
+    ----------
+    filename : str
+        checkpoint file
+    n_columns : int
+        number of columns of each row, the unit index and its params
+
+    Returns
+    -------
+    units : ndarray [units]
+        indices of the completed units
+    params : ndarray [units, n_columns-1]
+        fitted params of the completed units (of the last row, if a unit
+        was appended more than once)
+    """
+    rows = np.fromfile(filename, dtype='float64')
+    rows = rows[:rows.shape[0] - rows.shape[0] % n_columns].reshape(-1, n_columns)
+
+    # last row of each unit
+    units, last_rows = np.unique(rows[::-1, 0].astype(int), return_index=True)
+
+    return units, rows[::-1][last_rows, 1:]
 
 
 class Fitter:
@@ -167,8 +1444,10 @@ class Fitter:
 
         Parameters
         ----------
-        data : numpy.ndarray, 2D
-            input data. First dimension units, Second dimension time
+        data : numpy.ndarray, 2D, or VoxelSource
+            input data. First dimension units, Second dimension time.
+            A VoxelSource (e.g. of a memory-mapped array or an hdf5 dataset)
+            is read in blocks of units, without loading all data in memory.
         model : prfpy.Model
             Model object that provides the grid and iterative search
             predictions.
@@ -177,12 +1456,18 @@ class Fitter:
         fit_hrf : boolean, optional
             Whether or not to fit two extra parameters for hrf derivative and
             dispersion. The default is False.
+        output_dir : str, optional (keyword argument)
+            folder in which the grid and iterative fit parameters are written
+            as memory-mapped .npy files as they are computed
+            (see allocate_output). By default, they are held in memory.
         """
         assert len(data.shape) == 2, \
             "input data should be two-dimensional, with first dimension units and second dimension time"     
 
-            
-        self.data = data.astype('float32')
+        if isinstance(data, VoxelSource):
+            self.data = data
+        else:
+            self.data = data.astype('float32')
         
         self.model = model
         self.n_jobs = n_jobs
@@ -195,6 +1480,52 @@ class Fitter:
 
         self.data_var = self.data.var(axis=-1)
 
+    def allocate_output(self, name, shape):
+        """allocate_output
+
+        preallocated output array, memory-mapped to output_dir/name.npy
+        if the fitter has an output_dir (see allocate_output)
+
+        Parameters
+        ----------
+        name : str
+            name of the output (e.g. 'gridsearch_params')
+        shape : tuple
+            shape of the output
+
+        Returns
+        -------
+        numpy.ndarray or numpy.memmap
+            zero-filled output
+        """
+        filename = None
+        if getattr(self, 'output_dir', None) is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            filename = os.path.join(self.output_dir, name + '.npy')
+
+        return allocate_output(shape, filename=filename, dtype='float64')
+
+    def unit_data(self, units, block_size=1024):
+        """unit_data
+
+        iterates over the data of the given units, reading them in blocks
+
+        Parameters
+        ----------
+        units : numpy.ndarray
+            indices of the units
+        block_size : int, optional
+            number of units read at a time. The default is 1024.
+
+        Yields
+        ------
+        numpy.ndarray
+            data of each unit, in the order of units
+        """
+        for start in range(0, units.shape[0], block_size):
+            for data in self.data[units[start:start+block_size]]:
+                yield data
+
     def iterative_fit(self,
                       rsq_threshold,
                       verbose=False,
@@ -203,7 +1534,21 @@ class Fitter:
                       args={},
                       constraints=None,
                       xtol=1e-4,
-                      ftol=1e-3):
+                      ftol=1e-3,
+                      analytic_gradient=True,
+                      engine='scipy',
+                      lm_block_size=128,
+                      checkpoint_file=None,
+                      checkpoint_units=1000,
+                      checkpoint_seconds=0,
+                      resume=True,
+                      optimizer=None,
+                      max_evaluations=None,
+                      max_seconds=None,
+                      unit_coordinates=None,
+                      warm_start_units=256,
+                      prediction_cache_size=0,
+                      prediction_cache_tolerance=0.0):
         """
         Generic function for iterative fitting. Does not need to be
         redefined for new models. It is sufficient to define
@@ -226,9 +1571,62 @@ class Fitter:
             Further arguments passed to iterative_search. The default is {}.
         constrains: list of scipy.optimize.LinearConstraints and/or
             scipy.optimize.NonLinearConstraints
+        analytic_gradient : boolean, optional
+            Whether bounded minimization uses the analytic gradient of the
+            model (see iterative_search). The default is True.
+        engine : str, optional
+            'scipy' minimizes each unit separately with scipy (see iterative_search).
+            'batched_lm' minimizes blocks of units at once with a vectorized
+            Levenberg-Marquardt solver (see batched_levenberg_marquardt), for models
+            with analytic jacobians. Bounds are enforced by clipping, constraints
+            are not supported. The default is 'scipy'.
+        lm_block_size : int, optional
+            Number of units per block for engine='batched_lm'. The default is 128.
+        checkpoint_file : str, optional
+            file to which the unit indices and params of completed units are
+            appended as the fit progresses (see append_checkpoint), so that
+            a job stopped by its time limit can be resumed. The default is
+            None (no checkpoint).
+        checkpoint_units : int, optional
+            with checkpoint_file, units are fit in chunks of checkpoint_units.
+            The default is 1000.
+        checkpoint_seconds : float, optional
+            with checkpoint_file, completed chunks are appended at most every
+            checkpoint_seconds. The default is 0, after every chunk.
+        resume : bool, optional
+            with checkpoint_file, units already in the checkpoint are not fit
+            again; otherwise the checkpoint is restarted. The default is True.
+        optimizer : str, optional
+            with engine='scipy', backend of iterative_search (see
+            register_optimizer). The default is None, see default_optimizer.
+        max_evaluations : int, optional
+            with engine='scipy', maximum number of error evaluations per
+            unit. The default is None, no maximum.
+        max_seconds : float, optional
+            with engine='scipy', maximum minimization time per unit, in
+            seconds. The default is None, no maximum.
+        unit_coordinates : numpy.ndarray, [units, 3], optional
+            integer (voxel) coordinates of the units. If given, units are
+            fit slice by slice (ordered by z, y, x), in chunks of at most
+            warm_start_units, and each unit starts from the best of its
+            starting params and the fitted params of its neighbours fitted
+            in previous chunks (see warm_start_params). The default is None.
+        warm_start_units : int, optional
+            with unit_coordinates, maximum number of units per chunk.
+            The default is 256.
+        prediction_cache_size, prediction_cache_tolerance : optional
+            with engine='scipy', memoization of the predictions of each
+            unit's minimization (see iterative_search). The default is 0, none.
         Returns
         -------
-        None.
+        None. The minimization statistics of each unit fit by iterative_search
+        (evaluations, iterations, seconds, budget spent, prediction cache hits
+        and lookups; nan for other units)
+        are stored in iterative_search_stats, and summarized in optimizer_stats
+        (see summarize_optimizer_stats). With unit_coordinates, warm started
+        units are marked in warm_started, and optimizer_stats also holds
+        their number, the median evaluations of warm and grid started units,
+        and the time spent choosing warm starts.
 
         """
 
@@ -255,11 +1653,67 @@ class Fitter:
             #use the grid or explicitly provided params to select voxels to fit
             self.rsq_mask = self.starting_params[:, -1] > rsq_threshold
 
-        self.iterative_search_params = np.zeros_like(self.starting_params)
-
-        if self.rsq_mask.sum()>0:
-            iterative_search_params = Parallel(self.n_jobs, verbose=verbose)(
-                delayed(iterative_search)(self.model,
+        self.iterative_search_params = self.allocate_output('iterative_search_params',
+                                                            self.starting_params.shape)
+        fit_units = np.flatnonzero(self.rsq_mask)
+        self.iterative_search_stats = np.full((self.starting_params.shape[0], 6), np.nan)
+
+        if checkpoint_file is not None:
+            # unit index and fitted params (with rsq) of each completed unit
+            n_columns = 1 + self.starting_params.shape[-1]
+            if resume and os.path.isfile(checkpoint_file):
+                done_units, done_params = read_checkpoint(checkpoint_file, n_columns)
+                self.iterative_search_params[done_units] = done_params
+                fit_units = np.setdiff1d(fit_units, done_units)
+                if verbose:
+                    print("Resuming from " + checkpoint_file + ": " + str(done_units.shape[0]) +
+                          " units done, " + str(fit_units.shape[0]) + " to fit.")
+            else:
+                open(checkpoint_file, 'wb').close()
+            chunk_size = checkpoint_units
+        else:
+            chunk_size = max(fit_units.shape[0], 1)
+
+        # only what return_prediction needs is sent to the workers
+        prediction_kernel = self.model.prediction_kernel()
+
+        # starting params of each unit, replaced by warm starts with unit_coordinates
+        unit_start_params = self.starting_params[:, :-1]
+        self.warm_started = np.zeros(self.starting_params.shape[0], dtype=bool)
+        if unit_coordinates is not None:
+            assert len(unit_coordinates) == self.starting_params.shape[0], \
+                "unit_coordinates should have one row per unit"
+            unit_coordinates = np.asarray(unit_coordinates, dtype=int)
+            fit_units = fit_units[np.lexsort(unit_coordinates[fit_units].T)]
+            neighbours = unit_neighbours(unit_coordinates)
+            # units fitted before (in the checkpoint)
+            converged = self.rsq_mask.copy()
+            converged[fit_units] = False
+            unit_start_params = np.array(unit_start_params, dtype='float64')
+            chunk_size = min(chunk_size, warm_start_units)
+            warm_start_seconds = 0
+
+        if fit_units.shape[0] > 0 and engine == 'batched_lm':
+            assert not self.constraints, "batched_lm does not support constraints"
+        elif fit_units.shape[0] > 0:
+            assert engine == 'scipy', "engine should be 'scipy' or 'batched_lm'"
+        if optimizer is None:
+            optimizer = default_optimizer(self.bounds, self.constraints)
+
+        def fit_chunk(parallel, units):
+            if engine == 'batched_lm':
+                return np.concatenate(parallel(
+                    delayed(batched_levenberg_marquardt)(prediction_kernel,
+                                                         self.data[units[start:start+lm_block_size]],
+                                                         unit_start_params[units[start:start+lm_block_size]],
+                                                         args=args,
+                                                         bounds=self.bounds,
+                                                         xtol=xtol,
+                                                         ftol=ftol)
+                    for start in range(0, units.shape[0], lm_block_size)))
+
+            results = parallel(
+                delayed(iterative_search)(prediction_kernel,
                                           data,
                                           start_params,
                                           args=args,
@@ -267,10 +1721,65 @@ class Fitter:
                                           ftol=ftol,
                                           verbose=verbose,
                                           bounds=self.bounds,
-                                          constraints=self.constraints)
-                for (data, start_params) in zip(self.data[self.rsq_mask], self.starting_params[self.rsq_mask, :-1]))
-            self.iterative_search_params[self.rsq_mask] = np.array(
-                iterative_search_params)
+                                          constraints=self.constraints,
+                                          analytic_gradient=analytic_gradient,
+                                          optimizer=optimizer,
+                                          max_evaluations=max_evaluations,
+                                          max_seconds=max_seconds,
+                                          prediction_cache_size=prediction_cache_size,
+                                          prediction_cache_tolerance=prediction_cache_tolerance,
+                                          return_stats=True)
+                for (data, start_params) in zip(self.unit_data(units), unit_start_params[units]))
+            self.iterative_search_stats[units] = [stats for _, stats in results]
+            return np.array([params for params, _ in results])
+
+        if fit_units.shape[0] == 0:
+            return
+
+        start_time = time.perf_counter()
+
+        # the same workers fit all chunks
+        with Parallel(self.n_jobs, verbose=verbose) as parallel:
+            pending_units, pending_params = [], []
+            last_checkpoint = time.time()
+
+            for start in range(0, fit_units.shape[0], chunk_size):
+                units = fit_units[start:start+chunk_size]
+                if unit_coordinates is not None:
+                    warm_start_time = time.perf_counter()
+                    unit_start_params[units], self.warm_started[units] = warm_start_params(
+                        prediction_kernel, self.data[units], unit_start_params[units],
+                        self.iterative_search_params[:, :-1], neighbours[units], converged, args)
+                    warm_start_seconds += time.perf_counter() - warm_start_time
+
+                self.iterative_search_params[units] = fit_chunk(parallel, units)
+                if unit_coordinates is not None:
+                    converged[units] = True
+
+                if checkpoint_file is not None:
+                    pending_units.append(units)
+                    pending_params.append(self.iterative_search_params[units])
+                    if time.time() - last_checkpoint >= checkpoint_seconds or start+chunk_size >= fit_units.shape[0]:
+                        append_checkpoint(checkpoint_file, np.concatenate(pending_units), np.concatenate(pending_params))
+                        pending_units, pending_params = [], []
+                        last_checkpoint = time.time()
+
+        self.optimizer_stats = summarize_optimizer_stats(self.iterative_search_stats[fit_units],
+                                                         self.iterative_search_params[fit_units, -1],
+                                                         time.perf_counter() - start_time)
+        self.optimizer_stats['optimizer'] = optimizer if engine == 'scipy' else engine
+        if unit_coordinates is not None:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                self.optimizer_stats.update(
+                    warm_started=int(self.warm_started[fit_units].sum()),
+                    median_evaluations_warm_started=float(np.nanmedian(
+                        self.iterative_search_stats[fit_units[self.warm_started[fit_units]], 0])),
+                    median_evaluations_grid_started=float(np.nanmedian(
+                        self.iterative_search_stats[fit_units[~self.warm_started[fit_units]], 0])),
+                    warm_start_seconds=warm_start_seconds)
+        if verbose:
+            print(self.optimizer_stats)
             
                 
     def crossvalidate_fit(self,
@@ -312,7 +1821,7 @@ class Fitter:
                 self.iterative_search_params[self.rsq_mask,-3:-1] = median_hrf_params
                 
             
-            test_predictions = self.model.return_prediction(*list(self.iterative_search_params[self.rsq_mask,:-1].T))
+            test_predictions = self.model.predict_batch(self.iterative_search_params[self.rsq_mask,:-1])
             self.model.stimulus = fit_stimulus
             
             #calculate CV-rsq        
@@ -354,7 +1863,19 @@ class Iso2DGaussianFitter(Fitter):
                  size_grid,
                  verbose=False,
                  n_batches=1000,
-                 pos_prfs_only=True):
+                 pos_prfs_only=True,
+                 grid_chunk_size=None,
+                 grid_cache_dir=None,
+                 method='dense',
+                 coarse_grid_size=12,
+                 n_candidates=3,
+                 n_validation_units=0,
+                 n_components=None,
+                 retained_variance=0.99999,
+                 n_exact=10,
+                 n_clusters=None,
+                 n_probe=None,
+                 other_fitters=[]):
         """grid_fit
 
         performs grid fit using provided grids and predictor definitions
@@ -376,96 +1897,653 @@ class Iso2DGaussianFitter(Fitter):
             parallelization and of sequential computing.
         pos_prfs_only : bool, optional
             Enforce positive PRFs only.
+        grid_chunk_size : int, optional
+            Number of grid rfs the model creates at a time, which bounds
+            the memory needed to create the grid predictions.
+            The default is None, which creates all grid rfs at once.
+        grid_cache_dir : str, optional
+            Folder in which the model caches its grid predictions, so that
+            jobs with identical stimulus, hrf, filter and grid settings
+            share them through a memory map (see Model.create_grid_predictions).
+            The default is None (no caching).
+        method : str, optional
+            'dense' evaluates all grid predictions for all units.
+            'coarse_to_fine' evaluates a coarse subgrid, and then the grid
+            points around the n_candidates best coarse points of each unit,
+            creating only the predictions needed
+            (see coarse_to_fine_grid_search).
+            'low_rank' searches in a truncated SVD basis of the predictions,
+            and recomputes the exact fit of the n_exact best predictions only
+            (see low_rank_grid_search).
+            'index' searches an IVF index of the normalized predictions,
+            exactly or, with n_probe, approximately (see index_grid_search).
+            The default is 'dense'.
+        coarse_grid_size : int, optional
+            'coarse_to_fine': number of coarse points along each grid
+            dimension. The default is 12.
+        n_candidates : int, optional
+            'coarse_to_fine': number of coarse points refined per unit.
+            The default is 3.
+        n_validation_units : int, optional
+            'coarse_to_fine' and 'index': number of randomly chosen units that
+            are also fit with the dense grid, to report the rsq lost.
+            The default is 0.
+        n_components : int, optional
+            'low_rank': number of SVD components. The default is None, which
+            uses the fewest components that retain retained_variance.
+        retained_variance : float, optional
+            'low_rank': fraction of the variance of the predictions to retain
+            if n_components is None. The default is 0.99999.
+        n_exact : int, optional
+            'low_rank': number of candidates per unit whose fit is computed
+            exactly. The default is 10.
+        n_clusters : int, optional
+            'index': number of index clusters. The default is None, the
+            square root of the number of grid points.
+        n_probe : int, optional
+            'index': maximum number of clusters searched per unit. The
+            default is None, an exact search.
+        other_fitters : list of Iso2DGaussianFitter, optional
+            'dense': fitters of other datasets with the same model (e.g.
+            other tasks or preprocessings with the same design), fit in the
+            same pass: their units are scored against the same grid
+            predictions, in the same matrix multiplications, and their
+            gridsearch_params are set. The default is [].
 
         Returns
         -------
         None.
 
         """
-        # let the model create the timecourses
-        self.model.create_grid_predictions(ecc_grid=ecc_grid,
-                                             polar_grid=polar_grid,
-                                             size_grid=size_grid)
-        self.model.predictions = self.model.predictions.astype('float32')
-
-        # this function analytically computes best-fit rsq, slope, and baseline
-        # for a given batch of units (faster than scipy/numpy lstsq).
-        def rsq_betas_for_batch(data, vox_num, predictions,
-                                n_timepoints, data_var,
-                                sum_preds, square_norm_preds):
-            result = np.zeros((data.shape[0], 4), dtype='float32')
-            for vox_data, num, idx in zip(
-                data, vox_num, np.arange(
-                    data.shape[0])):
-                # bookkeeping
-                sumd = np.sum(vox_data)
-
-                # best slopes and baselines for voxel for predictions
-                slopes = (n_timepoints * np.dot(vox_data, predictions.T) - sumd *
-                          sum_preds) / (n_timepoints * square_norm_preds - sum_preds**2)
-                baselines = (sumd - slopes * sum_preds) / n_timepoints
-
-                # resid and rsq
-                resid = np.linalg.norm((vox_data -
-                                        slopes[..., np.newaxis] *
-                                        predictions -
-                                        baselines[..., np.newaxis]), axis=-
-                                       1, ord=2)
-
-                #to enforce, if possible, positive prf amplitude
-                if pos_prfs_only:
-                    if np.any(slopes>0):
-                        resid[slopes<=0] = +np.inf
-
-                best_pred_voxel = np.nanargmin(resid)
-                rsq = 1 - resid[best_pred_voxel]**2 / \
-                    (n_timepoints * data_var[num])
-
-                result[idx, :] = best_pred_voxel, rsq, baselines[best_pred_voxel], slopes[best_pred_voxel]
-
-            return result
+        assert method == 'dense' or len(other_fitters) == 0, \
+            "other_fitters are only fit with the 'dense' grid_fit method"
+        for fitter in other_fitters:
+            assert fitter.model is self.model, "other_fitters should share the model of the fitter"
+
+        if method == 'coarse_to_fine':
+            # predictions are created on demand
+            self.model.setup_grid(ecc_grid, polar_grid, size_grid)
+            grid_search_rbs = self.coarse_to_fine_grid_search(
+                coarse_grid_size=coarse_grid_size,
+                n_candidates=n_candidates,
+                pos_prfs_only=pos_prfs_only,
+                n_validation_units=n_validation_units,
+                verbose=verbose)
+
+        else:
+            assert method in ['dense', 'low_rank', 'index'], "unknown grid_fit method " + str(method)
+            # let the model create the timecourses
+            self.model.create_grid_predictions(ecc_grid=ecc_grid,
+                                                 polar_grid=polar_grid,
+                                                 size_grid=size_grid,
+                                                 chunk_size=grid_chunk_size,
+                                                 cache_dir=grid_cache_dir)
+            if method == 'low_rank':
+                grid_search_rbs = self.low_rank_grid_search(n_components=n_components,
+                                                            retained_variance=retained_variance,
+                                                            pos_prfs_only=pos_prfs_only,
+                                                            n_exact=n_exact,
+                                                            cache_dir=grid_cache_dir,
+                                                            verbose=verbose)
+            elif method == 'index':
+                grid_search_rbs = self.index_grid_search(n_clusters=n_clusters,
+                                                         n_probe=n_probe,
+                                                         pos_prfs_only=pos_prfs_only,
+                                                         n_validation_units=n_validation_units,
+                                                         cache_dir=grid_cache_dir,
+                                                         verbose=verbose)
+            else:
+                grid_search_rbs = self.dense_grid_search(n_batches=n_batches,
+                                                         pos_prfs_only=pos_prfs_only,
+                                                         other_fitters=other_fitters,
+                                                         verbose=verbose)
+
+        # results of the units of all fitters, in order
+        unit_offsets = np.cumsum([0] + [fitter.n_units for fitter in [self] + other_fitters])
+        for fitter, start, stop in zip([self] + other_fitters, unit_offsets[:-1], unit_offsets[1:]):
+            max_rsqs = grid_search_rbs[start:stop, 0].astype('int')
+            fitter.gridsearch_r2 = grid_search_rbs[start:stop, 1]
+            fitter.best_fitting_baseline = grid_search_rbs[start:stop, 2]
+            fitter.best_fitting_beta = grid_search_rbs[start:stop, 3]
+
+            # output
+            fitter.gridsearch_params = fitter.allocate_output('gridsearch_params', (fitter.n_units, 6))
+            fitter.gridsearch_params[:] = np.array([
+                self.model.xs.ravel()[max_rsqs],
+                self.model.ys.ravel()[max_rsqs],
+                self.model.sizes.ravel()[max_rsqs],
+                fitter.best_fitting_beta,
+                fitter.best_fitting_baseline,
+                fitter.gridsearch_r2
+            ]).T
+
+
+    def dense_grid_search(self, n_batches=1000, pos_prfs_only=True, other_fitters=[], verbose=False):
+        """dense_grid_search
+
+        finds the best of all grid predictions of the model for all units,
+        in parallel over batches of units (see rsq_betas_for_batch)
+
+        Parameters
+        ----------
+        n_batches : int, optional
+            Number of batches of units. The default is 1000.
+        pos_prfs_only : bool, optional
+            Enforce positive PRFs only. The default is True.
+        other_fitters : list of Fitter, optional
+            fitters of other datasets with the same number of timepoints.
+            Each batch holds units of all datasets, so that the predictions
+            are read once for all datasets. The default is [].
+        verbose : boolean, optional
+            print output. The default is False.
+
+        Returns
+        -------
+        ndarray [units, 4]
+            index of the best grid prediction, rsq, baseline and slope, per
+            unit, for the units of the fitter followed by those of other_fitters
+        """
+        # no copy if already float32 (e.g. memory-mapped from the cache)
+        self.model.predictions = self.model.predictions.astype('float32', copy=False)
 
         # bookkeeping
-        sum_preds = np.sum(self.model.predictions, axis=-1)
-        square_norm_preds = np.linalg.norm(
-            self.model.predictions, axis=-1, ord=2)**2
-
-        # split data in batches
-        split_indices = np.array_split(
-            np.arange(self.data.shape[0]), n_batches)
-        data_batches = np.array_split(self.data, n_batches, axis=0)
+        sum_preds = np.sum(self.model.predictions, axis=-1, dtype='float64')
+        square_norm_preds = np.einsum('ij,ij->i', self.model.predictions,
+                                      self.model.predictions, dtype='float64')
+
+        fitters = [self] + list(other_fitters)
+        for fitter in other_fitters:
+            assert fitter.n_timepoints == self.n_timepoints, \
+                "other_fitters should have the same number of timepoints"
+
+        # units of all fitters are numbered in order
+        unit_offsets = np.cumsum([0] + [fitter.n_units for fitter in fitters])
+        data_var = np.concatenate([fitter.data_var for fitter in fitters])
+
+        # split the data of each fitter in batches, read as they are dispatched
+        split_indices = [np.array_split(np.arange(fitter.n_units), n_batches) for fitter in fitters]
         if verbose:
             print("Each batch contains approx. " +
-                  str(data_batches[0].shape[0]) + " voxels.")
+                  str(int(unit_offsets[-1] / n_batches)) + " voxels.")
+
+        def batch_data(batch):
+            return np.concatenate([fitter.data[split[batch]] for fitter, split in zip(fitters, split_indices)])
+
+        def batch_vox_num(batch):
+            return np.concatenate([split[batch] + offset for split, offset in zip(split_indices, unit_offsets)])
 
         # perform grid fit
         grid_search_rbs = Parallel(self.n_jobs, verbose=verbose)(
             delayed(rsq_betas_for_batch)(
-                data=data,
-                vox_num=vox_num,
+                data=batch_data(batch),
+                vox_num=batch_vox_num(batch),
                 predictions=self.model.predictions,
                 n_timepoints=self.n_timepoints,
-                data_var=self.data_var,
+                data_var=data_var,
                 sum_preds=sum_preds,
-                square_norm_preds=square_norm_preds)
-            for data, vox_num in zip(data_batches, split_indices))
+                square_norm_preds=square_norm_preds,
+                pos_prfs_only=pos_prfs_only)
+            for batch in range(n_batches))
+
+        if len(other_fitters) == 0:
+            return np.concatenate(grid_search_rbs, axis=0)
+
+        # batches interleave the units of the fitters
+        result = np.zeros((unit_offsets[-1], 4), dtype='float32')
+        result[np.concatenate([batch_vox_num(batch) for batch in range(n_batches)])] = \
+            np.concatenate(grid_search_rbs, axis=0)
+
+        return result
+
+    def low_rank_grid_search(self,
+                             n_components=None,
+                             retained_variance=0.99999,
+                             pos_prfs_only=True,
+                             n_exact=10,
+                             cache_dir=None,
+                             block_size=256,
+                             verbose=False):
+        """low_rank_grid_search
+
+        grid search in a truncated temporal SVD basis of the grid predictions
+        (see Model.grid_prediction_basis). Mean-removed predictions are stored
+        as n_components coefficients, mean-removed data are projected onto the
+        same basis, and the best n_exact predictions of each unit are found
+        from inner products in n_components dimensions. The exact fit of
+        these candidates (slope, baseline and rsq) then picks the best one. With cache_dir, the basis and
+        the coefficients are stored next to the cached grid predictions.
+
+        The number of components and the variance of the predictions they
+        retain (also for all other numbers of components, to choose
+        n_components) are stored in self.grid_fit_report.
 
-        grid_search_rbs = np.concatenate(grid_search_rbs, axis=0)
+        Parameters
+        ----------
+        n_components : int, optional
+            Number of components. The default is None, which uses the fewest
+            components that retain retained_variance.
+        retained_variance : float, optional
+            Fraction of variance to retain if n_components is None.
+            The default is 0.99999.
+        pos_prfs_only : bool, optional
+            Enforce positive PRFs only. The default is True.
+        n_exact : int, optional
+            Number of candidates per unit whose fit is computed exactly.
+            The default is 10.
+        cache_dir : str, optional
+            grid cache folder. The default is None.
+        block_size : int, optional
+            Number of units per matrix multiplication. The default is 256.
+        verbose : boolean, optional
+            print the report. The default is False.
 
-        max_rsqs = grid_search_rbs[:, 0].astype('int')
-        self.gridsearch_r2 = grid_search_rbs[:, 1]
-        self.best_fitting_baseline = grid_search_rbs[:, 2]
-        self.best_fitting_beta = grid_search_rbs[:, 3]
+        Returns
+        -------
+        ndarray [units, 4]
+            index of the best grid prediction, rsq, baseline and slope, per unit
+        """
+        start_time = time.time()
+        predictions = self.model.predictions.astype('float32', copy=False)
+
+        basis, singular_values = self.model.grid_prediction_basis(cache_dir=cache_dir)
+        variance_curve = np.cumsum(singular_values**2) / np.sum(singular_values**2)
+        if n_components is None:
+            n_components = int(np.searchsorted(variance_curve, retained_variance) + 1)
+        n_components = min(n_components, basis.shape[-1])
+        basis = np.ascontiguousarray(basis[:, :n_components], dtype='float32')
+
+        # exact sums and (mean-removed) squared norms of the predictions
+        sum_preds = np.sum(predictions, axis=-1, dtype='float64')
+        square_norm_preds = np.einsum('ij,ij->i', predictions, predictions, dtype='float64')
+        centered_square_norm_preds = square_norm_preds - sum_preds**2 / self.n_timepoints
+
+        coefficients_name = 'svd_coefficients_{}'.format(n_components)
+        coefficients = None
+        if cache_dir is not None and hasattr(self.model, 'grid_key'):
+            coefficients = load_cached_array(cache_dir, self.model.grid_key, coefficients_name)
+        if coefficients is None:
+            coefficients = np.zeros((predictions.shape[0], n_components), dtype='float32')
+            for start in range(0, predictions.shape[0], 8192):
+                coefficients[start:start+8192] = (predictions[start:start+8192] -
+                    sum_preds[start:start+8192, np.newaxis].astype('float32') / self.n_timepoints) @ basis
+            if cache_dir is not None and hasattr(self.model, 'grid_key'):
+                save_cached_array(cache_dir, self.model.grid_key, coefficients_name, coefficients)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaled_coefficients = np.nan_to_num(
+                coefficients / np.sqrt(centered_square_norm_preds)[:, np.newaxis].astype('float32'),
+                nan=0.0, posinf=0.0, neginf=0.0)
+
+        result = np.zeros((self.n_units, 4), dtype='float32')
+
+        for start in range(0, self.n_units, block_size):
+            stop = min(start+block_size, self.n_units)
+            data = self.data[start:stop]
+            data_var = self.data_var[start:stop].astype('float64')
+            sum_data = np.sum(data, axis=-1, dtype='float64')
+            projections = (data - data.mean(axis=-1, keepdims=True)) @ basis
+
+            # the least-squares rss of a prediction decreases with the squared
+            # (approximate) inner product of mean-removed data and unit-norm prediction
+            candidates = best_correlated_predictions(projections @ scaled_coefficients.T,
+                                                     pos_prfs_only=pos_prfs_only,
+                                                     n_best=min(n_exact, predictions.shape[0]))
+
+            # exact fit of the best candidates
+            candidate_predictions = predictions[candidates.ravel()].reshape(
+                candidates.shape + (self.n_timepoints,))
+            rss, slopes, baselines = least_squares_rss(
+                np.einsum('ut,uct->uc', data, candidate_predictions, dtype='float64'),
+                sum_data,
+                data_var,
+                sum_preds[candidates],
+                square_norm_preds[candidates],
+                self.n_timepoints,
+                pos_prfs_only=pos_prfs_only)
+            best = np.argmin(rss, axis=-1)
+            units = np.arange(stop-start)
+
+            result[start:stop, 0] = candidates[units, best]
+            result[start:stop, 1] = 1 - np.maximum(rss[units, best], 0) / (self.n_timepoints * data_var)
+            result[start:stop, 2] = baselines[units, best]
+            result[start:stop, 3] = slopes[units, best]
+
+        self.grid_fit_report = dict(
+            method='low_rank',
+            seconds=time.time() - start_time,
+            n_components=n_components,
+            retained_variance=variance_curve[n_components-1],
+            # retained variance for 1, 2, ... components
+            retained_variance_by_components=variance_curve)
 
-        # output
-        self.gridsearch_params = np.array([
-            self.model.xs.ravel()[max_rsqs],
-            self.model.ys.ravel()[max_rsqs],
-            self.model.sizes.ravel()[max_rsqs],
-            self.best_fitting_beta,
-            self.best_fitting_baseline,
-            self.gridsearch_r2
-        ]).T
+        if verbose:
+            print("low rank grid search with {} components, retaining {} of the prediction variance".format(
+                n_components, variance_curve[n_components-1]))
+
+        return result
+
+    def index_grid_search(self,
+                          n_clusters=None,
+                          n_probe=None,
+                          pos_prfs_only=True,
+                          n_validation_units=0,
+                          cache_dir=None,
+                          block_size=1024,
+                          verbose=False):
+        """index_grid_search
+
+        grid search with an IVF index of the normalized grid predictions
+        (see Model.grid_prediction_index and search_prediction_index).
+        The least-squares rss of a prediction decreases with the correlation
+        of data and prediction, so the best prediction of each unit is its
+        maximum-inner-product neighbour among the normalized predictions
+        (the largest absolute inner product, for units without positive ones,
+        or without pos_prfs_only). The search is exact, pruning clusters by
+        their score bounds; with n_probe it visits at most n_probe clusters
+        per unit, which is approximate. With cache_dir, the index is stored
+        next to the cached grid predictions.
+
+        The fraction of inner products computed relative to the dense grid
+        (and, with n_validation_units, the recall of the best dense grid
+        point and the rsq lost) are stored in self.grid_fit_report.
+
+        Parameters
+        ----------
+        n_clusters : int, optional
+            Number of index clusters. The default is None
+            (see Model.grid_prediction_index).
+        n_probe : int, optional
+            Maximum number of clusters visited per unit. The default is None (exact).
+        pos_prfs_only : bool, optional
+            Enforce positive PRFs only. The default is True.
+        n_validation_units : int, optional
+            Number of randomly chosen units also fit with the dense grid,
+            for the report. The default is 0.
+        cache_dir : str, optional
+            grid cache folder. The default is None.
+        block_size : int, optional
+            Number of units searched at a time. The default is 1024.
+        verbose : boolean, optional
+            print the report. The default is False.
+
+        Returns
+        -------
+        ndarray [units, 4]
+            index of the best grid prediction, rsq, baseline and slope, per unit
+        """
+        start_time = time.time()
+        predictions = self.model.predictions.astype('float32', copy=False)
+        index = self.model.grid_prediction_index(n_clusters=n_clusters, cache_dir=cache_dir)
+
+        result = np.zeros((self.n_units, 4), dtype='float32')
+        n_evaluated = 0
+
+        for start in range(0, self.n_units, block_size):
+            stop = min(start+block_size, self.n_units)
+            data = self.data[start:stop]
+            data_var = self.data_var[start:stop].astype('float64')
+
+            queries = (data - data.mean(axis=-1, keepdims=True)).astype('float32')
+            norms = np.linalg.norm(queries, axis=-1, keepdims=True)
+            queries = np.divide(queries, norms, out=np.zeros_like(queries), where=norms > 0)
+
+            best_indices, best_scores, n_block_evaluated = search_prediction_index(
+                queries, index, absolute=not pos_prfs_only, n_probe=n_probe)
+            n_evaluated += n_block_evaluated
+
+            if pos_prfs_only:
+                # units without positive correlations rank by absolute value
+                neg_units = np.flatnonzero(best_scores <= 0)
+                if neg_units.size > 0:
+                    best_indices[neg_units], _, n_block_evaluated = search_prediction_index(
+                        queries[neg_units], index, absolute=True, n_probe=n_probe)
+                    n_evaluated += n_block_evaluated
+
+            # exact fit of the best predictions
+            best_grid_points = index['order'][best_indices]
+            best_predictions = predictions[best_grid_points]
+            rss, slopes, baselines = least_squares_rss(
+                np.einsum('ut,ut->u', data, best_predictions, dtype='float64')[:, np.newaxis],
+                np.sum(data, axis=-1, dtype='float64'),
+                data_var,
+                np.sum(best_predictions, axis=-1, dtype='float64')[:, np.newaxis],
+                np.einsum('ut,ut->u', best_predictions, best_predictions, dtype='float64')[:, np.newaxis],
+                self.n_timepoints,
+                pos_prfs_only=pos_prfs_only)
+
+            result[start:stop, 0] = best_grid_points
+            result[start:stop, 1] = 1 - np.maximum(rss[:, 0], 0) / (self.n_timepoints * data_var)
+            result[start:stop, 2] = baselines[:, 0]
+            result[start:stop, 3] = slopes[:, 0]
+
+        self.grid_fit_report = dict(
+            method='index',
+            seconds=time.time() - start_time,
+            n_grid_points=predictions.shape[0],
+            n_clusters=index['centroids'].shape[0],
+            n_probe=n_probe,
+            # fraction of the dense grid's inner products (centroids included)
+            product_fraction=(n_evaluated / self.n_units + index['centroids'].shape[0]) / predictions.shape[0])
+
+        if n_validation_units > 0:
+            validation_units = np.sort(np.random.default_rng(0).choice(
+                self.n_units, min(n_validation_units, self.n_units), replace=False))
+            dense_result = rsq_betas_for_batch(
+                data=self.data[validation_units],
+                vox_num=validation_units,
+                predictions=predictions,
+                n_timepoints=self.n_timepoints,
+                data_var=self.data_var,
+                sum_preds=np.sum(predictions, axis=-1, dtype='float64'),
+                square_norm_preds=np.einsum('ij,ij->i', predictions, predictions, dtype='float64'),
+                pos_prfs_only=pos_prfs_only)
+            rsq_loss = dense_result[:, 1] - result[validation_units, 1]
+            self.grid_fit_report.update(
+                n_validation_units=validation_units.size,
+                # recall of the best dense grid point
+                recall=np.mean(dense_result[:, 0] == result[validation_units, 0]),
+                median_rsq_loss=np.median(rsq_loss),
+                max_rsq_loss=np.max(rsq_loss))
+
+        if verbose:
+            print(self.grid_fit_report)
+
+        return result
+
+    def coarse_to_fine_grid_search(self,
+                                   coarse_grid_size=12,
+                                   n_candidates=3,
+                                   pos_prfs_only=True,
+                                   n_validation_units=0,
+                                   max_refinements=10,
+                                   block_size=64,
+                                   chunk_size=8192,
+                                   verbose=False):
+        """coarse_to_fine_grid_search
+
+        multi-resolution grid search over the grid set up in the model
+        (see Model.setup_grid). All units are first fit with a coarse
+        subgrid of coarse_grid_size evenly spaced points along each grid
+        dimension. For each unit, all grid points within half a coarse step
+        of its n_candidates best coarse points (polar angle wrapping around,
+        if the polar grid covers the circle) are then evaluated, and this neighbourhood is moved to the best point
+        found until that point no longer changes (at most max_refinements
+        times). Predictions are created on demand by the model
+        (see Model.grid_predictions), so grid points far from the optimum of
+        every unit are never created.
+
+        The costs relative to the dense grid (and, with n_validation_units,
+        the rsq lost) are stored in self.grid_fit_report.
+
+        Parameters
+        ----------
+        coarse_grid_size : int, optional
+            Number of coarse points along each grid dimension. The default is 12.
+        n_candidates : int, optional
+            Number of coarse points refined per unit. The default is 3.
+        pos_prfs_only : bool, optional
+            Enforce positive PRFs only. The default is True.
+        n_validation_units : int, optional
+            Number of randomly chosen units also fit with the dense grid,
+            for the report. The default is 0.
+        max_refinements : int, optional
+            Maximum number of neighbourhoods evaluated per unit. The default is 10.
+        block_size : int, optional
+            Number of units refined at a time. The default is 64.
+        chunk_size : int, optional
+            Number of grid predictions created at a time for the dense fit of
+            the validation units, which streams over the grid without
+            keeping its predictions. The default is 8192.
+        verbose : boolean, optional
+            print the report. The default is False.
+
+        Returns
+        -------
+        ndarray [units, 4]
+            index of the best grid prediction, rsq, baseline and slope, per unit
+        """
+        start_time = time.time()
+        grid_shape = self.model.xs.shape
+        n_grid = self.model.xs.size
+
+        # the first and last polar angles are neighbours if the polar grid
+        # covers the circle, i.e. the gap between them is at most a grid step
+        polars = self.model.polars[:, 0, 0]
+        polar_gap = np.mod(polars[0] - polars[-1], 2*np.pi)
+        wrap_polar = polars.size > 2 and \
+            min(polar_gap, 2*np.pi - polar_gap) <= np.abs(np.diff(polars)).max() * (1 + 1e-6)
+
+        # evenly spaced subset of each grid dimension
+        coarse_axes = [np.unique(np.round(np.linspace(0, n-1, min(coarse_grid_size, n))).astype(int))
+                       for n in grid_shape]
+        coarse_points = np.ravel_multi_index(np.meshgrid(*coarse_axes, indexing='ij'),
+                                             grid_shape).ravel()
+
+        # offsets of the grid points within half a coarse step
+        radii = [int(np.ceil((n-1) / max(len(axis)-1, 1) / 2)) for n, axis in zip(grid_shape, coarse_axes)]
+        offsets = np.stack(np.meshgrid(*[np.arange(-r, r+1) for r in radii], indexing='ij'),
+                           axis=-1).reshape(-1, 3)
+        n_candidates = min(n_candidates, coarse_points.size)
+
+        coarse_predictions = self.model.grid_predictions(coarse_points)
+        coarse_sum_preds = np.sum(coarse_predictions, axis=-1, dtype='float64')
+        coarse_square_norm_preds = np.einsum('ij,ij->i', coarse_predictions,
+                                             coarse_predictions, dtype='float64')
+
+        result = np.zeros((self.n_units, 4), dtype='float32')
+        n_evaluated = 0
+
+        for start in range(0, self.n_units, block_size):
+            stop = min(start+block_size, self.n_units)
+            data = self.data[start:stop]
+            sum_data = np.sum(data, axis=-1, dtype='float64')
+            data_var = self.data_var[start:stop].astype('float64')
+
+            coarse_rss = least_squares_rss(np.dot(data, coarse_predictions.T).astype('float64'),
+                                           sum_data, data_var, coarse_sum_preds, coarse_square_norm_preds,
+                                           self.n_timepoints, pos_prfs_only=pos_prfs_only)[0]
+            centers = coarse_points[np.argpartition(coarse_rss, n_candidates-1, axis=-1)[:, :n_candidates]]
+
+            best_rss = np.full(stop-start, np.inf)
+            units = np.arange(stop-start)
+
+            # refine around the candidates, then around the best point of each
+            # unit until it no longer moves (a local search on the grid)
+            for _ in range(max_refinements):
+                # grid points around the centers, wrapping polar angle (first dimension)
+                candidates = np.stack(np.unravel_index(centers, grid_shape), axis=-1)[:, :, np.newaxis] + offsets
+                if wrap_polar:
+                    candidates[..., 0] %= grid_shape[0]
+                candidates = np.clip(candidates, 0, np.array(grid_shape) - 1)
+                candidates = np.ravel_multi_index(tuple(np.moveaxis(candidates.reshape(units.size, -1, 3), -1, 0)),
+                                                  grid_shape)
+
+                predictions = self.model.grid_predictions(candidates.ravel()).reshape(
+                    candidates.shape + (self.n_timepoints,))
+                rss, slopes, baselines = least_squares_rss(
+                    np.einsum('ut,uct->uc', data[units], predictions, dtype='float64'),
+                    sum_data[units],
+                    data_var[units],
+                    np.sum(predictions, axis=-1, dtype='float64'),
+                    np.einsum('uct,uct->uc', predictions, predictions, dtype='float64'),
+                    self.n_timepoints,
+                    pos_prfs_only=pos_prfs_only)
+
+                n_evaluated += candidates.size
+                best = np.argmin(rss, axis=-1)
+                candidate_units = np.arange(units.size)
+                improved = rss[candidate_units, best] < best_rss[units]
+                improved_units = units[improved]
+
+                best_rss[improved_units] = rss[candidate_units, best][improved]
+                result[start+improved_units, 0] = candidates[candidate_units, best][improved]
+                result[start+improved_units, 2] = baselines[candidate_units, best][improved]
+                result[start+improved_units, 3] = slopes[candidate_units, best][improved]
+
+                centers = candidates[candidate_units, best][improved][:, np.newaxis]
+                units = improved_units
+                if units.size == 0:
+                    break
+
+            result[start:stop, 1] = 1 - np.maximum(best_rss, 0) / (self.n_timepoints * data_var)
+
+        self.grid_fit_report = dict(
+            method='coarse_to_fine',
+            seconds=time.time() - start_time,
+            n_grid_points=n_grid,
+            n_coarse_points=coarse_points.size,
+            n_refined_points_per_unit=n_evaluated / self.n_units,
+            # fraction of the dense grid's predictions and inner products
+            prediction_fraction=self.model.grid_prediction_computed.sum() / n_grid,
+            product_fraction=(coarse_points.size + n_evaluated / self.n_units) / n_grid)
+
+        if n_validation_units > 0:
+            validation_units = np.sort(np.random.default_rng(0).choice(
+                self.n_units, min(n_validation_units, self.n_units), replace=False))
+            data = self.data[validation_units]
+            sum_data = np.sum(data, axis=-1, dtype='float64')
+            data_var = self.data_var[validation_units].astype('float64')
+            units = np.arange(validation_units.size)
+
+            # dense fit streamed over chunks of the grid, with the running best
+            # grid point of each unit among all predictions (first row) and
+            # among predictions with positive slopes (second row), so that
+            # pos_prfs_only applies over the full grid as in least_squares_rss
+            dense_rss = np.full((2, units.size), np.inf)
+            dense_points = np.zeros((2, units.size), dtype=int)
+            any_positive = np.zeros(units.size, dtype=bool)
+            for grid_start in range(0, n_grid, chunk_size):
+                chunk = np.arange(grid_start, min(grid_start+chunk_size, n_grid))
+                predictions = self.model.grid_predictions(chunk, cache=False)
+                rss, slopes, _ = least_squares_rss(
+                    np.dot(data, predictions.T).astype('float64'),
+                    sum_data,
+                    data_var,
+                    np.sum(predictions, axis=-1, dtype='float64'),
+                    np.einsum('ij,ij->i', predictions, predictions, dtype='float64'),
+                    self.n_timepoints,
+                    pos_prfs_only=False)
+
+                any_positive |= np.any(slopes > 0, axis=-1)
+                for row, chunk_rss in enumerate([rss, np.where(slopes > 0, rss, np.inf)]):
+                    best = np.argmin(chunk_rss, axis=-1)
+                    improved = chunk_rss[units, best] < dense_rss[row]
+                    dense_rss[row, improved] = chunk_rss[units, best][improved]
+                    dense_points[row, improved] = chunk[best][improved]
+
+            row = (pos_prfs_only & any_positive).astype(int)
+            dense_rsq = 1 - np.maximum(dense_rss[row, units], 0) / (self.n_timepoints * data_var)
+            rsq_loss = dense_rsq.astype('float32') - result[validation_units, 1]
+            self.grid_fit_report.update(
+                n_validation_units=validation_units.size,
+                same_grid_point_fraction=np.mean(dense_points[row, units] == result[validation_units, 0]),
+                median_rsq_loss=np.median(rsq_loss),
+                max_rsq_loss=np.max(rsq_loss))
+
+        if verbose:
+            print(self.grid_fit_report)
+
+        return result
 
 
 class Extend_Iso2DGaussianFitter(Iso2DGaussianFitter):
@@ -543,7 +2621,21 @@ class Extend_Iso2DGaussianFitter(Iso2DGaussianFitter):
                       args={},
                       constraints=[],
                       xtol=1e-4,
-                      ftol=1e-3):
+                      ftol=1e-3,
+                      analytic_gradient=True,
+                      engine='scipy',
+                      lm_block_size=128,
+                      checkpoint_file=None,
+                      checkpoint_units=1000,
+                      checkpoint_seconds=0,
+                      resume=True,
+                      optimizer=None,
+                      max_evaluations=None,
+                      max_seconds=None,
+                      unit_coordinates=None,
+                      warm_start_units=256,
+                      prediction_cache_size=0,
+                      prediction_cache_tolerance=0.0):
         """
         Iterative_fit for models building on top of the Gaussian. Does not need to be
         redefined for new models. It is sufficient to define either
@@ -563,6 +2655,21 @@ class Extend_Iso2DGaussianFitter(Iso2DGaussianFitter):
             Bounds for parameter minimization. The default is None.
         args : dictionary, optional
             Further arguments passed to iterative_search. The default is {}.
+        analytic_gradient : boolean, optional
+            Whether bounded minimization uses the analytic gradient of the
+            model (see iterative_search). The default is True.
+        engine : str, optional
+            'scipy' or 'batched_lm' (see Fitter.iterative_fit). The default is 'scipy'.
+        lm_block_size : int, optional
+            Number of units per block for engine='batched_lm'. The default is 128.
+        checkpoint_file, checkpoint_units, checkpoint_seconds, resume : optional
+            checkpointing of the fit (see Fitter.iterative_fit).
+        optimizer, max_evaluations, max_seconds : optional
+            backend and per-unit budget of iterative_search (see Fitter.iterative_fit).
+        unit_coordinates, warm_start_units : optional
+            warm starts from neighbouring units (see Fitter.iterative_fit).
+        prediction_cache_size, prediction_cache_tolerance : optional
+            memoization of predictions (see Fitter.iterative_fit).
 
         Returns
         -------
@@ -599,7 +2706,21 @@ class Extend_Iso2DGaussianFitter(Iso2DGaussianFitter):
                               args=args,
                               constraints=constraints,
                               xtol=xtol,
-                              ftol=ftol)
+                              ftol=ftol,
+                              analytic_gradient=analytic_gradient,
+                              engine=engine,
+                              lm_block_size=lm_block_size,
+                              checkpoint_file=checkpoint_file,
+                              checkpoint_units=checkpoint_units,
+                              checkpoint_seconds=checkpoint_seconds,
+                              resume=resume,
+                              optimizer=optimizer,
+                              max_evaluations=max_evaluations,
+                              max_seconds=max_seconds,
+                              unit_coordinates=unit_coordinates,
+                              warm_start_units=warm_start_units,
+                              prediction_cache_size=prediction_cache_size,
+                              prediction_cache_tolerance=prediction_cache_tolerance)
 
 
 class CSS_Iso2DGaussianFitter(Extend_Iso2DGaussianFitter):
@@ -775,74 +2896,21 @@ class Norm_Iso2DGaussianFitter(Extend_Iso2DGaussianFitter):
 
         
 
-        # this function analytically computes best-fit rsq, slope, and baseline
-        # for a given batch of units (faster than scipy/numpy lstsq).
-        def rsq_betas_for_batch(data,
-                                vox_nums,
-                                n_predictions,
-                                n_timepoints,
-                                data_var,
-                                sa, ss, nb, sb,
-                                gaussian_params):
-
-            result = np.zeros((data.shape[0], 4), dtype='float32')
-
-            for vox_data, vox_num, idx in zip(
-                data, vox_nums, np.arange(
-                    data.shape[0])):
-
-                # let the model create the timecourses, per voxel, since the
-                # gridding is over new parameters, while size and position
-                # are obtained from previous Gaussian fit
-                predictions = self.model.create_grid_predictions(
-                    gaussian_params[vox_num, :-1], n_predictions, n_timepoints, sa, ss, nb, sb)
-                # bookkeeping
-                sum_preds = np.sum(predictions, axis=-1)
-                square_norm_preds = np.linalg.norm(
-                    predictions, axis=-1, ord=2)**2
-                sumd = np.sum(vox_data)
-
-                # best possible slopes and baselines
-                slopes = (n_timepoints * np.dot(vox_data, predictions.T) - sumd *
-                          sum_preds) / (n_timepoints * square_norm_preds - sum_preds**2)
-                baselines = (sumd - slopes * sum_preds) / n_timepoints
-
-                # find best prediction and store relevant data
-                resid = np.linalg.norm((vox_data -
-                                        slopes[..., np.newaxis] *
-                                        predictions -
-                                        baselines[..., np.newaxis]), ord=2, axis=-
-                                       1)
-
-                #to enforce, if possible, positive prf amplitude & neural baseline
-                if pos_prfs_only:
-                    if np.any(slopes>0):
-                        resid[slopes<=0] = +np.inf
-
-                best_pred_voxel = np.nanargmin(resid)
-
-                rsq = 1 - resid[best_pred_voxel]**2 / \
-                    (n_timepoints * data_var[vox_num])
-
-                result[idx, :] = best_pred_voxel, rsq, baselines[best_pred_voxel], slopes[best_pred_voxel]
-
-            return result
-
         # masking and splitting data
         split_indices = np.array_split(np.arange(self.data.shape[0])[
                                        self.gridsearch_rsq_mask], n_batches)
-        data_batches = np.array_split(
-            self.data[self.gridsearch_rsq_mask], n_batches, axis=0)
 
         if verbose:
             print("Each batch contains approx. " +
-                  str(data_batches[0].shape[0]) + " voxels.")
+                  str(split_indices[0].shape[0]) + " voxels.")
 
         # parallel grid search over (sequential) batches of voxels
+        prediction_kernel = self.model.prediction_kernel()
         grid_search_rbs = Parallel(self.n_jobs, verbose=11)(
-            delayed(rsq_betas_for_batch)(
-                data=data,
+            delayed(norm_rsq_betas_for_batch)(
+                data=self.data[vox_nums],
                 vox_nums=vox_nums,
+                model=prediction_kernel,
                 n_predictions=self.n_predictions,
                 n_timepoints=self.n_timepoints,
                 data_var=self.data_var,
@@ -850,8 +2918,9 @@ class Norm_Iso2DGaussianFitter(Extend_Iso2DGaussianFitter):
                 ss=self.ss,
                 nb=self.nb,
                 sb=self.sb,
-                gaussian_params=self.gaussian_params)
-            for data, vox_nums in zip(data_batches, split_indices))
+                gaussian_params=self.gaussian_params,
+                pos_prfs_only=pos_prfs_only)
+            for vox_nums in split_indices)
 
         grid_search_rbs = np.concatenate(grid_search_rbs, axis=0)
 
@@ -861,7 +2930,7 @@ class Norm_Iso2DGaussianFitter(Extend_Iso2DGaussianFitter):
         self.best_fitting_baseline = grid_search_rbs[:, 2]
         self.best_fitting_beta = grid_search_rbs[:, 3]
 
-        self.gridsearch_params = np.zeros((self.n_units, 10))
+        self.gridsearch_params = self.allocate_output('gridsearch_params', (self.n_units, 10))
 
         self.gridsearch_params[self.gridsearch_rsq_mask] = np.array([
             self.gaussian_params[self.gridsearch_rsq_mask, 0],
@@ -875,3 +2944,187 @@ class Norm_Iso2DGaussianFitter(Extend_Iso2DGaussianFitter):
             self.sb[max_rsqs],
             self.gridsearch_r2
         ]).T
+
+
+class GazeShift_Iso2DGaussianFitter(Iso2DGaussianFitter):
+    """GazeShift_Iso2DGaussianFitter
+
+    Fits only the x position of an isotropic gaussian pRF model, with the
+    y position and size (and hrf) of each unit imported from a previous fit,
+    e.g. of the GazeCenterFS task, to measure horizontal shifts of the pRFs
+    with gaze. Amplitude and baseline are solved in closed form, so the grid
+    fit is a 1D grid of shifted predictions per unit, and the iterative fit
+    a 1D bounded refinement around the best grid position.
+
+    """
+
+    def __init__(self, model, data, previous_params, n_jobs=1, **kwargs):
+        """__init__
+
+        Parameters
+        ----------
+        model : Iso2DGaussianModel
+            Model object that provides the predictions.
+        data : numpy.ndarray, 2D, or VoxelSource
+            input data. First dimension units, Second dimension time
+        previous_params : numpy.ndarray
+            [x, y, size, beta, baseline, rsq] or, with fitted hrf,
+            [x, y, size, beta, baseline, hrf_1, hrf_2, rsq] of each unit,
+            e.g. iterative_search_params of an Iso2DGaussianFitter.
+            y, size and hrf are kept fixed.
+        n_jobs : int, optional
+            number of jobs to use in parallelization, by default 1
+        """
+        assert previous_params.shape[0] == data.shape[0], \
+            "previous_params should have one row per unit"
+        assert previous_params.shape[-1] in [6, 8], \
+            "previous_params should be gaussian parameters and rsq, with or without hrf"
+
+        super().__init__(data, model, n_jobs=n_jobs, fit_hrf=False, **kwargs)
+
+        self.previous_params = previous_params
+        # y, size and, if fitted, hrf_1 and hrf_2
+        self.fixed_params = np.array(previous_params[:, [1, 2] + list(range(5, previous_params.shape[-1]-1))],
+                                     dtype='float64')
+
+    def shift_params(self, units, fit_result):
+        """shift_params
+
+        parameters of the given units in the layout of previous_params,
+        from their fitted x position, rsq, baseline and slope
+
+        Parameters
+        ----------
+        units : ndarray
+            indices of the units
+        fit_result : ndarray [units, 4]
+            x position, rsq, baseline and slope, per unit
+
+        Returns
+        -------
+        ndarray [units, 6] or [units, 8]
+        """
+        return np.c_[fit_result[:, 0],
+                     self.fixed_params[units, :2],
+                     fit_result[:, 3],
+                     fit_result[:, 2],
+                     self.fixed_params[units, 2:],
+                     fit_result[:, 1]]
+
+    def grid_fit(self,
+                 x_grid,
+                 verbose=False,
+                 n_batches=1000,
+                 pos_prfs_only=True):
+        """grid_fit
+
+        fits the x position of all units on a 1D grid, with their y position
+        and size (and hrf) fixed (see x_grid_rsq_betas_for_batch)
+
+        Parameters
+        ----------
+        x_grid : 1D ndarray
+            x positions of the grid
+        verbose : boolean, optional
+            print output. The default is False.
+        n_batches : int, optional
+            The grid fit is performed in parallel over n_batches of units.
+            The default is 1000.
+        pos_prfs_only : bool, optional
+            Enforce positive PRFs only. The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.x_grid = np.sort(np.asarray(x_grid, dtype='float64'))
+
+        # only what return_prediction needs is sent to the workers
+        prediction_kernel = self.model.prediction_kernel()
+
+        split_indices = np.array_split(np.arange(self.n_units), max(min(n_batches, self.n_units), 1))
+        grid_search_rbs = Parallel(self.n_jobs, verbose=verbose)(
+            delayed(x_grid_rsq_betas_for_batch)(
+                data=self.data[vox_num],
+                model=prediction_kernel,
+                fixed_params=self.fixed_params[vox_num],
+                x_grid=self.x_grid,
+                data_var=self.data_var[vox_num],
+                pos_prfs_only=pos_prfs_only)
+            for vox_num in split_indices)
+
+        self.gridsearch_params = self.allocate_output('gridsearch_params', self.previous_params.shape)
+        self.gridsearch_params[:] = self.shift_params(np.arange(self.n_units),
+                                                      np.concatenate(grid_search_rbs, axis=0))
+
+    def iterative_fit(self,
+                      rsq_threshold,
+                      verbose=False,
+                      x_bounds=None,
+                      xtol=1e-3,
+                      n_batches=100,
+                      pos_prfs_only=True):
+        """iterative_fit
+
+        refines the x position of the units whose grid fit rsq exceeds
+        rsq_threshold, within one grid step of their best grid position
+        (see x_refine_for_batch). Other units are left at zero, as in
+        Fitter.iterative_fit.
+
+        Parameters
+        ----------
+        rsq_threshold : float
+            Rsq threshold for iterative fitting. Must be between 0 and 1.
+        verbose : boolean, optional
+            print output. The default is False.
+        x_bounds : tuple, optional
+            (min, max) of the x position. The default is None, the range
+            of the grid.
+        xtol : float, optional
+            precision of the x position. The default is 1e-3.
+        n_batches : int, optional
+            The refinement is performed in parallel over n_batches of units.
+            The default is 100.
+        pos_prfs_only : bool, optional
+            Keep positive PRFs positive. The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        assert hasattr(self, 'gridsearch_params'), 'First use self.grid_fit!'
+
+        if x_bounds is None:
+            x_bounds = (self.x_grid[0], self.x_grid[-1])
+        grid_step = np.max(np.diff(self.x_grid)) if self.x_grid.shape[0] > 1 else xtol
+
+        self.rsq_mask = self.gridsearch_params[:, -1] > rsq_threshold
+        self.iterative_search_params = self.allocate_output('iterative_search_params',
+                                                            self.gridsearch_params.shape)
+        fit_units = np.flatnonzero(self.rsq_mask)
+
+        if fit_units.shape[0] > 0:
+            start_x = np.clip(self.gridsearch_params[fit_units, 0], x_bounds[0], x_bounds[1])
+            lower = np.maximum(start_x - grid_step, x_bounds[0])
+            upper = np.minimum(start_x + grid_step, x_bounds[1])
+
+            prediction_kernel = self.model.prediction_kernel()
+
+            split_indices = np.array_split(np.arange(fit_units.shape[0]), min(n_batches, fit_units.shape[0]))
+            iterative_search_rbs = Parallel(self.n_jobs, verbose=verbose)(
+                delayed(x_refine_for_batch)(
+                    data=self.data[fit_units[batch]],
+                    model=prediction_kernel,
+                    fixed_params=self.fixed_params[fit_units[batch]],
+                    lower=lower[batch],
+                    upper=upper[batch],
+                    start_x=start_x[batch],
+                    data_var=self.data_var[fit_units[batch]],
+                    xtol=xtol,
+                    pos_prfs_only=pos_prfs_only)
+                for batch in split_indices)
+
+            self.iterative_search_params[fit_units] = self.shift_params(
+                fit_units, np.concatenate(iterative_search_rbs, axis=0))
@@ -1,12 +1,20 @@
 import numpy as np
 import scipy.signal as signal
+from copy import copy
 from nilearn.glm.first_level.hemodynamic_models import spm_hrf, spm_time_derivative, spm_dispersion_derivative
 from .rf import gauss2D_iso_cart   # import required RF shapes
 from .timecourse import stimulus_through_prf, \
+    stimulus_through_separable_prf, \
+    stimulus_through_separable_prf_jacobian, \
+    stimulus_through_shifted_separable_prf, \
     convolve_stimulus_dm, \
     generate_random_cosine_drifts, \
     generate_arima_noise, \
-    filter_predictions
+    filter_predictions, \
+    filter_operator, \
+    baseline_correct_predictions
+from .stimulus import shift_design_matrix
+from .cache import hash_items, load_cached_array, save_cached_array
 
 
 class Model(object):
@@ -29,10 +37,32 @@ class Model(object):
         """
         self.stimulus = stimulus
 
+    def create_hrf_basis(self):
+        """create_hrf_basis
+
+        the spm hrf and its time and dispersion derivatives, sampled at the
+        TR of the stimulus. They are computed once per TR and cached, as
+        every hrf is a linear combination of them (see create_hrf).
+
+        Returns
+        -------
+        numpy.ndarray
+            basis functions, first dimension (hrf, time derivative,
+            dispersion derivative), second dimension time
+        """
+        if getattr(self, 'hrf_basis_TR', None) != self.stimulus.TR:
+            self.hrf_basis = np.array([
+                basis_function(tr=self.stimulus.TR, oversampling=1, time_length=40)
+                for basis_function in (spm_hrf, spm_time_derivative, spm_dispersion_derivative)])
+            self.hrf_basis_TR = self.stimulus.TR
+
+        return self.hrf_basis
+
     def create_hrf(self, hrf_params=[1.0, 1.0, 0.0]):
         """
         
-        construct single or multiple HRFs        
+        construct single or multiple HRFs, as linear combinations of the
+        cached basis functions (see create_hrf_basis)
 
         Parameters
         ----------
@@ -45,25 +75,11 @@ class Model(object):
             DESCRIPTION.
 
         """
-        
-        hrf = np.array(
-            [
-                np.ones_like(hrf_params[1])*hrf_params[0] *
-                spm_hrf(
-                    tr=self.stimulus.TR,
-                    oversampling=1,
-                    time_length=40)[...,np.newaxis],
-                hrf_params[1] *
-                spm_time_derivative(
-                    tr=self.stimulus.TR,
-                    oversampling=1,
-                    time_length=40)[...,np.newaxis],
-                hrf_params[2] *
-                spm_dispersion_derivative(
-                    tr=self.stimulus.TR,
-                    oversampling=1,
-                    time_length=40)[...,np.newaxis]]).sum(
-            axis=0)                    
+        hrf_basis = self.create_hrf_basis()
+
+        hrf = np.ones_like(hrf_params[1])*hrf_params[0] * hrf_basis[0][...,np.newaxis] + \
+            hrf_params[1] * hrf_basis[1][...,np.newaxis] + \
+            hrf_params[2] * hrf_basis[2][...,np.newaxis]
 
         return hrf.T
     
@@ -154,6 +170,9 @@ class Iso2DGaussianModel(Model):
                  filter_type='dc',
                  filter_params={},
                  normalize_RFs=False,
+                 separable_rfs=True,
+                 precompute_convolution=True,
+                 precompute_filter=True,
                  **kwargs):
         """__init__ for Iso2DGaussianModel
 
@@ -173,6 +192,20 @@ class Iso2DGaussianModel(Model):
         filter_predictions : boolean, optional
             whether to high-pass filter the predictions, default False
         filter_params : see timecourse.py
+        separable_rfs : boolean, optional
+            whether to compute the response of the (isotropic) rfs as
+            separable x and y gaussians, without creating 2D rfs
+            (see timecourse.stimulus_through_separable_prf), default True
+        precompute_convolution : boolean, optional
+            whether return_prediction applies the (fixed) hrf through a cached
+            time x time convolution operator, and for linear models through the
+            design matrix convolved with this operator, instead of convolving
+            each prediction (see precompute_hrf_convolution), default True.
+            Predictions with hrf_1/hrf_2 then use cached operators of the
+            hrf basis functions (see precompute_hrf_basis_convolution).
+        precompute_filter : boolean, optional
+            whether predictions are filtered through a cached time x time
+            filter operator (see precompute_filter_operator), default True
         """
         super().__init__(stimulus)
         self.__dict__.update(kwargs)
@@ -189,8 +222,8 @@ class Iso2DGaussianModel(Model):
         elif isinstance(hrf, np.ndarray) and len(hrf) > 3:
             self.hrf = hrf
 
-        self.stimulus.convolved_design_matrix = convolve_stimulus_dm(
-            stimulus.design_matrix, hrf=self.hrf)
+        self.stimulus.convolved_design_matrix = np.ascontiguousarray(convolve_stimulus_dm(
+            stimulus.design_matrix, hrf=self.hrf))
 
         # filtering and other stuff
         self.filter_predictions = filter_predictions
@@ -206,7 +239,526 @@ class Iso2DGaussianModel(Model):
       
         #normalizing RFs to have volume 1
         self.normalize_RFs = normalize_RFs
-        
+
+        self.separable_rfs = separable_rfs
+
+        self.precompute_convolution = precompute_convolution
+
+        self.precompute_filter = precompute_filter
+
+    def precompute_hrf_convolution(self):
+        """precompute_hrf_convolution
+
+        computes, for the current stimulus and hrf, the time x time operator
+        `hrf_operator` such that neural_tc @ hrf_operator equals
+        convolve_timecourse_hrf(neural_tc, self.hrf) (the padded convolution
+        is linear in the timecourse), and the design matrix convolved with
+        this operator, `hrf_convolved_design_matrix`. As dotting rfs and the
+        design matrix is linear too, linear models can use the latter directly.
+        Both are recomputed only if the stimulus or hrf object changed
+        (e.g. in crossvalidate_fit).
+
+        Returns
+        -------
+        bool
+            whether the operators are available (not for 1D, 'direct' hrfs)
+        """
+        if np.ndim(self.hrf) != 2:
+            return False
+
+        source_stimulus, source_hrf = getattr(self, 'hrf_operator_source', (None, None))
+        if source_stimulus is self.stimulus and source_hrf is self.hrf:
+            return True
+
+        design_matrix = self.stimulus.design_matrix
+        n_timepoints = design_matrix.shape[-1]
+
+        self.hrf_operator = self.convolve_timecourse_hrf(np.eye(n_timepoints), self.hrf)
+        self.hrf_convolved_design_matrix = (
+            design_matrix.reshape(-1, n_timepoints) @ self.hrf_operator).reshape(design_matrix.shape)
+        self.hrf_operator_source = (self.stimulus, self.hrf)
+
+        return True
+
+    def use_precomputed_convolution(self, hrf_1=None, hrf_2=None):
+        """use_precomputed_convolution
+
+        whether a prediction with these hrf parameters can use the operators
+        of precompute_hrf_convolution (computing them if needed)
+
+        Parameters
+        ----------
+        hrf_1, hrf_2 : float or numpy.ndarray, optional
+            hrf derivative weights (the default is None, for self.hrf)
+
+        Returns
+        -------
+        bool
+        """
+        return self.precompute_convolution and (hrf_1 is None or hrf_2 is None) and \
+            self.precompute_hrf_convolution()
+
+    def precompute_hrf_basis_convolution(self):
+        """precompute_hrf_basis_convolution
+
+        computes, for the current stimulus, the time x time operators
+        `hrf_basis_operators` that convolve timecourses with each hrf basis
+        function (see create_hrf_basis and precompute_hrf_convolution).
+        As the hrf is linear in hrf_1 and hrf_2, so is its operator, and
+        predictions with fitted hrfs combine these operators rather than
+        creating and convolving with a new hrf.
+        The operators are recomputed only if the stimulus object changed.
+        """
+        if getattr(self, 'hrf_basis_operators_source', None) is self.stimulus:
+            return
+
+        identity = np.eye(self.stimulus.design_matrix.shape[-1])
+        self.hrf_basis_operators = np.array([self.convolve_timecourse_hrf(identity, basis[np.newaxis])
+                                             for basis in self.create_hrf_basis()])
+        self.hrf_basis_operators_source = self.stimulus
+
+    def convolve_hrf_basis(self, neural_tc):
+        """convolve_hrf_basis
+
+        convolves neural timecourses with each hrf basis function, through
+        the precomputed operators if precompute_convolution
+
+        Parameters
+        ----------
+        neural_tc : numpy.ndarray
+            neural timecourses, first dimension pRFs, second dimension time
+
+        Returns
+        -------
+        numpy.ndarray
+            convolved timecourses, first dimension (hrf, time derivative,
+            dispersion derivative), second dimension pRFs, third dimension time
+        """
+        if self.precompute_convolution:
+            self.precompute_hrf_basis_convolution()
+            return neural_tc @ self.hrf_basis_operators
+
+        return np.array([self.convolve_timecourse_hrf(neural_tc, basis[np.newaxis])
+                         for basis in self.create_hrf_basis()])
+
+    def convolve_neural_timecourse(self, neural_tc, hrf_1=None, hrf_2=None):
+        """convolve_neural_timecourse
+
+        convolves neural timecourses with self.hrf, or with the hrf given
+        by hrf_1 and hrf_2, through the precomputed operator when possible
+
+        Parameters
+        ----------
+        neural_tc : numpy.ndarray
+            neural timecourses, first dimension pRFs, second dimension time
+        hrf_1, hrf_2 : float or numpy.ndarray, optional
+            hrf derivative weights (the default is None, for self.hrf)
+
+        Returns
+        -------
+        numpy.ndarray
+            convolved timecourses
+        """
+        if self.use_precomputed_convolution(hrf_1, hrf_2):
+            return neural_tc @ self.hrf_operator
+        elif hrf_1 is None or hrf_2 is None:
+            return self.convolve_timecourse_hrf(neural_tc, self.hrf)
+        elif self.precompute_convolution or np.size(hrf_1) > 1 or np.size(hrf_2) > 1:
+            # convolve once with each basis function (rather than with a
+            # different hrf per timecourse), as the hrf is linear in hrf_1 and hrf_2
+            canonical_tc, time_derivative_tc, dispersion_derivative_tc = self.convolve_hrf_basis(neural_tc)
+            return canonical_tc + np.reshape(hrf_1, (-1, 1)) * time_derivative_tc + \
+                np.reshape(hrf_2, (-1, 1)) * dispersion_derivative_tc
+        else:
+            return self.convolve_timecourse_hrf(neural_tc, self.create_hrf([1.0, hrf_1, hrf_2]))
+
+    def precompute_filter_operator(self, n_timepoints):
+        """precompute_filter_operator
+
+        computes the time x time operator `filter_operator` of the filter
+        of this model (see timecourse.filter_operator), recomputed only if
+        the filter type, parameters or number of timepoints changed
+
+        Parameters
+        ----------
+        n_timepoints : int
+            number of timepoints of the predictions
+        """
+        key = hash_items(self.filter_type, self.filter_params, n_timepoints)
+        if getattr(self, 'filter_operator_key', None) != key:
+            self.filter_operator = filter_operator(n_timepoints, self.filter_type, self.filter_params)
+            self.filter_operator_key = key
+
+    def filter_timecourses(self, tc):
+        """filter_timecourses
+
+        filters timecourses as filter_predictions, through the cached filter
+        operator if precompute_filter, followed by the late_iso_dict
+        baseline correction if any
+
+        Parameters
+        ----------
+        tc : numpy.ndarray
+            timecourses, first dimension pRFs, second dimension time
+
+        Returns
+        -------
+        numpy.ndarray
+            filtered timecourses
+        """
+        if not self.precompute_filter or self.filter_type not in ['sg', 'dc']:
+            return filter_predictions(tc, self.filter_type, self.filter_params)
+
+        self.precompute_filter_operator(tc.shape[-1])
+        filtered_tc = tc @ self.filter_operator.astype(tc.dtype, copy=False)
+
+        late_iso_dict = self.filter_params.get('late_iso_dict')
+        if late_iso_dict is not None and (self.filter_type == 'dc' or self.filter_params.get('highpass', True)):
+            task_lengths = self.filter_params.get('task_lengths')
+            if task_lengths is None:
+                task_lengths = [tc.shape[-1]]
+            filtered_tc = baseline_correct_predictions(filtered_tc,
+                                                       task_lengths,
+                                                       self.filter_params.get('task_names'),
+                                                       late_iso_dict)
+
+        return filtered_tc
+
+    def predict_batch(self, params, chunk_size=256):
+        """predict_batch
+
+        predictions for many parameter sets, computed in chunks of
+        chunk_size sets, each with a single (vectorized) call to
+        return_prediction, so that memory use is bounded.
+
+        Parameters
+        ----------
+        params : numpy.ndarray
+            parameters, first dimension parameter sets, second dimension
+            the arguments of return_prediction, in order (with or
+            without hrf_1 and hrf_2)
+        chunk_size : int, optional
+            number of parameter sets per chunk. The default is 256.
+
+        Returns
+        -------
+        numpy.ndarray
+            float32 predictions, first dimension parameter sets, second dimension time
+        """
+        params = np.atleast_2d(np.asarray(params, dtype='float64'))
+        predictions = np.zeros((params.shape[0], self.stimulus.design_matrix.shape[-1]), dtype='float32')
+
+        for start in range(0, params.shape[0], chunk_size):
+            predictions[start:start+chunk_size] = self.return_prediction(
+                *list(params[start:start+chunk_size].T))
+
+        return predictions
+
+    def shifted_predictions(self, params, x_offsets, chunk_size=256):
+        """shifted_predictions
+
+        predictions for many parameter sets under the stimulus translated
+        horizontally by each of x_offsets degrees (see
+        PRFStimulus2D.shifted_design_matrix), e.g. the predictions of
+        GazeCenterFS pRFs for shifted gaze under retinotopic or spatiotopic
+        coding. With separable rfs, the projections of the stimulus onto the
+        rfs are computed once for all translations
+        (see timecourse.stimulus_through_shifted_separable_prf).
+
+        Parameters
+        ----------
+        params : numpy.ndarray
+            parameters, first dimension parameter sets, second dimension
+            the arguments of return_prediction, in order (with or
+            without hrf_1 and hrf_2)
+        x_offsets : list of float
+            horizontal translations of the stimulus, in degrees (positive rightward)
+        chunk_size : int, optional
+            number of parameter sets per chunk. The default is 256.
+
+        Returns
+        -------
+        numpy.ndarray
+            float32 predictions, first dimension translations, second
+            dimension parameter sets, third dimension time
+        """
+        params = np.atleast_2d(np.asarray(params, dtype='float64'))
+        column_shifts = [self.stimulus.column_shift(x_offset) for x_offset in x_offsets]
+        n_shifts, n_timepoints = len(column_shifts), self.stimulus.design_matrix.shape[-1]
+        predictions = np.zeros((n_shifts, params.shape[0], n_timepoints), dtype='float32')
+
+        fixed_hrf = params.shape[-1] < 7
+        if fixed_hrf and self.use_precomputed_convolution():
+            # translations commute with the (temporal) hrf convolution
+            dm = self.hrf_convolved_design_matrix
+        else:
+            dm = self.stimulus.design_matrix
+        if not self.separable_rfs:
+            shifted_dms = [shift_design_matrix(dm, column_shift) for column_shift in column_shifts]
+
+        for start in range(0, params.shape[0], chunk_size):
+            mu_x, mu_y, size, beta, baseline = params[start:start+chunk_size, :5].T
+
+            if self.separable_rfs:
+                tc = stimulus_through_shifted_separable_prf(
+                    x_coordinates=self.stimulus.x_coordinates_1d,
+                    y_coordinates=self.stimulus.y_coordinates_1d[::-1],
+                    mu_x=mu_x,
+                    mu_y=mu_y,
+                    sigma=size,
+                    stimulus=dm,
+                    column_shifts=column_shifts,
+                    normalize_RFs=self.normalize_RFs)
+            else:
+                tc = np.array([self.stimulus_through_rfs(mu_x, mu_y, size, shifted_dm)
+                               for shifted_dm in shifted_dms])
+            tc = tc.reshape(-1, n_timepoints)
+
+            if dm is self.stimulus.design_matrix:
+                if fixed_hrf:
+                    tc = self.convolve_neural_timecourse(tc)
+                else:
+                    tc = self.convolve_neural_timecourse(tc,
+                                                         np.tile(params[start:start+chunk_size, 5], n_shifts),
+                                                         np.tile(params[start:start+chunk_size, 6], n_shifts))
+
+            if self.filter_predictions:
+                tc = self.filter_timecourses(tc)
+
+            predictions[:, start:start+chunk_size] = baseline[..., np.newaxis] + \
+                beta[..., np.newaxis] * tc.reshape(n_shifts, -1, n_timepoints)
+
+        return predictions
+
+    def prediction_kernel(self):
+        """prediction_kernel
+
+        returns a slim copy of this model that holds only what
+        return_prediction (and return_prediction_and_jacobian) need:
+        hrf, filter settings, the design matrix, the precomputed convolution
+        operators and the 1D coordinates (2D coordinates only for non-separable
+        rfs). Grid predictions, rfs and meshgrids are left out, so that passing
+        the kernel to joblib workers does not serialize them for every task.
+        Arrays are shared with the model, not copied, and large ones are
+        memory-mapped to the workers by joblib.
+
+        Returns
+        -------
+        Iso2DGaussianModel
+            model of the same class, without grid attributes
+        """
+        kernel = copy(self)
+        for attribute in ['predictions', 'grid_rfs', 'eccs', 'polars', 'sizes', 'xs', 'ys',
+                          'grid_prediction_cache', 'grid_prediction_computed',
+                          'hrf_operator_source']:
+            kernel.__dict__.pop(attribute, None)
+
+        kernel.stimulus = copy(self.stimulus)
+        stimulus_attributes = ['convolved_design_matrix', 'complex_coordinates',
+                               'ecc_coordinates', 'polar_coordinates', 'mask',
+                               'shifted_design_matrices', 'shifted_stimuli']
+        if self.separable_rfs:
+            stimulus_attributes += ['x_coordinates', 'y_coordinates']
+        for attribute in stimulus_attributes:
+            kernel.stimulus.__dict__.pop(attribute, None)
+
+        # computed once here, rather than in each worker
+        if kernel.precompute_convolution:
+            kernel.precompute_hrf_convolution()
+        if getattr(self, 'hrf_basis_operators_source', None) is self.stimulus:
+            kernel.hrf_basis_operators_source = kernel.stimulus
+
+        return kernel
+
+    def stimulus_through_rfs(self, mu_x, mu_y, size, dm):
+        """stimulus_through_rfs
+
+        dot the design matrix and the isotropic gaussian rfs with the given
+        parameters, either as separable gaussians or through 2D rfs
+
+        Parameters
+        ----------
+        mu_x : float or numpy.ndarray
+            x-position of pRF(s)
+        mu_y : float or numpy.ndarray
+            y-position of pRF(s)
+        size : float or numpy.ndarray
+            size of pRF(s)
+        dm : numpy.ndarray
+            design matrix, either convolved with hrf or not
+
+        Returns
+        -------
+        numpy.ndarray
+            timecourses, first dimension pRFs, second dimension time
+        """
+        if self.separable_rfs:
+            # the 2D rfs below are rotated such that rows run from high to low y
+            return stimulus_through_separable_prf(
+                x_coordinates=self.stimulus.x_coordinates_1d,
+                y_coordinates=self.stimulus.y_coordinates_1d[::-1],
+                mu_x=mu_x,
+                mu_y=mu_y,
+                sigma=size,
+                stimulus=dm,
+                normalize_RFs=self.normalize_RFs)
+
+        rf = np.rot90(gauss2D_iso_cart(x=self.stimulus.x_coordinates[..., np.newaxis],
+                              y=self.stimulus.y_coordinates[..., np.newaxis],
+                              mu=(mu_x, mu_y),
+                              sigma=size,
+                              normalize_RFs=self.normalize_RFs).T, axes=(1,2))
+
+        return stimulus_through_prf(rf, dm)
+
+    def stimulus_through_rfs_jacobian(self, mu_x, mu_y, size, dm):
+        """stimulus_through_rfs_jacobian
+
+        as stimulus_through_rfs, but also returns the derivatives of the
+        timecourses with respect to mu_x, mu_y and size
+        (see timecourse.stimulus_through_separable_prf_jacobian)
+
+        Parameters
+        ----------
+        mu_x : float or numpy.ndarray
+            x-position of pRF(s)
+        mu_y : float or numpy.ndarray
+            y-position of pRF(s)
+        size : float or numpy.ndarray
+            size of pRF(s)
+        dm : numpy.ndarray
+            design matrix, either convolved with hrf or not
+
+        Returns
+        -------
+        numpy.ndarray
+            timecourses, first dimension pRFs, second dimension time
+        numpy.ndarray
+            derivatives, first dimension pRFs, second dimension
+            (mu_x, mu_y, size), third dimension time
+        """
+        return stimulus_through_separable_prf_jacobian(
+            x_coordinates=self.stimulus.x_coordinates_1d,
+            y_coordinates=self.stimulus.y_coordinates_1d[::-1],
+            mu_x=mu_x,
+            mu_y=mu_y,
+            sigma=size,
+            stimulus=dm,
+            normalize_RFs=self.normalize_RFs)
+
+    def convolve_and_filter_jacobian(self, neural_tc, neural_jacobian, hrf_1=None, hrf_2=None):
+        """convolve_and_filter_jacobian
+
+        convolves (and if requested, filters) neural timecourses together with
+        their derivatives. Both operations are linear, so the derivatives of the
+        bold timecourses are the convolved and filtered neural derivatives.
+        As the hrf is linear in hrf_1 and hrf_2, the derivatives with respect
+        to these are the neural timecourses convolved with the spm time and
+        dispersion derivatives.
+
+        Parameters
+        ----------
+        neural_tc : numpy.ndarray
+            neural timecourses, first dimension pRFs, second dimension time
+        neural_jacobian : numpy.ndarray
+            derivatives of neural_tc, first dimension pRFs,
+            second dimension parameters, third dimension time
+        hrf_1 : float or numpy.ndarray, optional
+            hrf time derivative weight (the default is None, for self.hrf)
+        hrf_2 : float or numpy.ndarray, optional
+            hrf dispersion derivative weight (the default is None, for self.hrf)
+
+        Returns
+        -------
+        numpy.ndarray
+            bold timecourses, first dimension pRFs, second dimension time
+        numpy.ndarray
+            derivatives of the bold timecourses, same layout as neural_jacobian
+        numpy.ndarray or None
+            derivatives with respect to hrf_1 and hrf_2, first dimension pRFs,
+            second dimension (hrf_1, hrf_2), third dimension time.
+            None if hrf_1 or hrf_2 is None.
+        """
+        n_prfs, n_params, n_timepoints = neural_jacobian.shape
+        all_tcs = np.concatenate([neural_tc[:, np.newaxis], neural_jacobian],
+                                 axis=1).reshape(-1, n_timepoints)
+
+        if hrf_1 is None or hrf_2 is None:
+            all_tcs = self.convolve_neural_timecourse(all_tcs)
+        else:
+            # convolve once with each basis function, rather than with a different hrf per pRF
+            canonical_tcs, time_derivative_tcs, dispersion_derivative_tcs = \
+                self.convolve_hrf_basis(all_tcs).reshape(3, n_prfs, n_params+1, n_timepoints)
+            all_tcs = np.concatenate([
+                (canonical_tcs +
+                 np.reshape(hrf_1, (-1, 1, 1)) * time_derivative_tcs +
+                 np.reshape(hrf_2, (-1, 1, 1)) * dispersion_derivative_tcs).reshape(-1, n_timepoints),
+                time_derivative_tcs[:, 0],
+                dispersion_derivative_tcs[:, 0]])
+
+        if self.filter_predictions:
+            all_tcs = self.filter_timecourses(all_tcs)
+
+        tc_and_jacobian = all_tcs[:n_prfs*(n_params+1)].reshape(n_prfs, n_params+1, n_timepoints)
+        if hrf_1 is None or hrf_2 is None:
+            hrf_jacobian = None
+        else:
+            hrf_jacobian = all_tcs[n_prfs*(n_params+1):].reshape(2, n_prfs, n_timepoints).transpose(1, 0, 2)
+
+        return tc_and_jacobian[:, 0], tc_and_jacobian[:, 1:], hrf_jacobian
+
+    def return_prediction_and_jacobian(self,
+                                       mu_x,
+                                       mu_y,
+                                       size,
+                                       beta,
+                                       baseline,
+                                       hrf_1=None,
+                                       hrf_2=None):
+        """return_prediction_and_jacobian
+
+        returns the prediction for a set of parameters, as return_prediction,
+        together with its analytic derivatives with respect to all parameters,
+        for use as the gradient in iterative search.
+
+        Parameters
+        ----------
+        mu_x : float or numpy.ndarray
+            x-position of pRF
+        mu_y : float or numpy.ndarray
+            y-position of pRF
+        size : float or numpy.ndarray
+            size of pRF
+        beta : float or numpy.ndarray
+            amplitude of pRF
+        baseline : float or numpy.ndarray
+            baseline of pRF
+        hrf_1, hrf_2 : float or numpy.ndarray, optional
+            hrf derivative weights (the default is None, for self.hrf)
+
+        Returns
+        -------
+        numpy.ndarray
+            predictions, first dimension pRFs, second dimension time
+        numpy.ndarray
+            derivatives of the predictions, first dimension pRFs, second dimension
+            parameters (in the order of the arguments), third dimension time
+        """
+        neural_tc, neural_jacobian = self.stimulus_through_rfs_jacobian(
+            mu_x, mu_y, size, self.stimulus.design_matrix)
+        tc, tc_jacobian, hrf_jacobian = self.convolve_and_filter_jacobian(
+            neural_tc, neural_jacobian, hrf_1, hrf_2)
+
+        beta = np.reshape(beta, (-1, 1, 1))
+        baseline = np.reshape(baseline, (-1, 1))
+
+        jacobian = [beta * tc_jacobian,
+                    tc[:, np.newaxis],
+                    np.ones_like(tc)[:, np.newaxis]]
+        if hrf_jacobian is not None:
+            jacobian.append(beta * hrf_jacobian)
+
+        return baseline + beta[:, 0] * tc, np.concatenate(jacobian, axis=1)
 
     def create_rfs(self):
         """create_rfs
@@ -215,13 +767,69 @@ class Iso2DGaussianModel(Model):
 
         """
         assert hasattr(self, 'xs'), "please set up the grid first"
-        self.grid_rfs = np.rot90(gauss2D_iso_cart(
+        self.grid_rfs = self.create_chunk_rfs(0, self.xs.size)
+
+    def create_chunk_rfs(self, start, stop):
+        """create_chunk_rfs
+
+        creates rfs for grid points start to stop of the (raveled) grid
+
+        Parameters
+        ----------
+        start : int
+            index of the first grid point of the chunk
+        stop : int
+            index after the last grid point of the chunk
+
+        Returns
+        -------
+        numpy.ndarray
+            rfs of the chunk, first dimension grid points
+        """
+        assert hasattr(self, 'xs'), "please set up the grid first"
+        return np.rot90(gauss2D_iso_cart(
             x=self.stimulus.x_coordinates[..., np.newaxis],
             y=self.stimulus.y_coordinates[..., np.newaxis],
-            mu=np.array([self.xs.ravel(), self.ys.ravel()]),
-            sigma=self.sizes.ravel(),
+            mu=np.array([self.xs.ravel()[start:stop], self.ys.ravel()[start:stop]]),
+            sigma=self.sizes.ravel()[start:stop],
             normalize_RFs=self.normalize_RFs).T, axes=(1,2))
 
+    def stream_grid_predictions(self, chunk_size):
+        """stream_grid_predictions
+
+        creates (and if requested, filters) timecourses for the grid in chunks
+        of chunk_size rfs, written into a preallocated float32 array.
+        The rfs (or, for separable rfs, the timecourses) of the full grid are
+        never held in memory at once, so that peak memory scales with
+        chunk_size instead of with the grid size.
+
+        Parameters
+        ----------
+        chunk_size : int
+            number of rfs created at a time
+        """
+        assert hasattr(self, 'xs'), "please set up the grid first"
+        n_predictions = self.xs.size
+        self.predictions = np.zeros((n_predictions,
+                                     self.stimulus.convolved_design_matrix.shape[-1]),
+                                    dtype='float32')
+
+        for start in range(0, n_predictions, chunk_size):
+            stop = min(start+chunk_size, n_predictions)
+            if self.separable_rfs:
+                chunk_predictions = self.stimulus_through_rfs(
+                    self.xs.ravel()[start:stop], self.ys.ravel()[start:stop],
+                    self.sizes.ravel()[start:stop], self.stimulus.convolved_design_matrix)
+            else:
+                chunk_predictions = stimulus_through_prf(
+                    self.create_chunk_rfs(start, stop),
+                    self.stimulus.convolved_design_matrix)
+
+            if self.filter_predictions:
+                chunk_predictions = self.filter_timecourses(chunk_predictions)
+
+            self.predictions[start:stop] = chunk_predictions
+
     def stimulus_times_prfs(self):
         """stimulus_times_prfs
 
@@ -233,10 +841,289 @@ class Iso2DGaussianModel(Model):
             self.grid_rfs, self.stimulus.convolved_design_matrix)
 
 
+    def setup_grid(self, ecc_grid, polar_grid, size_grid):
+        """setup_grid
+
+        sets up the (polar x ecc x size) meshgrids of grid parameters,
+        without creating predictions, and empties the cache of
+        on-demand grid predictions (see grid_predictions)
+
+        Parameters
+        ----------
+        ecc_grid : list
+            eccentricity grid
+        polar_grid : list
+            polar angle grid
+        size_grid : list
+            size grid
+        """
+        assert ecc_grid is not None and polar_grid is not None and size_grid is not None, \
+            "please fill in all spatial grids"
+
+        self.eccs, self.polars, self.sizes = np.meshgrid(
+            ecc_grid, polar_grid, size_grid)
+        self.xs, self.ys = np.cos(self.polars) * \
+            self.eccs, np.sin(self.polars) * self.eccs
+
+        self.__dict__.pop('grid_prediction_cache', None)
+        self.__dict__.pop('grid_prediction_computed', None)
+
+    def grid_predictions(self, indices, chunk_size=1000, cache=True):
+        """grid_predictions
+
+        returns (filtered) float32 predictions for the given points of the
+        raveled grid. Predictions are created on demand and kept in
+        grid_prediction_cache, so each grid point is created at most once;
+        grid_prediction_computed marks the points created so far.
+
+        Parameters
+        ----------
+        indices : numpy.ndarray of int
+            indices into the raveled grid (see setup_grid)
+        chunk_size : int, optional
+            number of missing predictions created at a time. The default is 1000.
+        cache : bool, optional
+            keep the created predictions in grid_prediction_cache. Without,
+            predictions already cached are reused, but new ones are not kept,
+            e.g. to stream over the full grid. The default is True.
+
+        Returns
+        -------
+        numpy.ndarray
+            predictions, first dimension indices, second dimension time
+        """
+        assert hasattr(self, 'xs'), "please set up the grid first"
+        n_timepoints = self.stimulus.convolved_design_matrix.shape[-1]
+
+        def create(chunk):
+            predictions = self.stimulus_through_rfs(
+                self.xs.ravel()[chunk], self.ys.ravel()[chunk], self.sizes.ravel()[chunk],
+                self.stimulus.convolved_design_matrix)
+
+            if self.filter_predictions:
+                predictions = self.filter_timecourses(predictions)
+            return predictions
+
+        indices = np.asarray(indices)
+        if not cache:
+            predictions = np.zeros((indices.size, n_timepoints), dtype='float32')
+            missing = np.arange(indices.size)
+            if hasattr(self, 'grid_prediction_cache'):
+                computed = self.grid_prediction_computed[indices.ravel()]
+                predictions[computed] = self.grid_prediction_cache[indices.ravel()[computed]]
+                missing = missing[~computed]
+            for start in range(0, missing.size, chunk_size):
+                chunk = missing[start:start+chunk_size]
+                predictions[chunk] = create(indices.ravel()[chunk])
+            return predictions.reshape(indices.shape + (n_timepoints,))
+
+        if not hasattr(self, 'grid_prediction_cache'):
+            # zero pages are only committed by the OS once written to
+            self.grid_prediction_cache = np.zeros((self.xs.size, n_timepoints), dtype='float32')
+            self.grid_prediction_computed = np.zeros(self.xs.size, dtype=bool)
+
+        missing = np.unique(indices[~self.grid_prediction_computed[indices]])
+        for start in range(0, missing.size, chunk_size):
+            chunk = missing[start:start+chunk_size]
+            self.grid_prediction_cache[chunk] = create(chunk)
+            self.grid_prediction_computed[chunk] = True
+
+        return self.grid_prediction_cache[indices]
+
+    def grid_prediction_basis(self, cache_dir=None, chunk_size=8192):
+        """grid_prediction_basis
+
+        orthonormal temporal basis of the grid predictions: the right singular
+        vectors of the prediction matrix after removing the mean of each
+        prediction, ordered by decreasing singular value. They are obtained
+        from the (time x time) Gram matrix, accumulated over chunks of
+        predictions. With cache_dir (and cached grid predictions), basis and
+        singular values are stored next to the predictions, under the same key.
+
+        Parameters
+        ----------
+        cache_dir : str, optional
+            grid cache folder (see create_grid_predictions). The default is None.
+        chunk_size : int, optional
+            number of predictions per chunk. The default is 8192.
+
+        Returns
+        -------
+        numpy.ndarray
+            basis, first dimension time, second dimension components
+        numpy.ndarray
+            singular values of the components
+        """
+        assert hasattr(self, 'predictions'), "please create the grid predictions first"
+        use_cache = cache_dir is not None and hasattr(self, 'grid_key')
+
+        if use_cache:
+            basis = load_cached_array(cache_dir, self.grid_key, 'svd_basis')
+            singular_values = load_cached_array(cache_dir, self.grid_key, 'svd_singular_values')
+            if basis is not None and singular_values is not None:
+                return basis, singular_values
+
+        n_timepoints = self.predictions.shape[-1]
+        gram = np.zeros((n_timepoints, n_timepoints))
+        for start in range(0, self.predictions.shape[0], chunk_size):
+            chunk = self.predictions[start:start+chunk_size].astype('float64')
+            chunk -= chunk.mean(axis=-1, keepdims=True)
+            gram += chunk.T @ chunk
+
+        eigenvalues, eigenvectors = np.linalg.eigh(gram)
+        order = np.argsort(eigenvalues)[::-1]
+        basis = eigenvectors[:, order]
+        singular_values = np.sqrt(np.clip(eigenvalues[order], 0, None))
+
+        if use_cache:
+            save_cached_array(cache_dir, self.grid_key, 'svd_basis', basis)
+            save_cached_array(cache_dir, self.grid_key, 'svd_singular_values', singular_values)
+
+        return basis, singular_values
+
+    def grid_prediction_index(self, n_clusters=None, cache_dir=None, n_iterations=10, chunk_size=8192):
+        """grid_prediction_index
+
+        inverted-file (IVF) index over the normalized grid predictions, for
+        maximum-inner-product (i.e. highest correlation) search.
+        Predictions are mean-removed and scaled to unit norm, and partitioned
+        by spherical k-means into n_clusters clusters. For each cluster, the
+        index holds its (unit-norm) centroid and its radius, the largest
+        distance of a member to the centroid, so that the inner product of a
+        unit-norm query with any member is at most that with the centroid
+        plus the radius. Normalized predictions are stored sorted by cluster.
+        With cache_dir (and cached grid predictions), the index is stored next
+        to the predictions, under the same key, the number of clusters and the
+        number of k-means iterations.
+
+        Parameters
+        ----------
+        n_clusters : int, optional
+            number of clusters. The default is None, the square root of the
+            number of grid predictions.
+        cache_dir : str, optional
+            grid cache folder (see create_grid_predictions). The default is None.
+        n_iterations : int, optional
+            number of k-means iterations. The default is 10.
+        chunk_size : int, optional
+            number of predictions per chunk. The default is 8192.
+
+        Returns
+        -------
+        dict
+            'normalized_predictions' : normalized predictions, sorted by cluster
+            'order' : grid index of each sorted prediction
+            'offsets' : cluster c holds sorted predictions offsets[c] to offsets[c+1]
+            'centroids' : unit-norm cluster centroids
+            'radii' : cluster radii
+        """
+        assert hasattr(self, 'predictions'), "please create the grid predictions first"
+        n_predictions = self.predictions.shape[0]
+        if n_clusters is None:
+            n_clusters = int(np.sqrt(n_predictions))
+        n_clusters = min(n_clusters, n_predictions)
+
+        names = ['normalized_predictions', 'order', 'offsets', 'centroids', 'radii']
+        use_cache = cache_dir is not None and hasattr(self, 'grid_key')
+
+        if use_cache:
+            index = {name: load_cached_array(cache_dir, self.grid_key, 'ivf_{}_{}_{}'.format(name, n_clusters, n_iterations))
+                     for name in names}
+            if all(array is not None for array in index.values()):
+                return index
+
+        normalized_predictions = np.zeros(self.predictions.shape, dtype='float32')
+        for start in range(0, n_predictions, chunk_size):
+            chunk = self.predictions[start:start+chunk_size].astype('float64')
+            chunk -= chunk.mean(axis=-1, keepdims=True)
+            norms = np.linalg.norm(chunk, axis=-1, keepdims=True)
+            normalized_predictions[start:start+chunk_size] = np.divide(
+                chunk, norms, out=np.zeros_like(chunk), where=norms > 0)
+
+        def assign(centroids):
+            return np.concatenate([np.argmax(normalized_predictions[start:start+chunk_size] @ centroids.T, axis=-1)
+                                   for start in range(0, n_predictions, chunk_size)])
+
+        # spherical k-means
+        rng = np.random.default_rng(0)
+        centroids = normalized_predictions[rng.choice(n_predictions, n_clusters, replace=False)]
+        for _ in range(n_iterations):
+            labels = assign(centroids)
+            order = np.argsort(labels, kind='stable')
+            offsets = np.searchsorted(labels[order], np.arange(n_clusters+1))
+            sums = np.zeros((n_clusters, normalized_predictions.shape[-1]))
+            filled = offsets[:-1] < offsets[1:]
+            sums[filled] = np.add.reduceat(normalized_predictions[order], offsets[:-1][filled], axis=0)
+            norms = np.linalg.norm(sums, axis=-1, keepdims=True)
+            # empty clusters are restarted at random predictions
+            empty = norms[:, 0] == 0
+            sums[empty] = normalized_predictions[rng.choice(n_predictions, empty.sum(), replace=False)]
+            norms[empty] = 1
+            centroids = (sums / norms).astype('float32')
+        labels = assign(centroids)
+
+        order = np.argsort(labels, kind='stable')
+        offsets = np.searchsorted(labels[order], np.arange(n_clusters+1))
+        normalized_predictions = normalized_predictions[order]
+        radii = np.array([np.max(np.linalg.norm(normalized_predictions[offsets[c]:offsets[c+1]] - centroids[c], axis=-1),
+                                 initial=0.0)
+                          for c in range(n_clusters)], dtype='float32')
+
+        index = dict(normalized_predictions=normalized_predictions,
+                     order=order,
+                     offsets=offsets,
+                     centroids=centroids,
+                     radii=radii)
+
+        if use_cache:
+            for name in names:
+                save_cached_array(cache_dir, self.grid_key, 'ivf_{}_{}_{}'.format(name, n_clusters, n_iterations), index[name])
+            index = {name: load_cached_array(cache_dir, self.grid_key, 'ivf_{}_{}_{}'.format(name, n_clusters, n_iterations))
+                     for name in names}
+
+        return index
+
+    def grid_cache_key(self, ecc_grid, polar_grid, size_grid):
+        """grid_cache_key
+
+        content hash identifying the grid predictions of this model:
+        design matrix, screen geometry, TR, hrf, rf normalization,
+        filter settings and the grids.
+
+        Parameters
+        ----------
+        ecc_grid : list
+            eccentricity grid
+        polar_grid : list
+            polar angle grid
+        size_grid : list
+            size grid
+
+        Returns
+        -------
+        str
+            hexadecimal hash
+        """
+        return hash_items(type(self).__name__,
+                          self.stimulus.design_matrix,
+                          self.stimulus.x_coordinates_1d,
+                          self.stimulus.y_coordinates_1d,
+                          self.stimulus.TR,
+                          np.asarray(self.hrf),
+                          self.normalize_RFs,
+                          self.filter_predictions,
+                          self.filter_type,
+                          self.filter_params if self.filter_predictions else None,
+                          np.asarray(ecc_grid, dtype='float64'),
+                          np.asarray(polar_grid, dtype='float64'),
+                          np.asarray(size_grid, dtype='float64'))
+
     def create_grid_predictions(self,
                                 ecc_grid,
                                 polar_grid,
-                                size_grid):
+                                size_grid,
+                                chunk_size=None,
+                                cache_dir=None):
         """create_predictions
 
         creates predictions for a given set of parameters
@@ -251,23 +1138,48 @@ class Iso2DGaussianModel(Model):
             to be filled in by user
         size_grid : list
             to be filled in by user
+        chunk_size : int, optional
+            if given, predictions (and 2D rfs, for non-separable rfs) are
+            created in chunks of chunk_size grid points and stored as float32
+            (see stream_grid_predictions), and grid_rfs is not kept. The
+            default is None, which creates all predictions of the grid at once.
+        cache_dir : str, optional
+            if given, the float32 predictions are stored in this folder under
+            a hash of the stimulus, hrf, filter settings and grids
+            (see grid_cache_key). Later calls with the same settings, e.g.
+            from other slice jobs, open them read-only with np.load(mmap_mode='r')
+            instead of recreating them. The default is None (no caching).
         """
-        assert ecc_grid is not None and polar_grid is not None and size_grid is not None, \
-            "please fill in all spatial grids"
-
-        self.eccs, self.polars, self.sizes = np.meshgrid(
-            ecc_grid, polar_grid, size_grid)
-        self.xs, self.ys = np.cos(self.polars) * \
-            self.eccs, np.sin(self.polars) * self.eccs
-
-        self.create_rfs()
-        self.stimulus_times_prfs()
+        self.setup_grid(ecc_grid, polar_grid, size_grid)
+
+        if cache_dir is not None:
+            self.grid_key = self.grid_cache_key(ecc_grid, polar_grid, size_grid)
+            self.predictions = load_cached_array(cache_dir, self.grid_key, 'predictions')
+
+            if self.predictions is None:
+                self.create_grid_predictions(ecc_grid, polar_grid, size_grid,
+                                             chunk_size=chunk_size)
+                save_cached_array(cache_dir, self.grid_key, 'predictions',
+                                  self.predictions.astype('float32'))
+                self.predictions = load_cached_array(cache_dir, self.grid_key, 'predictions')
+
+            self.filtered_predictions = self.filter_predictions
+            return
+
+        if chunk_size is not None:
+            self.stream_grid_predictions(chunk_size)
+            self.filtered_predictions = self.filter_predictions
+            return
+        elif self.separable_rfs:
+            self.predictions = self.stimulus_through_rfs(
+                self.xs.ravel(), self.ys.ravel(), self.sizes.ravel(),
+                self.stimulus.convolved_design_matrix)
+        else:
+            self.create_rfs()
+            self.stimulus_times_prfs()
 
         if self.filter_predictions:
-            self.predictions = filter_predictions(
-                self.predictions,
-                self.filter_type,
-                self.filter_params)
+            self.predictions = self.filter_timecourses(self.predictions)
             self.filtered_predictions = True
         else:
             self.filtered_predictions = False
@@ -304,32 +1216,21 @@ class Iso2DGaussianModel(Model):
         numpy.ndarray
             single prediction given the model
         """
-        if hrf_1 is None or hrf_2 is None:
-            current_hrf = self.hrf
+        if self.use_precomputed_convolution(hrf_1, hrf_2):
+            # linear model: dot the rf with the hrf-convolved design matrix
+            tc = self.stimulus_through_rfs(mu_x, mu_y, size, self.hrf_convolved_design_matrix)
         else:
-            current_hrf = self.create_hrf([1.0, hrf_1, hrf_2])
-
-        # create the single rf
-        rf = np.rot90(gauss2D_iso_cart(x=self.stimulus.x_coordinates[..., np.newaxis],
-                              y=self.stimulus.y_coordinates[..., np.newaxis],
-                              mu=(mu_x, mu_y),
-                              sigma=size,
-                              normalize_RFs=self.normalize_RFs).T, axes=(1,2))
-
-        dm = self.stimulus.design_matrix
-        neural_tc = stimulus_through_prf(rf, dm)
-
+            # create the single rf timecourse
+            dm = self.stimulus.design_matrix
+            neural_tc = self.stimulus_through_rfs(mu_x, mu_y, size, dm)
 
-        tc = self.convolve_timecourse_hrf(neural_tc, current_hrf)
+            tc = self.convolve_neural_timecourse(neural_tc, hrf_1, hrf_2)
         
 
         if not self.filter_predictions:
             return baseline[..., np.newaxis] + beta[..., np.newaxis] * tc
         else:
-            return baseline[..., np.newaxis] + beta[..., np.newaxis] * filter_predictions(
-                tc,
-                self.filter_type,
-                self.filter_params)
+            return baseline[..., np.newaxis] + beta[..., np.newaxis] * self.filter_timecourses(tc)
 
 
 class CSS_Iso2DGaussianModel(Iso2DGaussianModel):
@@ -370,30 +1271,80 @@ class CSS_Iso2DGaussianModel(Iso2DGaussianModel):
             single prediction given the model
         """
 
-        if hrf_1 is None or hrf_2 is None:
-            current_hrf = self.hrf
-        else:
-            current_hrf = self.create_hrf([1.0, hrf_1, hrf_2])
-
-        # create the single rf
-        rf = np.rot90(gauss2D_iso_cart(x=self.stimulus.x_coordinates[..., np.newaxis],
-                              y=self.stimulus.y_coordinates[..., np.newaxis],
-                              mu=(mu_x, mu_y),
-                              sigma=size,
-                              normalize_RFs=self.normalize_RFs).T, axes=(1,2))
-
+        # create the single rf timecourse
         dm = self.stimulus.design_matrix
-        neural_tc = stimulus_through_prf(rf, dm)**n[..., np.newaxis]
+        neural_tc = self.stimulus_through_rfs(mu_x, mu_y, size, dm)**n[..., np.newaxis]
         
-        tc = self.convolve_timecourse_hrf(neural_tc, current_hrf)
+        tc = self.convolve_neural_timecourse(neural_tc, hrf_1, hrf_2)
 
         if not self.filter_predictions:
             return baseline[..., np.newaxis] + beta[..., np.newaxis] * tc
         else:
-            return baseline[..., np.newaxis] + beta[..., np.newaxis] * filter_predictions(
-                tc,
-                self.filter_type,
-                self.filter_params)
+            return baseline[..., np.newaxis] + beta[..., np.newaxis] * self.filter_timecourses(tc)
+
+
+    def return_prediction_and_jacobian(self,
+                                       mu_x,
+                                       mu_y,
+                                       size,
+                                       beta,
+                                       baseline,
+                                       n,
+                                       hrf_1=None,
+                                       hrf_2=None):
+        """return_prediction_and_jacobian
+
+        returns the prediction for a set of parameters, as return_prediction,
+        together with its analytic derivatives with respect to all parameters.
+        The derivative with respect to n is set to 0 where the rf timecourse
+        is 0, where it is not defined.
+
+        Parameters
+        ----------
+        mu_x, mu_y, size, beta, baseline, n : float or numpy.ndarray
+            see return_prediction
+        hrf_1, hrf_2 : float or numpy.ndarray, optional
+            hrf derivative weights (the default is None, for self.hrf)
+
+        Returns
+        -------
+        numpy.ndarray
+            predictions, first dimension pRFs, second dimension time
+        numpy.ndarray
+            derivatives of the predictions, first dimension pRFs, second dimension
+            parameters (in the order of the arguments), third dimension time
+        """
+        rf_tc, rf_jacobian = self.stimulus_through_rfs_jacobian(
+            mu_x, mu_y, size, self.stimulus.design_matrix)
+
+        n = np.reshape(n, (-1, 1))
+        positive = rf_tc > 0
+        safe_rf_tc = np.where(positive, rf_tc, 1.0)
+        neural_tc = np.where(positive, safe_rf_tc**n, 0.0)
+        # n * rf_tc**(n-1) * rf_jacobian, as n * rf_tc**n * (rf_jacobian / rf_tc):
+        # rf_tc**(n-1) overflows for small n where rf_tc underflows (off-screen
+        # frames of small or distant pRFs). Non-finite entries are set to 0
+        # before the convolution spreads them over the timecourse.
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            neural_jacobian = np.concatenate([
+                (n * neural_tc)[:, np.newaxis] * (rf_jacobian / safe_rf_tc[:, np.newaxis]),
+                (neural_tc * np.log(safe_rf_tc))[:, np.newaxis]], axis=1)
+        neural_jacobian[~np.isfinite(neural_jacobian)] = 0.0
+
+        tc, tc_jacobian, hrf_jacobian = self.convolve_and_filter_jacobian(
+            neural_tc, neural_jacobian, hrf_1, hrf_2)
+
+        beta = np.reshape(beta, (-1, 1, 1))
+        baseline = np.reshape(baseline, (-1, 1))
+
+        jacobian = [beta * tc_jacobian[:, :3],
+                    tc[:, np.newaxis],
+                    np.ones_like(tc)[:, np.newaxis],
+                    beta * tc_jacobian[:, 3:]]
+        if hrf_jacobian is not None:
+            jacobian.append(beta * hrf_jacobian)
+
+        return baseline + beta[:, 0] * tc, np.concatenate(jacobian, axis=1)
 
 
 class Norm_Iso2DGaussianModel(Iso2DGaussianModel):
@@ -403,6 +1354,10 @@ class Norm_Iso2DGaussianModel(Iso2DGaussianModel):
 
     """
 
+    # no analytic derivatives for the normalization model,
+    # iterative search falls back to numerical gradients
+    return_prediction_and_jacobian = None
+
     def create_grid_predictions(self,
                                 gaussian_params,
                                 n_predictions,
@@ -413,33 +1368,57 @@ class Norm_Iso2DGaussianModel(Iso2DGaussianModel):
                                 sb):
         """create_predictions
 
-        creates predictions for a given set of parameters
-
-        [description]
+        creates predictions for a given set of parameters.
+        The prf timecourse of each voxel, and its srf timecourses for each
+        unique surround size, are computed once, and combined over the
+        (sa, nb, sb) grid by broadcasting. All neural timecourses are then
+        convolved with the hrf at once.
 
         Parameters
         ----------
-        gaussian_params: array size (3), containing prf position and size.
+        gaussian_params: array size (3), or (n_voxels, 3), containing prf position and size.
         n_predictions, n_timepoints: self explanatory, obtained from fitter
         nb,sa,ss,sb: meshgrid, created in fitter.grid_fit
 
+        Returns
+        -------
+        numpy.ndarray
+            predictions, (n_predictions, n_timepoints) or, for several
+            voxels, (n_voxels, n_predictions, n_timepoints)
         """
+        gaussian_params = np.asarray(gaussian_params, dtype='float64')
+        single_voxel = gaussian_params.ndim == 1
+        gaussian_params = np.atleast_2d(gaussian_params)
+        n_voxels = gaussian_params.shape[0]
+        sa, ss, nb, sb = [np.asarray(grid, dtype='float64')[:n_predictions, np.newaxis]
+                          for grid in (sa, ss, nb, sb)]
 
-        predictions = np.zeros((n_predictions, n_timepoints), dtype='float32')    
-        
-        for idx in range(n_predictions):
-            prediction_params = np.array([gaussian_params[0],
-                                    gaussian_params[1],
-                                    gaussian_params[2],
-                                    1.0,
-                                    0.0,
-                                    sa[idx],
-                                    ss[idx],
-                                    nb[idx],
-                                    sb[idx]]).T
-            predictions[idx,
-                        :] = self.return_prediction(*list(prediction_params)).astype('float32')
+        dm = self.stimulus.design_matrix
 
+        # prf timecourses, per voxel
+        prf_tc = self.stimulus_through_rfs(gaussian_params[:, 0],
+                                           gaussian_params[:, 1],
+                                           gaussian_params[:, 2],
+                                           dm)
+
+        # srf timecourses, per voxel and unique surround size
+        unique_ss, ss_indices = np.unique(ss[:, 0], return_inverse=True)
+        srf_tc = self.stimulus_through_rfs(np.repeat(gaussian_params[:, 0], unique_ss.size),
+                                           np.repeat(gaussian_params[:, 1], unique_ss.size),
+                                           np.tile(unique_ss, n_voxels),
+                                           dm).reshape(n_voxels, unique_ss.size, n_timepoints)
+
+        # normalization model timecourses, for unit prf amplitude
+        neural_tc = (prf_tc[:, np.newaxis] + nb) / (sa * srf_tc[:, ss_indices] + sb) - nb / sb
+
+        tc = self.convolve_neural_timecourse(neural_tc.reshape(-1, n_timepoints))
+        if self.filter_predictions:
+            tc = self.filter_timecourses(tc)
+
+        predictions = tc.reshape(n_voxels, n_predictions, n_timepoints).astype('float32')
+
+        if single_voxel:
+            return predictions[0]
         return predictions
 
     def return_prediction(self,
@@ -487,42 +1466,25 @@ class Norm_Iso2DGaussianModel(Iso2DGaussianModel):
             single prediction given the model
         """
 
-        if hrf_1 is None or hrf_2 is None:
-            current_hrf = self.hrf
-        else:
-            current_hrf = self.create_hrf([1.0, hrf_1, hrf_2])
-
-        # create the rfs
+        dm = self.stimulus.design_matrix
 
-        prf = np.rot90(gauss2D_iso_cart(x=self.stimulus.x_coordinates[..., np.newaxis],
-                               y=self.stimulus.y_coordinates[..., np.newaxis],
-                               mu=(mu_x, mu_y),
-                               sigma=prf_size,
-                               normalize_RFs=self.normalize_RFs).T, axes=(1,2))
+        # create the rf timecourses
+        prf_tc = self.stimulus_through_rfs(mu_x, mu_y, prf_size, dm)
 
         # surround receptive field (denominator)
-        srf = np.rot90(gauss2D_iso_cart(x=self.stimulus.x_coordinates[..., np.newaxis],
-                               y=self.stimulus.y_coordinates[..., np.newaxis],
-                               mu=(mu_x, mu_y),
-                               sigma=srf_size,
-                               normalize_RFs=self.normalize_RFs).T, axes=(1,2))
-
-        dm = self.stimulus.design_matrix
+        srf_tc = self.stimulus_through_rfs(mu_x, mu_y, srf_size, dm)
 
         # create normalization model timecourse
-        neural_tc = (prf_amplitude[..., np.newaxis] * stimulus_through_prf(prf, dm) + neural_baseline[..., np.newaxis]) /\
-            (srf_amplitude[..., np.newaxis] * stimulus_through_prf(srf, dm) + surround_baseline[..., np.newaxis]) \
+        neural_tc = (prf_amplitude[..., np.newaxis] * prf_tc + neural_baseline[..., np.newaxis]) /\
+            (srf_amplitude[..., np.newaxis] * srf_tc + surround_baseline[..., np.newaxis]) \
                 - neural_baseline[..., np.newaxis]/surround_baseline[..., np.newaxis]
 
-        tc = self.convolve_timecourse_hrf(neural_tc, current_hrf)
+        tc = self.convolve_neural_timecourse(neural_tc, hrf_1, hrf_2)
                 
         if not self.filter_predictions:
             return bold_baseline[..., np.newaxis] + tc
         else:
-            return bold_baseline[..., np.newaxis] + filter_predictions(
-                tc,
-                self.filter_type,
-                self.filter_params)
+            return bold_baseline[..., np.newaxis] + self.filter_timecourses(tc)
 
 
 
@@ -563,35 +1525,85 @@ class DoG_Iso2DGaussianModel(Iso2DGaussianModel):
         numpy.ndarray
             single prediction given the model
         """
-        if hrf_1 is None or hrf_2 is None:
-            current_hrf = self.hrf
+        # linear model: with a fixed hrf, dot the rfs with the hrf-convolved design matrix
+        precomputed = self.use_precomputed_convolution(hrf_1, hrf_2)
+        if precomputed:
+            dm = self.hrf_convolved_design_matrix
         else:
-            current_hrf = self.create_hrf([1.0, hrf_1, hrf_2])
-        # create the rfs
-        prf = np.rot90(gauss2D_iso_cart(x=self.stimulus.x_coordinates[..., np.newaxis],
-                               y=self.stimulus.y_coordinates[..., np.newaxis],
-                               mu=(mu_x, mu_y),
-                               sigma=prf_size,
-                              normalize_RFs=self.normalize_RFs).T, axes=(1,2))
+            dm = self.stimulus.design_matrix
 
-        # surround receptive field
-        srf = np.rot90(gauss2D_iso_cart(x=self.stimulus.x_coordinates[..., np.newaxis],
-                               y=self.stimulus.y_coordinates[..., np.newaxis],
-                               mu=(mu_x, mu_y),
-                               sigma=srf_size,
-                              normalize_RFs=self.normalize_RFs).T, axes=(1,2))
+        # create the rf timecourses
+        prf_tc = self.stimulus_through_rfs(mu_x, mu_y, prf_size, dm)
 
-        dm = self.stimulus.design_matrix
+        # surround receptive field
+        srf_tc = self.stimulus_through_rfs(mu_x, mu_y, srf_size, dm)
 
-        neural_tc = prf_amplitude[..., np.newaxis] * stimulus_through_prf(prf, dm) - \
-            srf_amplitude[..., np.newaxis] * stimulus_through_prf(srf, dm)
+        neural_tc = prf_amplitude[..., np.newaxis] * prf_tc - \
+            srf_amplitude[..., np.newaxis] * srf_tc
 
-        tc = self.convolve_timecourse_hrf(neural_tc, current_hrf)
+        if precomputed:
+            tc = neural_tc
+        else:
+            tc = self.convolve_neural_timecourse(neural_tc, hrf_1, hrf_2)
 
         if not self.filter_predictions:
             return bold_baseline[..., np.newaxis] + tc
         else:
-            return bold_baseline[..., np.newaxis] + filter_predictions(
-                tc,
-                self.filter_type,
-                self.filter_params)
+            return bold_baseline[..., np.newaxis] + self.filter_timecourses(tc)
+
+    def return_prediction_and_jacobian(self,
+                                       mu_x,
+                                       mu_y,
+                                       prf_size,
+                                       prf_amplitude,
+                                       bold_baseline,
+                                       srf_amplitude,
+                                       srf_size,
+                                       hrf_1=None,
+                                       hrf_2=None):
+        """return_prediction_and_jacobian
+
+        returns the prediction for a set of parameters, as return_prediction,
+        together with its analytic derivatives with respect to all parameters.
+
+        Parameters
+        ----------
+        mu_x, mu_y, prf_size, prf_amplitude, bold_baseline, srf_amplitude, srf_size : float or numpy.ndarray
+            see return_prediction
+        hrf_1, hrf_2 : float or numpy.ndarray, optional
+            hrf derivative weights (the default is None, for self.hrf)
+
+        Returns
+        -------
+        numpy.ndarray
+            predictions, first dimension pRFs, second dimension time
+        numpy.ndarray
+            derivatives of the predictions, first dimension pRFs, second dimension
+            parameters (in the order of the arguments), third dimension time
+        """
+        dm = self.stimulus.design_matrix
+
+        prf_tc, prf_jacobian = self.stimulus_through_rfs_jacobian(mu_x, mu_y, prf_size, dm)
+        srf_tc, srf_jacobian = self.stimulus_through_rfs_jacobian(mu_x, mu_y, srf_size, dm)
+
+        prf_amplitude = np.reshape(prf_amplitude, (-1, 1))
+        srf_amplitude = np.reshape(srf_amplitude, (-1, 1))
+
+        neural_tc = prf_amplitude * prf_tc - srf_amplitude * srf_tc
+        neural_jacobian = np.stack([
+            prf_amplitude * prf_jacobian[:, 0] - srf_amplitude * srf_jacobian[:, 0],
+            prf_amplitude * prf_jacobian[:, 1] - srf_amplitude * srf_jacobian[:, 1],
+            prf_amplitude * prf_jacobian[:, 2],
+            prf_tc,
+            np.zeros_like(prf_tc),
+            -srf_tc,
+            -srf_amplitude * srf_jacobian[:, 2]], axis=1)
+
+        tc, jacobian, hrf_jacobian = self.convolve_and_filter_jacobian(
+            neural_tc, neural_jacobian, hrf_1, hrf_2)
+        # bold_baseline is added after convolution
+        jacobian[:, 4] = 1.0
+        if hrf_jacobian is not None:
+            jacobian = np.concatenate([jacobian, hrf_jacobian], axis=1)
+
+        return np.reshape(bold_baseline, (-1, 1)) + tc, jacobian
@@ -1,4 +1,34 @@
 import numpy as np
+from copy import copy
+
+
+def shift_design_matrix(design_matrix, column_shift):
+    """shift_design_matrix
+
+    translates a design matrix along its columns (x), cropped to the screen:
+    column c of the result is column c-column_shift of design_matrix, and
+    columns translated from outside the screen are zero.
+
+    Parameters
+    ----------
+    design_matrix : numpy.ndarray, 3D
+        design matrix (rows, columns, time)
+    column_shift : int
+        translation, in columns (positive towards the last column)
+
+    Returns
+    -------
+    numpy.ndarray
+        translated design matrix
+    """
+    shifted_design_matrix = np.zeros_like(design_matrix)
+    n_columns = design_matrix.shape[1]
+    if column_shift >= 0:
+        shifted_design_matrix[:, column_shift:] = design_matrix[:, :max(n_columns-column_shift, 0)]
+    else:
+        shifted_design_matrix[:, :max(n_columns+column_shift, 0)] = design_matrix[:, -column_shift:]
+
+    return shifted_design_matrix
 
 
 class PRFStimulus2D(object):
@@ -147,7 +177,8 @@ class PRFStimulus2D(object):
 
         self.screen_size_cm = screen_size_cm
         self.screen_distance_cm = screen_distance_cm
-        self.design_matrix = design_matrix
+        # contiguous, so that the design matrix can be reshaped without copies
+        self.design_matrix = np.ascontiguousarray(design_matrix)
         if len(self.design_matrix.shape) >= 3 and self.design_matrix.shape[0] != self.design_matrix.shape[1]:
             raise ValueError  # need the screen to be square
         self.TR = TR
@@ -171,6 +202,9 @@ class PRFStimulus2D(object):
 
 
 
+        # 1D coordinate axes, used for separable (isotropic gaussian) prfs
+        self.x_coordinates_1d, self.y_coordinates_1d = oneD_grid, oneD_grid
+
         self.x_coordinates, self.y_coordinates = np.meshgrid(
             oneD_grid, oneD_grid)
         self.complex_coordinates = self.x_coordinates + self.y_coordinates * 1j
@@ -189,6 +223,78 @@ class PRFStimulus2D(object):
         else:
             self.dx = 1
 
+    def column_shift(self, x_offset):
+        """column_shift
+
+        translation in columns of the design matrix closest to x_offset
+
+        Parameters
+        ----------
+        x_offset : float
+            horizontal translation, in degrees (positive rightward)
+
+        Returns
+        -------
+        int
+        """
+        return int(np.round(x_offset / (self.x_coordinates_1d[1] - self.x_coordinates_1d[0])))
+
+    def shifted_design_matrix(self, x_offset):
+        """shifted_design_matrix
+
+        design matrix translated horizontally by x_offset degrees and cropped
+        to the screen (see shift_design_matrix), e.g. the stimulus in the
+        coordinates of a shifted gaze. Translated design matrices are cached
+        per column shift, in shifted_design_matrices.
+
+        Parameters
+        ----------
+        x_offset : float
+            horizontal translation, in degrees (positive rightward)
+
+        Returns
+        -------
+        numpy.ndarray
+            translated design matrix
+        """
+        column_shift = self.column_shift(x_offset)
+        shifted_design_matrices = self.__dict__.setdefault('shifted_design_matrices', {})
+        if column_shift not in shifted_design_matrices:
+            shifted_design_matrices[column_shift] = shift_design_matrix(self.design_matrix, column_shift)
+
+        return shifted_design_matrices[column_shift]
+
+    def shifted(self, x_offset):
+        """shifted
+
+        stimulus with the design matrix translated horizontally by x_offset
+        degrees (see shifted_design_matrix), and otherwise the same screen,
+        TR and tasks. Shifted stimuli are cached per column shift, in
+        shifted_stimuli, so that models keep their operators cached for
+        them (these are keyed on the stimulus).
+
+        Parameters
+        ----------
+        x_offset : float
+            horizontal translation, in degrees (positive rightward)
+
+        Returns
+        -------
+        PRFStimulus2D
+            translated stimulus
+        """
+        column_shift = self.column_shift(x_offset)
+        shifted_stimuli = self.__dict__.setdefault('shifted_stimuli', {})
+        if column_shift not in shifted_stimuli:
+            shifted_stimulus = copy(self)
+            for attribute in ['convolved_design_matrix', 'shifted_design_matrices', 'shifted_stimuli']:
+                shifted_stimulus.__dict__.pop(attribute, None)
+            shifted_stimulus.design_matrix = self.shifted_design_matrix(x_offset)
+            shifted_stimulus.mask = np.std(shifted_stimulus.design_matrix, axis=-1) != 0
+            shifted_stimuli[column_shift] = shifted_stimulus
+
+        return shifted_stimuli[column_shift]
+
 
 
 class PRFStimulus1D(object):
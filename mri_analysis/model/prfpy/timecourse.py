@@ -2,6 +2,7 @@ import numpy as np
 import scipy as sp
 import scipy.signal as signal
 from statsmodels.tsa.arima_process import arma_generate_sample
+from .rf import gauss1D_cart
 
 
 def convolve_stimulus_dm(stimulus, hrf):
@@ -60,6 +61,268 @@ def stimulus_through_prf(prfs, stimulus, mask=None):
     return prf_r @ stim_r
 
 
+def stimulus_through_separable_prf(x_coordinates,
+                                   y_coordinates,
+                                   mu_x,
+                                   mu_y,
+                                   sigma,
+                                   stimulus,
+                                   normalize_RFs=False,
+                                   chunk_size=1000):
+    """stimulus_through_separable_prf
+
+    dot the stimulus and isotropic gaussian prfs, without creating the prfs.
+
+    An isotropic gaussian factors into a gaussian gx along the x axis and
+    a gaussian gy along the y axis, so the response to stimulus frame S_t
+    is gy @ S_t @ gx. For each unique sigma, the stimulus is first projected
+    onto the 1D gaussians of the axis with the fewest unique positions,
+    after which every prf only needs a small product with the other 1D gaussian.
+    The full-stimulus work thus scales with the number of unique positions
+    along one axis, and the per-prf work with one stimulus dimension
+    (O(N*W*T) for grids on a cartesian lattice, instead of O(N*W*H*T)).
+    When most prfs have a size of their own, the stimulus is instead
+    projected onto the gy of chunks of prfs at once.
+
+    Parameters
+    ----------
+    x_coordinates : numpy.ndarray, 1D
+        x position of each stimulus column (second dimension of stimulus)
+    y_coordinates : numpy.ndarray, 1D
+        y position of each stimulus row (first dimension of stimulus)
+    mu_x : float or numpy.ndarray
+        x positions of the prfs
+    mu_y : float or numpy.ndarray
+        y positions of the prfs
+    sigma : float or numpy.ndarray
+        sizes of the prfs
+    stimulus : numpy.ndarray, 3D
+        the stimulus design matrix (rows, columns, time),
+        either convolved with hrf or not.
+    normalize_RFs : bool, optional
+        whether the prfs are normalized to have volume 1 (the default is False)
+    chunk_size : int, optional
+        maximum number of 1D projections of the stimulus held in memory
+        at once (the default is 1000)
+
+    Returns
+    -------
+    numpy.ndarray
+        timecourses, first dimension prfs (1 for scalar parameters),
+        second dimension time
+    """
+    mu_x, mu_y, sigma = [np.ravel(par).astype('float64') for par in
+                         np.broadcast_arrays(mu_x, mu_y, sigma)]
+    assert stimulus.shape[:2] == (y_coordinates.shape[0], x_coordinates.shape[0]), \
+        """stimulus spatial dimensions {stimdim} must match the number of
+        y {ydim} and x {xdim} coordinates""".format(
+            stimdim=stimulus.shape[:2],
+            ydim=y_coordinates.shape[0],
+            xdim=x_coordinates.shape[0])
+
+    n_rows, n_columns, n_timepoints = stimulus.shape
+    prf_tcs = np.zeros((mu_x.shape[0], n_timepoints))
+    unique_sizes = np.unique(sigma)
+
+    if unique_sizes.shape[0] > mu_x.shape[0] // 2:
+        # hardly any shared sizes (e.g. fitted parameters): project the
+        # stimulus onto the gy of a chunk of prfs with a single GEMM
+        for start in range(0, mu_x.shape[0], chunk_size):
+            stop = start+chunk_size
+            gx = gauss1D_cart(x_coordinates[np.newaxis], mu_x[start:stop, np.newaxis], sigma[start:stop, np.newaxis])
+            gy = gauss1D_cart(y_coordinates[np.newaxis], mu_y[start:stop, np.newaxis], sigma[start:stop, np.newaxis])
+            projections = (gy @ stimulus.reshape(n_rows, -1)).reshape(-1, n_columns, n_timepoints)
+            prf_tcs[start:stop] = np.einsum('nc,nct->nt', gx, projections)
+    else:
+        for size in unique_sizes:
+            size_idx = np.flatnonzero(sigma == size)
+            unique_x, x_idx = np.unique(mu_x[size_idx], return_inverse=True)
+            unique_y, y_idx = np.unique(mu_y[size_idx], return_inverse=True)
+            gx = gauss1D_cart(x_coordinates[np.newaxis], unique_x[:, np.newaxis], size)
+            gy = gauss1D_cart(y_coordinates[np.newaxis], unique_y[:, np.newaxis], size)
+
+            if unique_y.shape[0] <= unique_x.shape[0]:
+                # project rows first: one GEMM per chunk of unique y positions
+                for start in range(0, unique_y.shape[0], chunk_size):
+                    stop = start+chunk_size
+                    in_chunk = np.flatnonzero((y_idx >= start) & (y_idx < stop))
+                    projections = (gy[start:stop] @ stimulus.reshape(n_rows, -1)).reshape(
+                        -1, n_columns, n_timepoints)
+                    prf_tcs[size_idx[in_chunk]] = np.einsum('nc,nct->nt',
+                                                            gx[x_idx[in_chunk]],
+                                                            projections[y_idx[in_chunk]-start])
+            else:
+                # project columns first, stacked over stimulus rows
+                for start in range(0, unique_x.shape[0], chunk_size):
+                    stop = start+chunk_size
+                    in_chunk = np.flatnonzero((x_idx >= start) & (x_idx < stop))
+                    projections = gx[start:stop] @ stimulus
+                    prf_tcs[size_idx[in_chunk]] = np.einsum('nr,rnt->nt',
+                                                            gy[y_idx[in_chunk]],
+                                                            projections[:, x_idx[in_chunk]-start])
+
+    if normalize_RFs:
+        prf_tcs /= (2*np.pi*sigma**2)[:, np.newaxis]
+
+    return prf_tcs
+
+
+def stimulus_through_shifted_separable_prf(x_coordinates,
+                                           y_coordinates,
+                                           mu_x,
+                                           mu_y,
+                                           sigma,
+                                           stimulus,
+                                           column_shifts,
+                                           normalize_RFs=False,
+                                           chunk_size=1000):
+    """stimulus_through_shifted_separable_prf
+
+    dot isotropic gaussian prfs and the stimulus translated along x by each
+    of column_shifts columns (see shift_design_matrix), without creating the
+    prfs or the translated stimuli.
+
+    A translation along x leaves the projection gy @ S_t of the stimulus onto
+    the y gaussian of a prf unchanged, up to a shift of its columns, so it is
+    computed once per prf (as in stimulus_through_separable_prf) and only
+    its product with the x gaussian is repeated for each translation.
+
+    Parameters
+    ----------
+    x_coordinates : numpy.ndarray, 1D
+        x position of each stimulus column (second dimension of stimulus)
+    y_coordinates : numpy.ndarray, 1D
+        y position of each stimulus row (first dimension of stimulus)
+    mu_x : float or numpy.ndarray
+        x positions of the prfs
+    mu_y : float or numpy.ndarray
+        y positions of the prfs
+    sigma : float or numpy.ndarray
+        sizes of the prfs
+    stimulus : numpy.ndarray, 3D
+        the stimulus design matrix (rows, columns, time),
+        either convolved with hrf or not.
+    column_shifts : list of int
+        translations of the stimulus, in columns (positive towards the
+        last column)
+    normalize_RFs : bool, optional
+        whether the prfs are normalized to have volume 1 (the default is False)
+    chunk_size : int, optional
+        maximum number of 1D projections of the stimulus held in memory
+        at once (the default is 1000)
+
+    Returns
+    -------
+    numpy.ndarray
+        timecourses, first dimension translations, second dimension prfs,
+        third dimension time
+    """
+    mu_x, mu_y, sigma = [np.ravel(par).astype('float64') for par in
+                         np.broadcast_arrays(mu_x, mu_y, sigma)]
+    assert stimulus.shape[:2] == (y_coordinates.shape[0], x_coordinates.shape[0]), \
+        """stimulus spatial dimensions {stimdim} must match the number of
+        y {ydim} and x {xdim} coordinates""".format(
+            stimdim=stimulus.shape[:2],
+            ydim=y_coordinates.shape[0],
+            xdim=x_coordinates.shape[0])
+
+    n_rows, n_columns, n_timepoints = stimulus.shape
+    prf_tcs = np.zeros((len(column_shifts), mu_x.shape[0], n_timepoints))
+
+    for start in range(0, mu_x.shape[0], chunk_size):
+        stop = start+chunk_size
+        gx = gauss1D_cart(x_coordinates[np.newaxis], mu_x[start:stop, np.newaxis], sigma[start:stop, np.newaxis])
+        gy = gauss1D_cart(y_coordinates[np.newaxis], mu_y[start:stop, np.newaxis], sigma[start:stop, np.newaxis])
+        projections = (gy @ stimulus.reshape(n_rows, -1)).reshape(-1, n_columns, n_timepoints)
+
+        for shift_nb, shift in enumerate(column_shifts):
+            # column c of the translated stimulus is column c-shift of the stimulus
+            first, last = max(0, -shift), min(n_columns, n_columns-shift)
+            if first < last:
+                prf_tcs[shift_nb, start:stop] = np.einsum('nc,nct->nt',
+                                                          gx[:, first+shift:last+shift],
+                                                          projections[:, first:last])
+
+    if normalize_RFs:
+        prf_tcs /= (2*np.pi*sigma**2)[:, np.newaxis]
+
+    return prf_tcs
+
+
+def stimulus_through_separable_prf_jacobian(x_coordinates,
+                                            y_coordinates,
+                                            mu_x,
+                                            mu_y,
+                                            sigma,
+                                            stimulus,
+                                            normalize_RFs=False):
+    """stimulus_through_separable_prf_jacobian
+
+    dot the stimulus and isotropic gaussian prfs, and return the derivatives
+    of these timecourses with respect to prf x position, y position and size.
+
+    With gx and gy the 1D gaussians (see stimulus_through_separable_prf),
+    dx = x - mu_x and dy = y - mu_y, the derivatives of the prf are
+    gx*gy*dx/sigma**2, gx*gy*dy/sigma**2 and gx*gy*(dx**2+dy**2)/sigma**3.
+    The stimulus is projected onto gy, gy*dy and gy*dy**2 of all prfs with
+    a single matrix multiplication, after which each timecourse is a
+    small product with gx, gx*dx or gx*dx**2.
+
+    Parameters
+    ----------
+    x_coordinates : numpy.ndarray, 1D
+        x position of each stimulus column (second dimension of stimulus)
+    y_coordinates : numpy.ndarray, 1D
+        y position of each stimulus row (first dimension of stimulus)
+    mu_x : float or numpy.ndarray
+        x positions of the prfs
+    mu_y : float or numpy.ndarray
+        y positions of the prfs
+    sigma : float or numpy.ndarray
+        sizes of the prfs
+    stimulus : numpy.ndarray, 3D
+        the stimulus design matrix (rows, columns, time)
+    normalize_RFs : bool, optional
+        whether the prfs are normalized to have volume 1 (the default is False)
+
+    Returns
+    -------
+    numpy.ndarray
+        timecourses, first dimension prfs, second dimension time
+    numpy.ndarray
+        derivatives of the timecourses, first dimension prfs,
+        second dimension (mu_x, mu_y, sigma), third dimension time
+    """
+    mu_x, mu_y, sigma = [np.ravel(par).astype('float64') for par in
+                         np.broadcast_arrays(mu_x, mu_y, sigma)]
+    n_prfs = mu_x.shape[0]
+    n_rows, n_columns, n_timepoints = stimulus.shape
+
+    dx = x_coordinates[np.newaxis] - mu_x[:, np.newaxis]
+    dy = y_coordinates[np.newaxis] - mu_y[:, np.newaxis]
+    gx = np.exp(-dx**2/(2*sigma[:, np.newaxis]**2))
+    gy = np.exp(-dy**2/(2*sigma[:, np.newaxis]**2))
+
+    # (3, prfs, columns, time) projections of the stimulus onto gy, gy*dy, gy*dy**2
+    projections = (np.concatenate([gy, gy*dy, gy*dy**2]) @ stimulus.reshape(n_rows, -1)).reshape(
+        3, n_prfs, n_columns, n_timepoints)
+
+    prf_tcs = np.einsum('nc,nct->nt', gx, projections[0])
+    prf_jacobian = np.stack([
+        np.einsum('nc,nct->nt', gx*dx, projections[0]) / sigma[:, np.newaxis]**2,
+        np.einsum('nc,nct->nt', gx, projections[1]) / sigma[:, np.newaxis]**2,
+        (np.einsum('nc,nct->nt', gx*dx**2, projections[0]) +
+         np.einsum('nc,nct->nt', gx, projections[2])) / sigma[:, np.newaxis]**3], axis=1)
+
+    if normalize_RFs:
+        # derivative of the 1/(2*pi*sigma**2) normalization itself
+        prf_jacobian[:, 2] -= 2 * prf_tcs / sigma[:, np.newaxis]
+        prf_tcs /= (2*np.pi*sigma**2)[:, np.newaxis]
+        prf_jacobian /= (2*np.pi*sigma**2)[:, np.newaxis, np.newaxis]
+
+    return prf_tcs, prf_jacobian
+
+
 def filter_predictions(predictions, 
                        filter_type,
                        filter_params):
@@ -90,6 +353,99 @@ def filter_predictions(predictions,
         return predictions
 
 
+def filter_operator(n_timepoints, filter_type, filter_params):
+    """filter_operator
+
+    time x time matrix F such that predictions @ F equals
+    filter_predictions(predictions, filter_type, filter_params), up to the
+    late_iso_dict baseline correction, which is not linear
+    (see baseline_correct_predictions). Both filters are linear and act on
+    each task separately, so F is block-diagonal, with as blocks the filter
+    applied to the rows of an identity matrix of the length of each task.
+
+    Parameters
+    ----------
+    n_timepoints : int
+        number of timepoints of the predictions
+    filter_type : str
+        'sg' or 'dc', see filter_predictions
+    filter_params : dict
+        see sgfilter_predictions and dcfilter_predictions
+
+    Returns
+    -------
+    numpy.ndarray
+        filter operator, n_timepoints x n_timepoints
+    """
+    task_lengths = filter_params.get('task_lengths')
+    if task_lengths is None:
+        task_lengths = [n_timepoints]
+
+    assert np.sum(task_lengths) == n_timepoints, "Task lengths \
+    are incompatible with the number of prediction timepoints."
+
+    operator = np.zeros((n_timepoints, n_timepoints))
+
+    start = 0
+    for task_length in task_lengths:
+        stop = start+task_length
+        task_params = dict(filter_params, task_lengths=[task_length], task_names=None, late_iso_dict=None)
+        operator[start:stop, start:stop] = filter_predictions(np.eye(task_length), filter_type, task_params)
+        start += task_length
+
+    return operator
+
+
+def baseline_correct_predictions(filtered_predictions,
+                                 task_lengths,
+                                 task_names,
+                                 late_iso_dict):
+    """baseline_correct_predictions
+
+    shifts the filtered predictions of each task to a common BOLD baseline,
+    the median over tasks of the median of each task over the late_iso_dict
+    timepoints, and then subtracts that common baseline
+
+    Parameters
+    ----------
+    filtered_predictions : numpy.ndarray
+        array containing filtered predictions, last dimension is time
+    task_lengths : list of ints
+        lengths of the tasks in TRs
+    task_names : list of str
+        Task names
+    late_iso_dict : dict
+        Dictionary whose keys correspond to task_names. Entries are ndarrays
+        containing the TR indices used to compute the BOLD baseline for each task.
+
+    Returns
+    -------
+    numpy.ndarray
+        baseline corrected predictions (the input array, modified in place)
+    """
+    baselines = dict()
+
+    start = 0
+    for i, task_length in enumerate(task_lengths):
+        stop = start+task_length
+        baselines[task_names[i]] = np.median(filtered_predictions[..., start:stop][...,late_iso_dict[task_names[i]]],
+                                           axis=-1)
+        start += task_length
+
+    baseline_full = np.median([baselines[task_name] for task_name in task_names], axis=0)
+
+    start = 0
+    for i, task_length in enumerate(task_lengths):
+        stop = start+task_length
+        baseline_diff = baseline_full - baselines[task_names[i]]
+        filtered_predictions[..., start:stop] += baseline_diff[...,np.newaxis]
+        start += task_length
+
+    filtered_predictions -= baseline_full[...,np.newaxis]
+
+    return filtered_predictions
+
+
 def dcfilter_predictions(predictions, first_modes_to_remove=5,
                          last_modes_to_remove_percent=0,
                          add_mean=True,
@@ -133,7 +489,6 @@ def dcfilter_predictions(predictions, first_modes_to_remove=5,
     assert np.sum(task_lengths) == predictions.shape[-1], "Task lengths \
     are incompatible with the number of prediction timepoints."
 
-    baselines = dict()
     filtered_predictions = np.zeros_like(predictions)
 
     start = 0
@@ -142,40 +497,30 @@ def dcfilter_predictions(predictions, first_modes_to_remove=5,
         stop = start+task_length
 
         try:
-            coeffs = sp.fftpack.dct(predictions, norm='ortho', axis=-1)
-            coeffs[:, :first_modes_to_remove] = 0
+            # each task is transformed separately
+            coeffs = sp.fftpack.dct(predictions[..., start:stop], norm='ortho', axis=-1)
+            coeffs[..., :first_modes_to_remove] = 0
             if last_modes_to_remove_percent>0:
                 last_modes_to_remove = int(task_length*last_modes_to_remove_percent/100)
-                coeffs[:, -last_modes_to_remove:] = 0
+                coeffs[..., -last_modes_to_remove:] = 0
         
             filtered_predictions[..., start:stop] = sp.fftpack.idct(coeffs, norm='ortho', axis=-1)
         except:
             print("Error occurred during predictions discrete cosine filtering.\
                   Using unfiltered prediction instead")
-            filtered_predictions = predictions
+            filtered_predictions[..., start:stop] = predictions[..., start:stop]
         
         if add_mean:
             filtered_predictions[..., start:stop] += np.mean(
                     predictions[..., start:stop], axis=-1)[..., np.newaxis]
-            
-        
-        if late_iso_dict is not None:
-            baselines[task_names[i]] = np.median(filtered_predictions[..., start:stop][...,late_iso_dict[task_names[i]]],
-                                               axis=-1)
 
         start += task_length
 
     if late_iso_dict is not None:
-        baseline_full = np.median([baselines[task_name] for task_name in task_names], axis=0)
-
-        start = 0
-        for i, task_length in enumerate(task_lengths):
-            stop = start+task_length
-            baseline_diff = baseline_full - baselines[task_names[i]]
-            filtered_predictions[..., start:stop] += baseline_diff[...,np.newaxis]
-            start += task_length
-        
-        filtered_predictions -= baseline_full[...,np.newaxis]
+        filtered_predictions = baseline_correct_predictions(filtered_predictions,
+                                                            task_lengths,
+                                                            task_names,
+                                                            late_iso_dict)
 
     return filtered_predictions
 
@@ -237,8 +582,6 @@ def sgfilter_predictions(predictions, window_length=201, polyorder=3,
     if highpass:
         hp_filtered_predictions = np.zeros_like(predictions)
 
-    baselines = dict()
-
     start = 0
     for i, task_length in enumerate(task_lengths):
 
@@ -272,23 +615,13 @@ def sgfilter_predictions(predictions, window_length=201, polyorder=3,
             hp_filtered_predictions[..., start:stop] = predictions[..., start:stop]\
                 - lp_filtered_predictions[..., start:stop]
 
-            if late_iso_dict is not None:
-                baselines[task_names[i]] = np.median(hp_filtered_predictions[..., start:stop][...,late_iso_dict[task_names[i]]],
-                                                   axis=-1)
-
         start += task_length
 
     if late_iso_dict is not None and highpass:
-        baseline_full = np.median([baselines[task_name] for task_name in task_names], axis=0)
-
-        start = 0
-        for i, task_length in enumerate(task_lengths):
-            stop = start+task_length
-            baseline_diff = baseline_full - baselines[task_names[i]]
-            hp_filtered_predictions[..., start:stop] += baseline_diff[...,np.newaxis]
-            start += task_length
-        
-        hp_filtered_predictions -= baseline_full[...,np.newaxis]
+        hp_filtered_predictions = baseline_correct_predictions(hp_filtered_predictions,
+                                                               task_lengths,
+                                                               task_names,
+                                                               late_iso_dict)
 
     if highpass:
         return hp_filtered_predictions
@@ -0,0 +1,285 @@
+import numpy as np
+
+
+class VoxelSource(object):
+    """VoxelSource
+
+    out-of-core fitter input: data of units x time, read in blocks of units
+    from any two-dimensional array-like that supports slicing, such as a
+    numpy.memmap, an h5py or a zarr dataset. Blocks are returned as float32,
+    so only the units in use are ever held in memory.
+
+    """
+
+    def __init__(self, data, block_size=4096):
+        """__init__ for VoxelSource
+
+        Parameters
+        ----------
+        data : array-like, 2D
+            data, first dimension units, second dimension time
+        block_size : int, optional
+            number of units read at a time. The default is 4096.
+        """
+        assert len(data.shape) == 2, \
+            "input data should be two-dimensional, with first dimension units and second dimension time"
+
+        self.data = data
+        self.shape = tuple(data.shape)
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """__getitem__
+
+        units selected by a slice, an integer array or a boolean mask, read
+        block by block
+
+        Returns
+        -------
+        numpy.ndarray
+            float32 data of the selected units
+        """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if step == 1:
+                return np.asarray(self.data[start:stop], dtype='float32')
+            key = np.arange(start, stop, step)
+
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        if key.ndim == 0:
+            return np.asarray(self.data[int(key)], dtype='float32')
+
+        selection = np.zeros((key.shape[0], self.shape[1]), dtype='float32')
+        for indices, block in self.blocks(key):
+            selection[indices] = block
+        return selection
+
+    def blocks(self, units=None):
+        """blocks
+
+        iterates over blocks of units. Each block is read as the contiguous
+        range of units that covers it, which all array-likes support.
+
+        Parameters
+        ----------
+        units : numpy.ndarray, optional
+            indices of the units to read. The default is None, all units.
+
+        Yields
+        ------
+        indices : numpy.ndarray
+            positions of the units of the block in `units`
+            (their indices, if units is None)
+        block : numpy.ndarray
+            float32 data of the units of the block
+        """
+        if units is None:
+            for start in range(0, self.shape[0], self.block_size):
+                stop = min(start+self.block_size, self.shape[0])
+                yield np.arange(start, stop), np.asarray(self.data[start:stop], dtype='float32')
+            return
+
+        order = np.argsort(units, kind='stable')
+        sorted_units = units[order]
+        start = 0
+        while start < sorted_units.shape[0]:
+            # units within block_size of the first unit of the block
+            stop = np.searchsorted(sorted_units, sorted_units[start] + self.block_size)
+            first, last = sorted_units[start], sorted_units[stop-1]
+            block = np.asarray(self.data[first:last+1], dtype='float32')
+            yield order[start:stop], block[sorted_units[start:stop] - first]
+            start = stop
+
+    def var(self, axis=-1):
+        """var
+
+        variance over time of each unit, computed block by block
+
+        Parameters
+        ----------
+        axis : int, optional
+            only -1 (time), as for numpy.ndarray.var. The default is -1.
+
+        Returns
+        -------
+        numpy.ndarray
+            float32 variance of each unit
+        """
+        assert axis in [-1, 1], "VoxelSource only computes variances over time"
+        data_var = np.zeros(self.shape[0], dtype='float32')
+        for indices, block in self.blocks():
+            data_var[indices] = block.var(axis=-1)
+        return data_var
+
+    @classmethod
+    def from_blocks(cls, blocks, n_units, n_timepoints, filename=None, block_size=4096):
+        """from_blocks
+
+        writes an iterator of (indices, block) into a preallocated array,
+        memory-mapped to filename if given (see allocate_output), as a source
+        that can be read several times
+
+        Parameters
+        ----------
+        blocks : iterable of (numpy.ndarray, numpy.ndarray)
+            unit indices and data of each block
+        n_units, n_timepoints : int
+            shape of the data
+        filename : str, optional
+            .npy file holding the data. The default is None (in memory).
+        block_size : int, optional
+            see __init__. The default is 4096.
+
+        Returns
+        -------
+        VoxelSource
+        """
+        data = allocate_output((n_units, n_timepoints), filename=filename)
+        for indices, block in blocks:
+            data[indices] = block
+        if filename is not None:
+            data.flush()
+
+        return cls(data, block_size=block_size)
+
+    @classmethod
+    def from_nifti(cls, img, mask, filename=None, block_size=4096):
+        """from_nifti
+
+        reads the voxels of a 4D nifti image within mask
+        (see from_nifti_voxels)
+
+        Parameters
+        ----------
+        img : nibabel.Nifti1Image
+            4D image
+        mask : numpy.ndarray, 3D
+            boolean mask of the voxels to read; voxels are ordered as in img[mask]
+        filename : str, optional
+            .npy file holding the data (see from_blocks). The default is None.
+        block_size : int, optional
+            see __init__. The default is 4096.
+
+        Returns
+        -------
+        VoxelSource
+        """
+        return cls.from_nifti_voxels(img, np.argwhere(mask), filename=filename, block_size=block_size)
+
+    @classmethod
+    def from_nifti_voxels(cls, img, voxel_indices, filename=None, block_size=4096):
+        """from_nifti_voxels
+
+        reads the given voxels of a 4D nifti image, one z-slice at a time
+        through the image's data proxy (rather than loading the whole image
+        as float64, as get_fdata does). Only slices holding voxels are read.
+
+        Parameters
+        ----------
+        img : nibabel.Nifti1Image
+            4D image
+        voxel_indices : numpy.ndarray, [voxels, 3]
+            x, y and z indices of the voxels to read, in the order of the units
+        filename : str, optional
+            .npy file holding the data (see from_blocks). The default is None.
+        block_size : int, optional
+            see __init__. The default is 4096.
+
+        Returns
+        -------
+        VoxelSource
+        """
+        voxel_indices = np.asarray(voxel_indices, dtype=int)
+
+        def slice_blocks():
+            for slice_nb in np.unique(voxel_indices[:, 2]):
+                in_slice = np.flatnonzero(voxel_indices[:, 2] == slice_nb)
+                slice_data = np.asarray(img.dataobj[:, :, slice_nb, :], dtype='float32')
+                yield in_slice, slice_data[voxel_indices[in_slice, 0], voxel_indices[in_slice, 1]]
+
+        return cls.from_blocks(slice_blocks(), voxel_indices.shape[0], img.shape[-1],
+                               filename=filename, block_size=block_size)
+
+
+def balanced_shards(costs, n_shards):
+    """balanced_shards
+
+    splits a list of units into n_shards consecutive shards of (nearly)
+    equal total cost, so that jobs fitting one shard each take the same time.
+    Shards are consecutive, so that units ordered by slice (see
+    brain_voxel_indices) give shards that read few slices.
+
+    Parameters
+    ----------
+    costs : numpy.ndarray
+        estimated fitting cost of each unit (e.g. ones, for equal costs)
+    n_shards : int
+        number of shards
+
+    Returns
+    -------
+    list of numpy.ndarray
+        positions of the units of each shard
+    """
+    cumulative_costs = np.cumsum(costs, dtype='float64')
+    targets = cumulative_costs[-1] * np.arange(1, n_shards) / n_shards
+    boundaries = np.searchsorted(cumulative_costs, targets, side='right')
+
+    return np.split(np.arange(len(costs)), boundaries)
+
+
+def brain_voxel_indices(img):
+    """brain_voxel_indices
+
+    indices of the voxels of a 4D nifti image with non-zero variance over
+    time, ordered by z-slice, computed one z-slice at a time
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+        4D image
+
+    Returns
+    -------
+    numpy.ndarray, [voxels, 3]
+        x, y and z indices of the voxels
+    """
+    voxel_indices = []
+    for slice_nb in range(img.shape[2]):
+        slice_data = np.asarray(img.dataobj[:, :, slice_nb, :], dtype='float32')
+        x, y = np.nonzero(np.var(slice_data, axis=-1) != 0.0)
+        voxel_indices.append(np.c_[x, y, np.full(x.shape, slice_nb)])
+
+    return np.concatenate(voxel_indices).astype(int)
+
+
+def allocate_output(shape, filename=None, dtype='float32'):
+    """allocate_output
+
+    preallocated output array, memory-mapped to a .npy file if filename is
+    given, so that results of large fits are written to disk as they are
+    computed and can be reopened with numpy.load(filename, mmap_mode='r')
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the output
+    filename : str, optional
+        .npy file. The default is None (in memory).
+    dtype : str, optional
+        The default is 'float32'.
+
+    Returns
+    -------
+    numpy.ndarray or numpy.memmap
+        zero-filled output
+    """
+    if filename is None:
+        return np.zeros(shape, dtype=dtype)
+
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
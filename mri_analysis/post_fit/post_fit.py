@@ -73,33 +73,32 @@ with open('settings.json') as f:
 base_dir = analysis_info['base_dir']
 deriv_dir = opj(base_dir,'pp_data',subject,'gauss','deriv')
 
-# Check if all slices are present
+# Check if all shards are present
 # -------------------------------
 # Original data to analyse
 data_file = "{base_dir}/pp_data/{sub}/func/{sub}_task-{task}_{preproc}_avg.nii.gz".format(
                         base_dir = base_dir, sub = subject, task = task, preproc = preproc)
 
 img_data = nb.load(data_file)
-data = img_data.get_fdata()
-data_var = np.var(data,axis=3)
-mask = data_var!=0.0
-slices = np.arange(mask.shape[2])[mask.sum(axis=(0,1))>0]
+voxel_files = sorted(glob.glob("{base_dir}/pp_data/{subject}/gauss/shards/{subject}_task-{task}_{preproc}_shard_*_voxels.npy".format(
+                                base_dir = base_dir,
+                                subject = subject,
+                                task = task,
+                                preproc = preproc)))
 
 est_files = []
 miss_files_nb = 0
-for slice_nb in slices:
-    est_file = "{base_dir}/pp_data/{subject}/gauss/fit/{subject}_task-{task}_{preproc}_avg_est_z_{slice_nb}.nii.gz".format(
+for voxel_file in voxel_files:
+    shard_nb = int(voxel_file.split('_shard_')[-1].split('_')[0])
+    est_file = "{base_dir}/pp_data/{subject}/gauss/fit/{subject}_task-{task}_{preproc}_avg_est_shard_{shard_nb}.npy".format(
                                 base_dir = base_dir,
                                 subject = subject,
                                 task = task,
                                 preproc = preproc,
-                                slice_nb = slice_nb)
+                                shard_nb = shard_nb)
     
-    if os.path.isfile(est_file):
-        if os.path.getsize(est_file) == 0:
-            num_miss_part += 1 
-        else:
-            est_files.append(est_file)
+    if os.path.isfile(est_file) and os.path.getsize(est_file) != 0:
+        est_files.append(est_file)
     else:
         miss_files_nb += 1
 
@@ -110,11 +109,13 @@ if miss_files_nb != 0:
 # Combine and save estimates
 # --------------------------
 print('Combining est files')
-ests = np.zeros((data.shape[0],data.shape[1],data.shape[2],6))
-for est_file in est_files:
-    img_est = nb.load(est_file)
-    est = img_est.get_fdata()
-    ests = ests + est
+ests = np.zeros((img_data.shape[0],img_data.shape[1],img_data.shape[2],6))
+for voxel_file, est_file in zip(voxel_files, est_files):
+    vox_indices = np.load(voxel_file)
+    est = np.load(est_file)
+    if est.shape[0] != vox_indices.shape[0]:
+        sys.exit('%s does not match %s, analysis stopped'%(est_file, voxel_file))
+    ests[tuple(vox_indices.T)] = est
 
 
 # Save estimates data
@@ -408,16 +408,8 @@ def mask_nifti_2_hdf5(deriv_file, tc_file, mask_file_L, mask_file_R, hdf5_file,
     rsq_idx, ecc_idx, polar_real_idx, polar_imag_idx , size_idx, \
             amp_idx, baseline_idx, cov_idx, x_idx, y_idx = 0,1,2,3,4,5,6,7,8,9
     tc_model_mask_data = np.zeros(tc_mask_data.shape)*np.nan
-       
-    for i in np.arange(0,tc_model_mask_data.shape[0]):
-        if np.isnan(deriv_mask_data[i,rsq_idx]):
-            pass
-        else:
-            tc_model_mask_data[i,:] = model.return_prediction(mu_x = deriv_mask_data[i,x_idx],
-                                                              mu_y = deriv_mask_data[i,y_idx], 
-                                                              size = deriv_mask_data[i,size_idx],
-                                                              beta = deriv_mask_data[i,amp_idx],
-                                                              baseline = deriv_mask_data[i,baseline_idx])
+    fit_mask = ~np.isnan(deriv_mask_data[:,rsq_idx])
+    tc_model_mask_data[fit_mask,:] = model.predict_batch(deriv_mask_data[fit_mask][:,[x_idx, y_idx, size_idx, amp_idx, baseline_idx]])
 
     try:
         h5file = h5py.File(hdf5_file, "r+")